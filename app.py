@@ -1,10 +1,10 @@
 import streamlit as st
 import os
-import tempfile
 import re
+import queue
 from history_manager import HistoryManager
-from main import process_video
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from main import process_video, canonical_source
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from utils import (
     extract_meaningful_search_query, 
     parse_timestamp_to_seconds, 
@@ -13,7 +13,9 @@ from utils import (
     search_videos,
     extract_video_id,
     get_video_info,
-    download_video_preview
+    download_video_preview,
+    MEDIA_CACHE,
+    STRATEGY_SCOREBOARD
 )
 
 # ตั้งค่าหน้าเว็บ
@@ -118,6 +120,18 @@ def get_history_mgr_v2(db_path):
 db_path = os.path.join(os.getcwd(), "history.db")
 history_mgr = get_history_mgr_v2(db_path)
 
+def get_uploaded_media_path(uploaded_file):
+    """
+    บันทึกไฟล์ที่ผู้ใช้อัปโหลดลง MEDIA_CACHE (คีย์คือ Hash ของเนื้อหา ไฟล์เดิมอัปโหลดซ้ำจะใช้ไฟล์เดิม แต่ path ที่คืนค่าใช้ชื่อไฟล์ของผู้ใช้เสมอ)
+    และจำ path ไว้ใน Session เพื่อไม่ต้องอ่านและ Hash ไฟล์ใหม่ทุกครั้งที่หน้าโหลดซ้ำ
+    """
+    memo_key = f"upload_path_{uploaded_file.name}_{uploaded_file.size}"
+    path = st.session_state.get(memo_key)
+    if not path or not os.path.exists(path):
+        path = MEDIA_CACHE.store_bytes('upload', bytes(uploaded_file.getbuffer()), uploaded_file.name)
+        st.session_state[memo_key] = path
+    return path
+
 @st.cache_data(ttl=3600, show_spinner=False)
 def get_cached_video_info(url):
     """ฟังก์ชันแคชสำหรับ get_video_info เพื่อลดการเรียกเครือข่ายซ้ำ"""
@@ -133,6 +147,8 @@ SESSION_DEFAULTS = {
     'should_autoplay': False,
     'seek_toggle': 0,
     'results_by_url': {},
+    'live_transcripts': {},
+    'partial_results': {},
     'processing_url': None,
     'paste_urls': "",
     'uploader_key': 0,
@@ -205,15 +221,37 @@ with st.sidebar:
     
     # ส่วนตรวจสอบและจัดการระบบ (Diagnostics & Tools) 
     with st.expander("🛠 ตรวจสอบระบบ (Diagnostics)"):
-        from main import GEMINI_API_KEYS
+        from main import GEMINI_API_KEYS, GEMINI_KEY_POOL, GEMINI_MODEL_REGISTRY, GEMINI_LIMITER, PROCESS_SINGLE_FLIGHT
+        from utils import YTDLP_LIMITER
         
         # 1. API Status
         if GEMINI_API_KEYS:
             st.success(f"✅ **Gemini AI**: พร้อมใช้งาน ({len(GEMINI_API_KEYS)} keys)")
+            cooling_keys = [k for k in GEMINI_KEY_POOL.snapshot() if k['cooldown_remaining'] > 0]
+            if cooling_keys:
+                st.warning(f"🧊 คีย์ที่กำลังพักจาก 429: {len(cooling_keys)}/{len(GEMINI_API_KEYS)}")
+            unavailable_models = [m for m in GEMINI_MODEL_REGISTRY.snapshot() if not m['listed'] or m['open_remaining'] > 0]
+            if unavailable_models:
+                st.caption("⛔ โมเดลที่ข้าม: " + ", ".join(m['model'] for m in unavailable_models))
         else:
             st.error("❌ **Gemini AI**: ไม่พบ API Key")
             
         st.caption("ระบบเสียง: **Gemini-Native Audio** (No Whisper)")
+        for limiter in (GEMINI_LIMITER.snapshot(), YTDLP_LIMITER.snapshot()):
+            st.caption(f"⚙️ งานพร้อมกัน {limiter['name']}: {limiter['in_flight']}/{limiter['limit']} (สูงสุด {limiter['max_limit']})")
+        media = MEDIA_CACHE.snapshot()
+        st.caption(f"💾 แคชไฟล์สื่อ: {media['files']} ไฟล์ {media['bytes'] / 1024 / 1024:,.0f}/{media['max_bytes'] / 1024 / 1024:,.0f} MB")
+        domains = sorted({entry['domain'] for entry in STRATEGY_SCOREBOARD.snapshot()})
+        if domains:
+            best_strategies = []
+            for domain in domains:
+                scores = STRATEGY_SCOREBOARD.scores(domain)
+                best = max(scores, key=scores.get)
+                best_strategies.append(f"{domain} → {best} ({scores[best]:.0%})")
+            st.caption("🎯 กลยุทธ์ดาวน์โหลดที่ได้ผลดีที่สุด: " + ", ".join(best_strategies))
+        running_jobs = PROCESS_SINGLE_FLIGHT.in_flight()
+        if running_jobs:
+            st.caption(f"🔗 วิดีโอที่กำลังประมวลผล: {len(running_jobs)} (ส่งซ้ำจะรอผลจากงานเดิม)")
             
         st.divider()
         
@@ -280,6 +318,10 @@ with st.container():
                 placeholder="https://www.youtube.com/watch?v=...\nhttps://www.tiktok.com/@user/video/...",
                 key="paste_urls"
             )
+            force_refresh = st.checkbox(
+                "ประมวลผลใหม่ (ไม่ใช้ผลลัพธ์เดิมจากประวัติ)",
+                key="force_refresh"
+            )
             process_urls = st.form_submit_button(
                 "เริ่มประมวลผลลิงก์", 
                 type="primary", 
@@ -299,6 +341,10 @@ with st.container():
                 label_visibility="collapsed",
                 key=f"uploader_{st.session_state.uploader_key}"
             )
+            st.checkbox(
+                "ประมวลผลใหม่ (ไม่ใช้ผลลัพธ์เดิมจากประวัติ)",
+                key="force_refresh_upload"
+            )
             process_file = st.form_submit_button(
                 "เริ่มประมวลผลไฟล์", 
                 type="primary", 
@@ -308,15 +354,32 @@ with st.container():
 
 
 
+def render_live_transcript(placeholder, label, lines, max_lines=30, partial=None):
+    """
+    แสดงบทบรรยายที่กำลังถอดเสียง (Streaming) เฉพาะบรรทัดล่าสุด เพื่อไม่ให้หน้าจอยาวเกินไป
+    partial: ผลลัพธ์ชั่วคราวจากคำบรรยาย YouTube (แสดงไว้ด้านบนจนกว่าผลลัพธ์สุดท้ายจะเสร็จ)
+    """
+    with placeholder.container(border=True):
+        if partial:
+            st.markdown("**⚡ สรุปชั่วคราว (จากคำบรรยาย YouTube — จะถูกแทนที่เมื่อถอดเสียงแยกผู้พูดเสร็จ)**")
+            st.write(partial.get('ai_summary', ''))
+            if partial.get('ai_topics'):
+                st.markdown('\n'.join(f"- {t}" for t in partial['ai_topics']))
+            if partial.get('keywords'):
+                st.caption("คำสำคัญ: " + ", ".join(str(k[0] if isinstance(k, (list, tuple)) else k) for k in partial['keywords']))
+        st.markdown(f"**🎙️ กำลังถอดเสียง:** {label[:60]} ({len(lines)} บรรทัด)")
+        st.text('\n'.join(lines[-max_lines:]))
+
+# เพดานจำนวนวิดีโอที่ประมวลผลพร้อมกันในหนึ่งชุด (ความเร็วจริงถูกปรับโดย Adaptive Limiter)
+BATCH_MAX_WORKERS = int(os.getenv('BATCH_MAX_WORKERS', '16'))
+
 # --- ส่วนเริ่มการประมวลผล (Processing) ---
 # เมื่อผู้ใช้คลิกปุ่ม "Process Links" หรือ "Process File"
 if process_urls or process_file:
     items_to_process = []
     
     if process_file and uploaded_file:
-        uploaded_temp_path = os.path.join(tempfile.gettempdir(), f"upload_{uploaded_file.name}")
-        with open(uploaded_temp_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
+        uploaded_temp_path = get_uploaded_media_path(uploaded_file)
         items_to_process.append((uploaded_temp_path, uploaded_file.name, True))
         st.session_state.active_preview_url = uploaded_temp_path
     
@@ -329,33 +392,77 @@ if process_urls or process_file:
         # ใช้ระบบ ThreadPoolExecutor เพื่อประมวลผลวิดีโอหลายตัวพร้อมกัน (Parallel)
         total = len(items_to_process)
         
-        with ThreadPoolExecutor(max_workers=min(len(items_to_process), 5)) as executor:
+        # คิวรับบรรทัดบทบรรยายแบบ Streaming จากเธรดประมวลผล (Streamlit วาดหน้าจอได้จากเธรดหลักเท่านั้น)
+        line_queues = {}
+        partial_queues = {}
+        live_boxes = {}
+        
+        # จำนวนเธรดเป็นเพียงเพดาน งานจริงถูกคุมด้วยตัวจำกัดแบบปรับตัวเอง (YTDLP_LIMITER / GEMINI_LIMITER)
+        # ซึ่งเพิ่มงานพร้อมกันเมื่อสำเร็จต่อเนื่อง และลดลงเมื่อโดน 429/403/Timeout
+        with ThreadPoolExecutor(max_workers=max(1, min(len(items_to_process), BATCH_MAX_WORKERS))) as executor:
             future_to_item = {}
             for target_url, display_name, is_uploaded in items_to_process:
+                result_key = f"res_{target_url}"
+                line_queues[result_key] = queue.Queue()
+                partial_queues[result_key] = queue.Queue()
+                st.session_state.live_transcripts[result_key] = []
+                live_boxes[result_key] = st.empty()
                 # ใช้ระบบ Pipeline อัตโนมัติ (Audio -> Gemini Analysis) - เปิดการแยกเสียงพูด (Diarization) เป็นค่าเริ่มต้น
-                future = executor.submit(process_video, target_url, diarize_mode=True)
+                # วิดีโอที่เคยประมวลผลแล้วจะเปิดจากประวัติทันที (ไม่ใช้โควตา) เว้นแต่เลือกประมวลผลใหม่
+                future = executor.submit(process_video, target_url, diarize_mode=True,
+                                         on_transcript_line=line_queues[result_key].put,
+                                         on_partial_results=partial_queues[result_key].put,
+                                         history_mgr=history_mgr,
+                                         force_refresh=st.session_state.get('force_refresh_upload' if is_uploaded else 'force_refresh', False))
                 future_to_item[future] = (target_url, display_name, is_uploaded)
             
-            for future in as_completed(future_to_item):
-                target_url, display_name, is_uploaded = future_to_item[future]
-                result_key = f"res_{target_url}"
-                try:
-                    # รับผลลัพธ์จากการประมวลผล
-                    results = future.result()
-                    if results:
-                        # เก็บผลลัพธ์ลงใน session_state เพื่อแสดงผลบนหน้าจอ
-                        st.session_state.results_by_url[result_key] = results
-                        if not results.get('error'):
-                            # บันทึกประวัติลงในฐานข้อมูล
-                            entry = {
-                                'title': results['video_title'],
-                                'url': target_url if not is_uploaded else f"Uploaded: {display_name}",
-                                'result_text': results['ai_analysis'] if results['is_audio_processed'] else results['ai_summary'],
-                                'platform': results.get('platform')
-                            }
-                            history_mgr.save_to_history(entry)
-                except Exception as e:
-                    st.session_state.results_by_url[result_key] = {'error': str(e)}
+            pending = set(future_to_item)
+            while pending:
+                done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                
+                # แสดงบทบรรยายที่ Gemini ถอดเสร็จแล้วทันที โดยไม่ต้องรอผลลัพธ์ทั้งหมด
+                for target_url, display_name, is_uploaded in items_to_process:
+                    result_key = f"res_{target_url}"
+                    live_lines = st.session_state.live_transcripts[result_key]
+                    new_lines = []
+                    while True:
+                        try: new_lines.append(line_queues[result_key].get_nowait())
+                        except queue.Empty: break
+                    new_partial = None
+                    while True:
+                        try: new_partial = partial_queues[result_key].get_nowait()
+                        except queue.Empty: break
+                    if new_partial:
+                        st.session_state.partial_results[result_key] = new_partial
+                    if new_lines or new_partial:
+                        live_lines.extend(new_lines)
+                        render_live_transcript(live_boxes[result_key], display_name, live_lines, partial=st.session_state.partial_results.get(result_key))
+                
+                for future in done:
+                    target_url, display_name, is_uploaded = future_to_item[future]
+                    result_key = f"res_{target_url}"
+                    live_boxes[result_key].empty()
+                    st.session_state.live_transcripts.pop(result_key, None)
+                    st.session_state.partial_results.pop(result_key, None)
+                    try:
+                        # รับผลลัพธ์จากการประมวลผล
+                        results = future.result()
+                        if results:
+                            # เก็บผลลัพธ์ลงใน session_state เพื่อแสดงผลบนหน้าจอ
+                            st.session_state.results_by_url[result_key] = results
+                            if not results.get('error') and not results.get('from_history'):
+                                # บันทึกประวัติลงในฐานข้อมูล (ผลลัพธ์จากประวัติไม่บันทึกซ้ำ เพื่อไม่ให้นับเป็นโควตาของวันนี้)
+                                entry = {
+                                    'title': results['video_title'],
+                                    'url': target_url if not is_uploaded else f"Uploaded: {display_name}",
+                                    'result_text': results['ai_analysis'] if results['is_audio_processed'] else results['ai_summary'],
+                                    'platform': results.get('platform'),
+                                    'video_id': canonical_source(target_url),
+                                    'results': results
+                                }
+                                history_mgr.save_to_history(entry)
+                    except Exception as e:
+                        st.session_state.results_by_url[result_key] = {'error': str(e)}
         
         st.success(f"✅ ประมวลผลเสร็จสิ้นทั้งหมด {total} รายการ!")
         st.rerun()
@@ -388,20 +495,22 @@ if urls_text.strip() or st.session_state.active_preview_url:
             # ไฟล์ที่อัปโหลด - ใช้ st.video พร้อมกำหนดเวลาเริ่มต้น
             st.markdown("**📁 ไฟล์ที่อัปโหลด (Uploaded File)**")
             
-            # ใช้เทคนิคการซ้อน Layer 3 ชั้นและคีย์แบบไดนามิกเพื่อบังคับให้เบราว์เซอร์รีเฟรชเมื่อเวลาเปลี่ยน
-            preview_container = st.empty()
-            with preview_container:
-                mod_toggle = st.session_state.seek_toggle % 3
+            # pin ไฟล์ใน MEDIA_CACHE ระหว่างที่ st.video อ่านไฟล์ เพื่อไม่ให้ถูกลบ (LRU) ระหว่างแสดงผล
+            with MEDIA_CACHE.pin(preview_url):
+                # ใช้เทคนิคการซ้อน Layer 3 ชั้นและคีย์แบบไดนามิกเพื่อบังคับให้เบราว์เซอร์รีเฟรชเมื่อเวลาเปลี่ยน
+                preview_container = st.empty()
+                with preview_container:
+                    mod_toggle = st.session_state.seek_toggle % 3
                 
-                if mod_toggle == 0:
-                    st.video(preview_url, start_time=p_start, autoplay=st.session_state.should_autoplay)
-                elif mod_toggle == 1:
-                    with st.container():
-                        st.video(preview_url, start_time=p_start, autoplay=st.session_state.should_autoplay)
-                else:
-                    col_p = st.columns([1])[0]
-                    with col_p:
+                    if mod_toggle == 0:
                         st.video(preview_url, start_time=p_start, autoplay=st.session_state.should_autoplay)
+                    elif mod_toggle == 1:
+                        with st.container():
+                            st.video(preview_url, start_time=p_start, autoplay=st.session_state.should_autoplay)
+                    else:
+                        col_p = st.columns([1])[0]
+                        with col_p:
+                            st.video(preview_url, start_time=p_start, autoplay=st.session_state.should_autoplay)
             
             if p_start > 0:
                 st.caption(f"⏩ กำลังเลื่อนไปยัง {format_time(p_start)}")
@@ -410,47 +519,35 @@ if urls_text.strip() or st.session_state.active_preview_url:
             platform_label = "TikTok" if is_tiktok else "Facebook"
             st.markdown(f"**{platform_label} Video**")
             
-            # Check if we already have a successful preview path in session state or cache
-            import hashlib
-            url_hash = hashlib.md5(preview_url.encode()).hexdigest()
-            preview_key = f"preview_path_{url_hash}"
-            local_preview_path = st.session_state.get(preview_key)
-            
-            # If not loaded, check if it exists in cache (temp) or download it automatically
+            # ค้นไฟล์ตัวอย่างจากแคชแบบ pin ทุกครั้งที่แสดงผล (แทนการจำ path ไว้ใน Session) ไฟล์จึงไม่ถูกลบ (LRU) ระหว่างที่ st.video อ่านอยู่
+            local_preview_path = MEDIA_CACHE.lookup('preview', preview_url, pin=True)
             if not local_preview_path:
-                temp_dir = tempfile.gettempdir()
-                cached_path = os.path.join(temp_dir, f"preview_{url_hash}.mp4")
-                if os.path.exists(cached_path):
-                    local_preview_path = cached_path
-                    st.session_state[preview_key] = local_preview_path
-                else:
-                    # ดาวน์โหลดในเบื้องหลังโดยอัตโนมัติ (จะแสดง Spinner ของ Streamlit)
-                    with st.status(f"📥 กำลังโหลดตัวอย่าง {platform_label} เพื่อรองรับการเลื่อนเวลา...", expanded=False):
-                        st.write("กำลังดึงข้อมูลวิดีโอ...")
-                        local_preview_path = download_video_preview(preview_url)
-                        if local_preview_path:
-                            st.session_state[preview_key] = local_preview_path
-                            # No st.rerun() here - let it continue to the next block while in the same script run
-
-            if local_preview_path and os.path.exists(local_preview_path):
-                # ใช้ตัวเล่นวิดีโอมาตรฐานกับไฟล์ในเครื่องเพื่อให้เลื่อนเวลาได้แม่นยำ (Seeking works perfectly!)
-                preview_container = st.empty()
-                with preview_container:
-                    mod_toggle = st.session_state.get('seek_toggle', 0) % 3
+                # ดาวน์โหลดในเบื้องหลังโดยอัตโนมัติ (จะแสดง Spinner ของ Streamlit) ไฟล์ที่คืนค่าถูก pin แล้ว
+                with st.status(f"📥 กำลังโหลดตัวอย่าง {platform_label} เพื่อรองรับการเลื่อนเวลา...", expanded=False):
+                    st.write("กำลังดึงข้อมูลวิดีโอ...")
+                    local_preview_path = download_video_preview(preview_url)
+
+            with MEDIA_CACHE.pin(local_preview_path, already_pinned=True):
+                preview_ready = bool(local_preview_path) and os.path.exists(local_preview_path)
+                if preview_ready:
+                    # ใช้ตัวเล่นวิดีโอมาตรฐานกับไฟล์ในเครื่องเพื่อให้เลื่อนเวลาได้แม่นยำ (Seeking works perfectly!)
+                    preview_container = st.empty()
+                    with preview_container:
+                        mod_toggle = st.session_state.get('seek_toggle', 0) % 3
                     
-                    if mod_toggle == 0:
-                        st.video(local_preview_path, start_time=p_start, autoplay=st.session_state.should_autoplay)
-                    elif mod_toggle == 1:
-                        with st.container():
-                            st.video(local_preview_path, start_time=p_start, autoplay=st.session_state.should_autoplay)
-                    else:
-                        col_p = st.columns([1])[0]
-                        with col_p:
+                        if mod_toggle == 0:
                             st.video(local_preview_path, start_time=p_start, autoplay=st.session_state.should_autoplay)
+                        elif mod_toggle == 1:
+                            with st.container():
+                                st.video(local_preview_path, start_time=p_start, autoplay=st.session_state.should_autoplay)
+                        else:
+                            col_p = st.columns([1])[0]
+                            with col_p:
+                                st.video(local_preview_path, start_time=p_start, autoplay=st.session_state.should_autoplay)
                 
-                if p_start > 0:
-                    st.caption(f"⏩ กำลังเลื่อนไปยัง {format_time(p_start)}")
-            else:
+                    if p_start > 0:
+                        st.caption(f"⏩ กำลังเลื่อนไปยัง {format_time(p_start)}")
+            if not preview_ready:
                 # ทางเลือกสุดท้าย: ใช้การฝังวิดีโอ (Embed) หากดาวน์โหลดล้มเหลว (สำหรับ TikTok)
                 if is_tiktok:
                     import re
@@ -525,6 +622,11 @@ def video_fragment(target_url, idx, is_uploaded=False, uploaded_name=None):
     # ส่วนแสดงผลลัพธ์ (Results Container)
     if result_key not in st.session_state.results_by_url:
         st.info(f"⏳ กำลังรอประมวลผล: {uploaded_name if is_uploaded else target_url[:50]+'...'}")
+        # แสดงบทบรรยายบางส่วนที่ได้รับมาแล้ว (ถ้ามี)
+        live_lines = st.session_state.live_transcripts.get(result_key)
+        partial = st.session_state.partial_results.get(result_key)
+        if live_lines or partial:
+            render_live_transcript(st.empty(), uploaded_name if is_uploaded else target_url, live_lines or [], partial=partial)
         return
 
     res = st.session_state.results_by_url[result_key]
@@ -569,7 +671,7 @@ def video_fragment(target_url, idx, is_uploaded=False, uploaded_name=None):
         
         # แสดงแหล่งที่มาของการถอดเสียงเพื่อความโปร่งใส
         source = res.get('transcription_source', 'Unknown')
-        st.caption(f"🔍 แหล่งข้อมูลการถอดเสียง: **{source}**")
+        st.caption(f"🔍 แหล่งข้อมูลการถอดเสียง: **{source}**" + (" (จากประวัติ)" if res.get('from_history') else ""))
 
     # Summary (Always visible at the top)
     with st.container(border=True):
@@ -733,7 +835,7 @@ if uploaded_file or urls_to_show or st.session_state.results_by_url:
     
     # แสดงรายการที่กำลังประมวลผลอยู่ (หากมี)
     if uploaded_file:
-        uploaded_temp_path = os.path.join(tempfile.gettempdir(), f"upload_{uploaded_file.name}")
+        uploaded_temp_path = get_uploaded_media_path(uploaded_file)
         st.markdown("### 📁 ไฟล์วิดีโอ (File)")
         video_fragment(uploaded_temp_path, 0, is_uploaded=True, uploaded_name=uploaded_file.name)
         st.divider()
@@ -0,0 +1,505 @@
+import sqlite3
+import hashlib
+import threading
+import time
+import os
+import json
+import shutil
+from contextlib import contextmanager
+
+
+# แคชค่า SHA-256 ของไฟล์ในหน่วยความจำ (คีย์: path, ขนาด, เวลาแก้ไข) เพื่อไม่ต้องอ่านไฟล์เสียงขนาดใหญ่ซ้ำ
+_file_hash_memo = {}
+_file_hash_lock = threading.Lock()
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """
+    คำนวณ SHA-256 ของไฟล์แบบอ่านทีละส่วน (Chunk) เพื่อไม่ให้กินหน่วยความจำ
+    ผลลัพธ์จะถูกจำไว้ตราบใดที่ขนาดและเวลาแก้ไขของไฟล์ยังเหมือนเดิม
+    """
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _file_hash_lock:
+        if memo_key in _file_hash_memo:
+            return _file_hash_memo[memo_key]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    result = digest.hexdigest()
+
+    with _file_hash_lock:
+        _file_hash_memo[memo_key] = result
+    return result
+
+
+class ResultCache:
+    """
+    แคชผลลัพธ์ของ Gemini แบบถาวรบนดิสก์ (SQLite)
+    - คีย์คือ Hash ของ (prompt, SHA-256 ของไฟล์เสียง, ชื่อโมเดล, max_output_tokens)
+    - จำกัดขนาดรวมด้วยการลบรายการที่ไม่ได้ใช้นานที่สุด (LRU Eviction)
+    - รายการที่เก่ากว่า TTL จะถือว่าหมดอายุ
+    """
+
+    def __init__(self, db_file="gemini_cache.db", max_bytes=200 * 1024 * 1024, ttl_seconds=7 * 24 * 3600):
+        self.db_file = db_file
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self.init_db()
+
+    def init_db(self):
+        """สร้างตาราง Cache หากยังไม่มีในระบบ"""
+        try:
+            with sqlite3.connect(self.db_file) as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS cache (
+                        key TEXT PRIMARY KEY,
+                        value TEXT,
+                        size INTEGER,
+                        created_at REAL,
+                        last_access REAL
+                    )
+                """)
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_cache_last_access ON cache (last_access)")
+                conn.commit()
+
+                # การปรับเปลี่ยนฐานข้อมูล: เพิ่มคอลัมน์ meta (เช่น finish_reason) หากยังไม่มี (สำหรับฐานข้อมูลเก่า)
+                try:
+                    cursor.execute("ALTER TABLE cache ADD COLUMN meta TEXT")
+                    conn.commit()
+                except sqlite3.OperationalError:
+                    # คอลัมน์น่าจะมีอยู่แล้ว
+                    pass
+        except Exception as e:
+            print(f"Cache initialization error: {e}")
+
+    @staticmethod
+    def make_key(prompt, audio_hash=None, model_name="", max_output_tokens=0):
+        """สร้างคีย์แคชจากข้อมูลทั้งหมดที่มีผลต่อผลลัพธ์ของโมเดล"""
+        digest = hashlib.sha256()
+        for part in (prompt, audio_hash or "", model_name, str(max_output_tokens)):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\x00")  # ตัวคั่นเพื่อป้องกันการชนกันของคีย์
+        return digest.hexdigest()
+
+    def get(self, key, with_meta=False):
+        """
+        ดึงค่าจากแคช คืนค่า None หากไม่พบหรือหมดอายุแล้ว
+        with_meta=True จะคืนค่าเป็น (value, meta) โดย meta เป็น dict ที่บันทึกไว้พร้อมค่า
+        """
+        miss = (None, {}) if with_meta else None
+        now = time.time()
+        try:
+            with sqlite3.connect(self.db_file) as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT value, created_at, meta FROM cache WHERE key = ?", (key,))
+                row = cursor.fetchone()
+                if not row:
+                    return miss
+
+                value, created_at, meta = row
+                if self.ttl_seconds and now - created_at > self.ttl_seconds:
+                    # หมดอายุแล้ว ลบทิ้ง
+                    cursor.execute("DELETE FROM cache WHERE key = ?", (key,))
+                    conn.commit()
+                    return miss
+
+                # อัปเดตเวลาใช้งานล่าสุดสำหรับ LRU
+                cursor.execute("UPDATE cache SET last_access = ? WHERE key = ?", (now, key))
+                conn.commit()
+                if with_meta:
+                    return value, json.loads(meta) if meta else {}
+                return value
+        except Exception as e:
+            print(f"Error reading cache: {e}")
+            return miss
+
+    def set(self, key, value, meta=None):
+        """บันทึกค่าลงแคช (พร้อมข้อมูลประกอบ meta ถ้ามี) และลบรายการเก่าออกหากขนาดรวมเกินขีดจำกัด"""
+        if value is None:
+            return False
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        if self.max_bytes and size > self.max_bytes:
+            return False
+
+        try:
+            with self._lock:
+                with sqlite3.connect(self.db_file) as conn:
+                    cursor = conn.cursor()
+                    cursor.execute("""
+                        INSERT OR REPLACE INTO cache (key, value, size, created_at, last_access, meta)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    """, (key, value, size, now, now, json.dumps(meta) if meta else None))
+                    conn.commit()
+                    self._evict(cursor)
+                    conn.commit()
+            return True
+        except Exception as e:
+            print(f"Error writing cache: {e}")
+            return False
+
+    def _evict(self, cursor):
+        """ลบรายการที่หมดอายุ และรายการที่ใช้งานล่าสุดนานที่สุดจนกว่าขนาดรวมจะไม่เกินโควตา"""
+        if self.ttl_seconds:
+            cursor.execute("DELETE FROM cache WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+
+        if not self.max_bytes:
+            return
+        cursor.execute("SELECT COALESCE(SUM(size), 0) FROM cache")
+        total = cursor.fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        cursor.execute("SELECT key, size FROM cache ORDER BY last_access ASC")
+        to_delete = []
+        for key, size in cursor.fetchall():
+            if total <= self.max_bytes:
+                break
+            to_delete.append((key,))
+            total -= size
+        cursor.executemany("DELETE FROM cache WHERE key = ?", to_delete)
+
+    def clear(self):
+        """ลบข้อมูลแคชทั้งหมด"""
+        try:
+            with sqlite3.connect(self.db_file) as conn:
+                conn.execute("DELETE FROM cache")
+                conn.commit()
+            return True
+        except Exception:
+            return False
+
+
+class StageCache:
+    """
+    แคชผลลัพธ์รายขั้นตอน (Stage) ของการประมวลผลวิดีโอ เช่น Metadata, คำบรรยาย, ผลถอดเสียง
+    - คีย์สร้างจากชื่อขั้นตอน + เวอร์ชันของขั้นตอน (stage_versions) + ข้อมูลนำเข้าทั้งหมดที่มีผลต่อผลลัพธ์
+      เมื่อแก้ Prompt ของขั้นตอนใด ให้เพิ่มเวอร์ชันของขั้นตอนนั้น แคชเดิมจะไม่ถูกใช้อีก
+    - ค่าที่เก็บต้องแปลงเป็น JSON ได้
+    - max_ages กำหนดอายุสูงสุดรายขั้นตอน (วินาที) เช่น Metadata ควรหมดอายุเร็วกว่าผลถอดเสียง
+    """
+
+    def __init__(self, store, stage_versions=None, max_ages=None):
+        self.store = store
+        self.stage_versions = stage_versions or {}
+        self.max_ages = max_ages or {}
+
+    def make_key(self, stage, **inputs):
+        """สร้างคีย์จากชื่อขั้นตอน เวอร์ชัน และข้อมูลนำเข้า (เรียงคีย์ก่อน เพื่อให้ลำดับอาร์กิวเมนต์ไม่มีผล)"""
+        payload = json.dumps(inputs, sort_keys=True, ensure_ascii=False, default=str)
+        return ResultCache.make_key(payload, model_name=f"stage:{stage}", max_output_tokens=self.stage_versions.get(stage, 1))
+
+    def get(self, stage, **inputs):
+        """ดึงผลลัพธ์ของขั้นตอน คืนค่า None หากไม่พบ หมดอายุ หรืออ่านไม่ได้"""
+        value, meta = self.store.get(self.make_key(stage, **inputs), with_meta=True)
+        if value is None:
+            return None
+        max_age = self.max_ages.get(stage)
+        if max_age and time.time() - meta.get('stored_at', 0) > max_age:
+            return None
+        try:
+            return json.loads(value)
+        except ValueError:
+            return None
+
+    def set(self, stage, value, **inputs):
+        """บันทึกผลลัพธ์ของขั้นตอน (ข้ามค่า None)"""
+        if value is None:
+            return False
+        return self.store.set(self.make_key(stage, **inputs), json.dumps(value, ensure_ascii=False), meta={'stage': stage, 'stored_at': time.time()})
+
+    def cached(self, stage, compute, **inputs):
+        """คืนค่าจากแคชถ้ามี มิฉะนั้นเรียก compute() แล้วบันทึกผลลัพธ์ (ค่า None ไม่ถูกบันทึก)"""
+        value = self.get(stage, **inputs)
+        if value is not None:
+            print(f"   ♻️ [Stage Cache] ใช้ผลลัพธ์เดิมของขั้นตอน {stage}")
+            return value
+        value = compute()
+        self.set(stage, value, **inputs)
+        return value
+
+
+class MediaCache:
+    """
+    แคชไฟล์สื่อ (เสียงที่ดาวน์โหลด, วิดีโอตัวอย่าง, ไฟล์อัปโหลด) ในโฟลเดอร์เดียวที่จำกัดขนาดได้
+    - คีย์คือ ID วิดีโอแบบมาตรฐานหรือ SHA-256 ของเนื้อหา แยกตามประเภท (kind)
+    - ดัชนี (SQLite) เก็บขนาดและเวลาใช้งานล่าสุด เมื่อเกินโควตาจะลบไฟล์ที่ไม่ได้ใช้นานที่สุด (LRU)
+    - ไฟล์เข้าแคชผ่าน adopt() หลังเขียนเสร็จแล้วเท่านั้น ผู้อ่านจึงไม่เห็นไฟล์ที่ดาวน์โหลดไม่ครบ
+    - ไฟล์ที่กำลังใช้งาน (pin) จะไม่ถูกลบ: lookup/adopt/store_bytes ที่ส่ง pin=True จะ pin ภายใต้ล็อกเดียวกับการอ่านดัชนี
+      ผู้เรียกต้องคืนด้วย unpin() หรือ with pin(path, already_pinned=True)
+    """
+
+    def __init__(self, root_dir, max_bytes=2 * 1024 * 1024 * 1024):
+        self.root_dir = root_dir
+        self.max_bytes = max_bytes
+        self.db_file = os.path.join(root_dir, "index.db")
+        self._lock = threading.Lock()
+        self._pins = {}
+        self._stale = {}  # โฟลเดอร์ที่ถูก pin -> [(path, inode)] ไฟล์เก่าที่รอลบเมื่อคืน pin ครั้งสุดท้าย
+        self.init_db()
+
+    def init_db(self):
+        """สร้างโฟลเดอร์และตารางดัชนีหากยังไม่มี"""
+        try:
+            os.makedirs(self.root_dir, exist_ok=True)
+            with sqlite3.connect(self.db_file) as conn:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS media (
+                        kind TEXT,
+                        key TEXT,
+                        path TEXT,
+                        size INTEGER,
+                        created_at REAL,
+                        last_access REAL,
+                        PRIMARY KEY (kind, key)
+                    )
+                """)
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_media_last_access ON media (last_access)")
+                conn.commit()
+
+                # การปรับเปลี่ยนฐานข้อมูล: ขนาดของสำเนาชื่ออื่น (store_bytes เมื่อสร้าง Hard Link ไม่ได้) หากยังไม่มี
+                try:
+                    conn.execute("ALTER TABLE media ADD COLUMN alias_bytes INTEGER DEFAULT 0")
+                    conn.commit()
+                except sqlite3.OperationalError:
+                    # คอลัมน์น่าจะมีอยู่แล้ว
+                    pass
+        except Exception as e:
+            print(f"Media cache initialization error: {e}")
+
+    def _entry_dir(self, kind, key):
+        """โฟลเดอร์ของแต่ละรายการ (ชื่อจาก Hash ของคีย์) เพื่อให้ไฟล์ข้างในคงชื่อเดิมไว้ได้ เช่น ชื่อไฟล์ที่ผู้ใช้อัปโหลด"""
+        return os.path.join(self.root_dir, kind, hashlib.sha256(key.encode("utf-8")).hexdigest()[:32])
+
+    def _pin_key(self, path):
+        """ไฟล์ในแคชถูก pin ทั้งโฟลเดอร์ของรายการ (รวมชื่อไฟล์อื่นของเนื้อหาเดียวกัน) ไฟล์นอกแคชใช้ path ตรงๆ"""
+        root = os.path.abspath(self.root_dir) + os.sep
+        absolute = os.path.abspath(path)
+        return os.path.dirname(absolute) if absolute.startswith(root) else absolute
+
+    def _pin_locked(self, path):
+        pin_key = self._pin_key(path)
+        self._pins[pin_key] = self._pins.get(pin_key, 0) + 1
+
+    def _is_pinned(self, path):
+        return self._pin_key(path) in self._pins
+
+    def lookup(self, kind, key, pin=False):
+        """
+        คืนค่า path ของไฟล์ในแคช (พร้อมอัปเดตเวลาใช้งาน) หรือ None หากไม่มีหรือไฟล์ไม่สมบูรณ์
+        pin=True: pin ไฟล์ก่อนคืนค่า ไฟล์จึงไม่ถูกลบระหว่างเวลาที่ได้ path จนถึงเวลาที่ใช้งาน
+        """
+        try:
+            with self._lock, sqlite3.connect(self.db_file) as conn:
+                row = conn.execute("SELECT path, size FROM media WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+                if not row:
+                    return None
+                path, size = row
+                if not os.path.isfile(path) or os.path.getsize(path) != size:
+                    # ไฟล์ถูกลบหรือเปลี่ยนจากภายนอก: ลบออกจากดัชนีพร้อมชื่อไฟล์อื่นของรายการนี้
+                    conn.execute("DELETE FROM media WHERE kind = ? AND key = ?", (kind, key))
+                    conn.commit()
+                    self._retire_locked(os.path.dirname(path))
+                    return None
+                conn.execute("UPDATE media SET last_access = ? WHERE kind = ? AND key = ?", (time.time(), kind, key))
+                conn.commit()
+                if pin:
+                    self._pin_locked(path)
+                return path
+        except Exception as e:
+            print(f"Error reading media cache: {e}")
+            return None
+
+    def adopt(self, kind, key, source_path, file_name=None, pin=False):
+        """
+        ย้ายไฟล์ที่เขียนเสร็จแล้วเข้าแคช (แทนที่รายการเดิมของคีย์นี้) แล้วลบไฟล์เก่าหากเกินโควตา
+        คืนค่า path ใหม่ในแคช (หากย้ายไม่สำเร็จจะคืนค่า source_path เดิม)
+        pin=True: pin ไฟล์ที่คืนค่าก่อนการลบไฟล์เก่า (แม้ย้ายไม่สำเร็จก็ยัง pin path ที่คืนค่า)
+        """
+        entry_dir = self._entry_dir(kind, key)
+        target = os.path.join(entry_dir, file_name or os.path.basename(source_path))
+        pinned = False
+        try:
+            os.makedirs(entry_dir, exist_ok=True)
+            if os.path.abspath(source_path) != os.path.abspath(target):
+                # คัดลอกไปชื่อชั่วคราวในโฟลเดอร์ปลายทางก่อน แล้ว os.replace (Atomic) เผื่ออยู่คนละ Filesystem
+                staging = f"{target}.partial"
+                shutil.move(source_path, staging)
+                os.replace(staging, target)
+            now = time.time()
+            with self._lock, sqlite3.connect(self.db_file) as conn:
+                row = conn.execute("SELECT path FROM media WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+                if row:
+                    # เนื้อหาเดิมของคีย์นี้ (รวมชื่อไฟล์อื่นที่ store_bytes สร้างไว้) ถูกแทนที่แล้ว
+                    self._retire_locked(entry_dir, keep=target)
+                if pin:
+                    self._pin_locked(target)
+                    pinned = True
+                conn.execute("""
+                    INSERT OR REPLACE INTO media (kind, key, path, size, created_at, last_access)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (kind, key, target, os.path.getsize(target), now, now))
+                conn.commit()
+                self._evict(conn, keep=target)
+                conn.commit()
+            return target
+        except Exception as e:
+            print(f"Error writing media cache: {e}")
+            result = target if os.path.exists(target) else source_path
+            if pin and not (pinned and result == target):
+                with self._lock:
+                    self._pin_locked(result)
+                if pinned:
+                    self.unpin(target)
+            return result
+
+    def store_bytes(self, kind, data, file_name, key=None, pin=False):
+        """
+        บันทึกข้อมูล (เช่น ไฟล์ที่ผู้ใช้อัปโหลด) โดยใช้ SHA-256 ของเนื้อหาเป็นคีย์ เนื้อหาเดิมจะใช้ไฟล์เดิมซ้ำ
+        ชื่อไฟล์ที่คืนค่าเป็นชื่อของผู้เรียกเสมอ: เนื้อหาเดิมที่มาในชื่อใหม่จะได้ Hard Link (หรือสำเนา) ชื่อนั้นในโฟลเดอร์เดียวกัน
+        """
+        key = key or hashlib.sha256(data).hexdigest()
+        existing = self.lookup(kind, key, pin=pin)
+        if existing:
+            if os.path.basename(existing) == file_name:
+                return existing
+            alias = os.path.join(os.path.dirname(existing), file_name)
+            try:
+                if not os.path.exists(alias) or not os.path.samefile(alias, existing):
+                    # สร้างชื่อใหม่ในชื่อชั่วคราวก่อนแล้ว os.replace ทับไฟล์เก่าที่อาจค้างจากเนื้อหาก่อนหน้า
+                    added = 0 if os.path.exists(alias) else len(data)
+                    staging = f"{alias}.partial"
+                    try:
+                        os.link(existing, staging)
+                        added = 0
+                    except OSError:
+                        shutil.copyfile(existing, staging)
+                    os.replace(staging, alias)
+                    if added:
+                        # สำเนา (ไม่ใช่ Hard Link) ใช้พื้นที่จริง จึงนับรวมในโควตาของรายการนี้
+                        with self._lock, sqlite3.connect(self.db_file) as conn:
+                            conn.execute("UPDATE media SET alias_bytes = COALESCE(alias_bytes, 0) + ? WHERE kind = ? AND key = ?", (added, kind, key))
+                            conn.commit()
+                return alias
+            except OSError as e:
+                print(f"Error writing media cache alias: {e}")
+                return existing
+        entry_dir = self._entry_dir(kind, key)
+        os.makedirs(entry_dir, exist_ok=True)
+        staging = os.path.join(entry_dir, f"{file_name}.partial")
+        with open(staging, "wb") as f:
+            f.write(data)
+        return self.adopt(kind, key, staging, file_name=file_name, pin=pin)
+
+    def unpin(self, path):
+        """คืน pin หนึ่งครั้ง (ที่ได้จาก pin=True หรือ pin()) path ที่ไม่ได้ถูก pin จะถูกข้าม"""
+        if not path:
+            return
+        with self._lock:
+            pin_key = self._pin_key(path)
+            if pin_key in self._pins:
+                self._pins[pin_key] -= 1
+                if not self._pins[pin_key]:
+                    del self._pins[pin_key]
+                    self._remove_stale_locked(pin_key)
+
+    @contextmanager
+    def pin(self, path, already_pinned=False):
+        """
+        ใช้กับ with: ป้องกันไม่ให้ไฟล์ถูกลบระหว่างใช้งาน (path เป็น None ได้)
+        already_pinned=True: path ได้มาจาก lookup/adopt/store_bytes ที่ pin=True แล้ว จะไม่ pin ซ้ำแต่คืน pin นั้นเมื่อออกจาก with
+        """
+        if not path:
+            yield path
+            return
+        if not already_pinned:
+            with self._lock:
+                self._pin_locked(path)
+        try:
+            yield path
+        finally:
+            self.unpin(path)
+
+    def _retire_locked(self, entry_dir, keep=None):
+        """
+        ลบไฟล์ทั้งหมดในโฟลเดอร์ของรายการ (ยกเว้น keep และไฟล์ .partial ที่กำลังเขียน) ต้องถือ self._lock อยู่
+        หากโฟลเดอร์ยังถูก pin จะจำไฟล์ไว้แล้วลบเมื่อคืน pin ครั้งสุดท้าย แทนการปล่อยไฟล์ค้างนอกดัชนี
+        """
+        pin_key = os.path.abspath(entry_dir)
+        try:
+            names = os.listdir(entry_dir)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(pin_key, name)
+            if name.endswith(".partial") or (keep and path == os.path.abspath(keep)):
+                continue
+            try:
+                inode = os.stat(path).st_ino
+            except OSError:
+                continue
+            self._stale.setdefault(pin_key, []).append((path, inode))
+        if pin_key not in self._pins:
+            self._remove_stale_locked(pin_key)
+
+    def _remove_stale_locked(self, pin_key):
+        """ลบไฟล์เก่าที่รอไว้ของโฟลเดอร์นี้ (ข้ามไฟล์ที่ถูกแทนที่ด้วยไฟล์ใหม่ชื่อเดิมแล้ว) ต้องถือ self._lock อยู่"""
+        for path, inode in self._stale.pop(pin_key, []):
+            try:
+                if os.stat(path).st_ino == inode:
+                    os.remove(path)
+            except OSError:
+                pass
+        try:
+            os.rmdir(pin_key)
+        except OSError:
+            pass
+
+    def _remove_entry(self, path):
+        """ลบทั้งโฟลเดอร์ของรายการ (รวมชื่อไฟล์อื่นของเนื้อหาเดียวกันที่ store_bytes สร้างไว้)"""
+        entry_dir = os.path.dirname(os.path.abspath(path))
+        if entry_dir.startswith(os.path.abspath(self.root_dir) + os.sep):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        else:
+            self._remove_file(path)
+
+    def _remove_file(self, path):
+        """ลบไฟล์และโฟลเดอร์ของรายการ (ถ้าว่างแล้ว)"""
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        try:
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+
+    def _evict(self, conn, keep=None):
+        """ลบรายการที่ใช้งานล่าสุดนานที่สุด (ยกเว้นไฟล์ที่ถูก pin และไฟล์ keep) จนกว่าขนาดรวมจะไม่เกินโควตา"""
+        if not self.max_bytes:
+            return
+        total = conn.execute("SELECT COALESCE(SUM(size + COALESCE(alias_bytes, 0)), 0) FROM media").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for kind, key, path, size in conn.execute("SELECT kind, key, path, size + COALESCE(alias_bytes, 0) FROM media ORDER BY last_access ASC").fetchall():
+            if total <= self.max_bytes:
+                break
+            if path == keep or self._is_pinned(path):
+                continue
+            self._remove_entry(path)
+            conn.execute("DELETE FROM media WHERE kind = ? AND key = ?", (kind, key))
+            total -= size
+
+    def snapshot(self):
+        """คืนค่าจำนวนไฟล์และขนาดรวม (สำหรับหน้าตรวจสอบระบบ)"""
+        try:
+            with sqlite3.connect(self.db_file) as conn:
+                count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size + COALESCE(alias_bytes, 0)), 0) FROM media").fetchone()
+            return {'files': count, 'bytes': total, 'max_bytes': self.max_bytes}
+        except Exception:
+            return {'files': 0, 'bytes': 0, 'max_bytes': self.max_bytes}
@@ -0,0 +1,232 @@
+import threading
+import subprocess
+import time
+import queue
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+
+def is_overload_error(error):
+    """ตรวจว่า Error บ่งบอกว่าปลายทางรับงานไม่ไหว (429 / 403 / Timeout) หรือไม่"""
+    if isinstance(error, (TimeoutError, subprocess.TimeoutExpired)):
+        return True
+    text = (str(error) or repr(error)).lower()
+    markers = ("429", "403", "too many requests", "forbidden", "resource exhausted", "rate limit", "not a bot", "timed out", "timeout")
+    return any(marker in text for marker in markers)
+
+
+class _Permit:
+    """สิทธิ์ทำงาน 1 ช่องของ AdaptiveLimiter ผู้ใช้แจ้งผลลัพธ์ผ่าน overloaded() หรือ neutral()"""
+
+    def __init__(self):
+        self.outcome = 'success'
+
+    def overloaded(self):
+        """ปลายทางตอบ 429/403/Timeout: ให้ลดจำนวนงานพร้อมกันลง"""
+        self.outcome = 'overload'
+
+    def neutral(self):
+        """ผลลัพธ์ไม่เกี่ยวกับความจุของปลายทาง (เช่น วิดีโอถูกลบ): ไม่ปรับขีดจำกัด"""
+        self.outcome = 'neutral'
+
+
+class AdaptiveLimiter:
+    """
+    ตัวจำกัดจำนวนงานพร้อมกันแบบปรับตัวเอง (AIMD: Additive Increase / Multiplicative Decrease)
+    - ทุกครั้งที่งานสำเร็จขณะที่ช่องเต็ม จะเพิ่มขีดจำกัดทีละน้อย (ประมาณ +1 ต่อหนึ่งรอบของงานเต็มช่อง)
+    - เมื่อพบ 429/403/Timeout จะลดขีดจำกัดลงแบบทวีคูณ (ไม่เกินหนึ่งครั้งต่อ backoff_cooldown วินาที)
+    ทำให้จำนวนงานพร้อมกันวิ่งตามความจุจริงของ Key Pool / IP แทนการเดาค่าคงที่
+    """
+
+    def __init__(self, name, initial_limit=4, min_limit=1, max_limit=16, backoff_factor=0.5, backoff_cooldown=2.0):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_factor = backoff_factor
+        self.backoff_cooldown = backoff_cooldown
+        self._limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self._in_flight = 0
+        self._last_backoff = 0.0
+        self._cond = threading.Condition()
+
+    @property
+    def limit(self):
+        """ขีดจำกัดปัจจุบัน (จำนวนเต็ม)"""
+        with self._cond:
+            return int(self._limit)
+
+    def acquire(self, timeout=None):
+        """รอจนกว่าจะมีช่องว่าง คืนค่า False หากเกิน timeout"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._in_flight >= int(self._limit):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(timeout=remaining)
+            self._in_flight += 1
+            return True
+
+    def release(self, outcome='success'):
+        """คืนช่องพร้อมผลลัพธ์ ('success', 'overload' หรือ 'neutral') เพื่อปรับขีดจำกัด"""
+        with self._cond:
+            saturated = self._in_flight >= int(self._limit)
+            self._in_flight = max(0, self._in_flight - 1)
+            now = time.time()
+            if outcome == 'overload':
+                if now - self._last_backoff >= self.backoff_cooldown:
+                    old_limit = int(self._limit)
+                    self._limit = max(float(self.min_limit), self._limit * self.backoff_factor)
+                    self._last_backoff = now
+                    print(f"   📉 [{self.name}] ลดงานพร้อมกัน {old_limit} -> {int(self._limit)} (429/403/Timeout)")
+            elif outcome == 'success' and saturated:
+                # เพิ่มเฉพาะเมื่อใช้ช่องเต็มจริง (ถ้าไม่เต็ม แสดงว่าความต้องการน้อยกว่าขีดจำกัดอยู่แล้ว)
+                self._limit = min(float(self.max_limit), self._limit + 1.0 / self._limit)
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self):
+        """
+        ใช้กับ with: รอช่องว่าง -> ทำงาน -> คืนช่อง
+        Exception ที่บ่งบอกการโอเวอร์โหลดจะถูกนับเป็น overload อัตโนมัติ (และโยนต่อตามปกติ)
+        """
+        permit = _Permit()
+        self.acquire()
+        try:
+            yield permit
+        except Exception as e:
+            permit.outcome = 'overload' if is_overload_error(e) else 'neutral'
+            raise
+        finally:
+            self.release(permit.outcome)
+
+    def snapshot(self):
+        """คืนค่าสถานะปัจจุบัน (สำหรับหน้าตรวจสอบระบบ)"""
+        with self._cond:
+            return {'name': self.name, 'limit': int(self._limit), 'in_flight': self._in_flight, 'max_limit': self.max_limit}
+
+
+class SingleFlight:
+    """
+    รวมงานที่เหมือนกันซึ่งกำลังทำอยู่ให้ทำเพียงครั้งเดียว (Single-flight)
+    ผู้เรียกคนแรกของแต่ละคีย์เป็นผู้ทำงานจริง ผู้เรียกที่ตามมาขณะงานยังไม่เสร็จจะรอรับผลลัพธ์ (หรือ Exception) เดียวกัน
+    เมื่องานเสร็จคีย์จะถูกลบทันที ผู้เรียกครั้งถัดไปจึงเริ่มงานใหม่เสมอ (ไม่ใช่แคช)
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        """เรียก fn() ครั้งเดียวต่อคีย์ที่กำลังทำอยู่ คืนค่า (ผลลัพธ์, shared) โดย shared=True หมายถึงได้ผลจากงานของผู้เรียกอื่น"""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+
+        if not leader:
+            print(f"   🔗 [{self.name}] งานเดียวกันกำลังทำอยู่ รอรับผลลัพธ์: {key}")
+            return future.result(), True
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def in_flight(self):
+        """คืนค่ารายการคีย์ที่กำลังทำอยู่ (สำหรับหน้าตรวจสอบระบบ)"""
+        with self._lock:
+            return list(self._calls)
+
+
+def race_strategies(strategies, run, fanout=3, hedge_delay=0.0):
+    """
+    แข่งหลายกลยุทธ์ (เรียงตามลำดับความสำคัญ) ที่ทำงานเดียวกัน คืนค่า (ผลลัพธ์แรกที่สำเร็จ, [(index, error), ...] ของกลยุทธ์ที่ล้มเหลว)
+    run(index, strategy, cancel_event, mark_started) คืนค่าผลลัพธ์เมื่อสำเร็จ หรือโยน Exception เมื่อล้มเหลว
+    โดยควรหยุดเองเมื่อ cancel_event ถูกตั้ง และเรียก mark_started() เมื่อเริ่มได้รับข้อมูลจริง
+    - รันพร้อมกันไม่เกิน fanout กลยุทธ์ เริ่มห่างกัน hedge_delay วินาที กลยุทธ์ที่ล้มเหลวจะถูกแทนที่ด้วยกลยุทธ์ถัดไปทันที
+    - เมื่อกลยุทธ์หนึ่งเริ่มได้รับข้อมูล กลยุทธ์อื่นจะถูกยกเลิก (และกลับเข้าคิวหากกลยุทธ์นั้นล้มเหลวภายหลัง) เพื่อไม่ให้ดาวน์โหลดซ้ำซ้อน
+    - ไม่รอให้กลยุทธ์ที่ถูกยกเลิกหยุดเสร็จ (แต่ละกลยุทธ์ต้องเก็บกวาดไฟล์ของตัวเอง)
+    """
+    fanout = max(1, int(fanout))
+    pending = list(enumerate(strategies))
+    parked = []  # กลยุทธ์ที่ถูกยกเลิกเพราะมีผู้นำ รอกลับเข้าคิวหากผู้นำล้มเหลว
+    results = queue.Queue()
+    active = {}  # index -> (strategy, cancel_event)
+    errors = []
+    lock = threading.Lock()
+    state = {'leader': None, 'last_launch': 0.0}
+
+    def launch():
+        index, strategy = pending.pop(0)
+        cancel_event = threading.Event()
+        with lock:
+            active[index] = (strategy, cancel_event)
+            state['last_launch'] = time.time()
+
+        def mark_started():
+            with lock:
+                if state['leader'] is not None:
+                    return
+                state['leader'] = index
+                for other, (_, other_cancel) in active.items():
+                    if other != index:
+                        other_cancel.set()
+
+        def worker():
+            try:
+                results.put((index, run(index, strategy, cancel_event, mark_started), None))
+            except BaseException as e:
+                results.put((index, None, e))
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    while pending or active:
+        with lock:
+            can_launch = pending and state['leader'] is None and len(active) < fanout
+            hedge_due = not active or time.time() - state['last_launch'] >= hedge_delay
+        if can_launch and hedge_due:
+            launch()
+            continue
+
+        try:
+            index, value, error = results.get(timeout=0.1)
+        except queue.Empty:
+            continue
+
+        with lock:
+            strategy, cancel_event = active.pop(index)
+            if error is None:
+                for _, other_cancel in active.values():
+                    other_cancel.set()
+                return value, errors
+            lost_lead = state['leader'] == index
+            if lost_lead:
+                state['leader'] = None
+            leader = state['leader']
+
+        if cancel_event.is_set():
+            # ถูกยกเลิกเพราะมีผู้นำ: พักไว้ หรือกลับเข้าคิวทันทีหากผู้นำล้มเหลวไปแล้ว
+            if leader is None:
+                pending = sorted(pending + [(index, strategy)], key=lambda item: item[0])
+            else:
+                parked.append((index, strategy))
+            continue
+        errors.append((index, error))
+        if lost_lead:
+            # ผู้นำล้มเหลวกลางทาง: นำกลยุทธ์ที่ถูกยกเลิกไปกลับเข้าคิวตามลำดับความสำคัญเดิม
+            pending = sorted(parked + pending, key=lambda item: item[0])
+            parked = []
+        with lock:
+            state['last_launch'] = 0.0  # แทนที่กลยุทธ์ที่ล้มเหลวทันที
+
+    return None, errors
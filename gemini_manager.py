@@ -0,0 +1,1023 @@
+import threading
+import atexit
+import time
+import re
+import os
+import json
+import bisect
+
+
+class ClientPool:
+    """
+    คลัง Client ของ Gemini แยกตาม API Key (แทนการเรียก genai.configure แบบ Global)
+    - แต่ละคีย์มีชุด Client ของตัวเอง สร้างครั้งเดียวแล้วนำกลับมาใช้ซ้ำ
+    - เธรดที่ทำงานพร้อมกันจึงไม่แย่งกันเปลี่ยนคีย์ และคำขอทุกครั้งถูกส่งด้วยคีย์ที่ถูกต้อง
+    การแยก Client ต้องใช้ API ภายในของ google-generativeai (อยู่ใน _private_manager และ _bind เท่านั้น)
+    หาก SDK เปลี่ยนไปจนใช้ไม่ได้ จะกลับไปใช้ genai.configure แบบ Global แทนการล้มเหลว
+    (ทางสำรองนี้ยังทำงานได้ แต่คำขอที่ส่งพร้อมกันหลายเธรดอาจถูกส่งด้วยคีย์ที่ตั้งล่าสุด)
+    """
+
+    def __init__(self):
+        self._managers = {}  # api_key -> _ClientManager ที่ตั้งค่าด้วยคีย์นั้น
+        self._lock = threading.Lock()
+        self._global_lock = threading.Lock()
+        self.isolated = True  # False เมื่อต้องใช้ genai.configure แบบ Global
+
+    def _private_manager(self, api_key):
+        """
+        จุดเดียวที่สร้าง _ClientManager (API ภายในของ SDK) สำหรับคีย์นี้
+        คืนค่า None หาก SDK ไม่มี API นี้แล้ว (ผู้เรียกจะใช้ genai.configure แทน)
+        """
+        if not self.isolated:
+            return None
+        manager = self._managers.get(api_key)
+        if manager is None:
+            try:
+                from google.generativeai.client import _ClientManager
+                manager = _ClientManager()
+                manager.configure(api_key=api_key)
+            except (ImportError, AttributeError) as e:
+                print(f"   ⚠️ SDK ของ Gemini ไม่รองรับการแยก Client ตามคีย์ ({e}) จะใช้ genai.configure แทน")
+                self.isolated = False
+                return None
+            self._managers[api_key] = manager
+        return manager
+
+    def _bind(self, model, attribute, client):
+        """ผูก Client เข้ากับ GenerativeModel (แอตทริบิวต์ภายใน) คืนค่า False หาก SDK ไม่มีแอตทริบิวต์นี้แล้ว"""
+        if not hasattr(model, attribute):
+            print(f"   ⚠️ GenerativeModel ไม่มี {attribute} แล้ว จะใช้ genai.configure แทน")
+            self.isolated = False
+            return False
+        setattr(model, attribute, client)
+        return True
+
+    def _configure_global(self, api_key):
+        """ทางสำรอง: ตั้งคีย์แบบ Global (ต้องเรียกภายใต้ _global_lock)"""
+        import google.generativeai as genai
+        genai.configure(api_key=api_key)
+        return genai
+
+    def _client(self, api_key, name):
+        """คืนค่า Client ประเภท name (เช่น 'generative', 'file', 'model') ของคีย์นี้ หรือ None หากต้องใช้ทางสำรอง"""
+        with self._lock:
+            manager = self._private_manager(api_key)
+            if manager is None:
+                return None
+            try:
+                return manager.get_default_client(name)
+            except AttributeError as e:
+                print(f"   ⚠️ สร้าง Client ของ Gemini แยกตามคีย์ไม่ได้ ({e}) จะใช้ genai.configure แทน")
+                self.isolated = False
+                return None
+
+    def model(self, api_key, model_name, **kwargs):
+        """สร้าง GenerativeModel ที่ผูกกับ Client ของคีย์นี้โดยเฉพาะ"""
+        import google.generativeai as genai
+        client = self._client(api_key, "generative")
+        if client is not None:
+            model = genai.GenerativeModel(model_name, **kwargs)
+            if self._bind(model, "_client", client):
+                return model
+        with self._global_lock:
+            return self._configure_global(api_key).GenerativeModel(model_name, **kwargs)
+
+    def upload_file(self, api_key, path, mime_type):
+        from google.generativeai.types import file_types
+        client = self._client(api_key, "file")
+        if client is None:
+            with self._global_lock:
+                return self._configure_global(api_key).upload_file(path, mime_type=mime_type, display_name=os.path.basename(path))
+        response = client.create_file(
+            path=path, mime_type=mime_type, display_name=os.path.basename(path)
+        )
+        return file_types.File(response)
+
+    def get_file(self, api_key, file_name):
+        from google.generativeai.types import file_types
+        client = self._client(api_key, "file")
+        if client is None:
+            with self._global_lock:
+                return self._configure_global(api_key).get_file(file_name)
+        return file_types.File(client.get_file(name=file_name))
+
+    def delete_file(self, api_key, file_name):
+        from google.generativeai import protos
+        client = self._client(api_key, "file")
+        if client is None:
+            with self._global_lock:
+                return self._configure_global(api_key).delete_file(file_name)
+        client.delete_file(request=protos.DeleteFileRequest(name=file_name))
+
+    def list_models(self, api_key):
+        """คืนค่าชื่อโมเดลที่คีย์นี้เรียก generateContent ได้ (ไม่มีคำนำหน้า models/)"""
+        client = self._client(api_key, "model")
+        names = set()
+        if client is None:
+            with self._global_lock:
+                models = list(self._configure_global(api_key).list_models(page_size=1000))
+        else:
+            models = client.list_models(page_size=1000)
+        for model in models:
+            if "generateContent" in model.supported_generation_methods:
+                names.add(model.name.split("/", 1)[-1])
+        return names
+
+
+class UploadRegistry:
+    """
+    ทะเบียนไฟล์เสียงที่อัปโหลดไปยัง Gemini แล้ว แยกตาม (API Key, SHA-256 ของไฟล์เสียง)
+    - อัปโหลดไฟล์เดิมเพียงครั้งเดียวต่อคีย์ แล้วนำกลับมาใช้ซ้ำข้ามโมเดลสำรองและการเรียกครั้งถัดไป
+    - เคารพเวลาหมดอายุของไฟล์ฝั่งเซิร์ฟเวอร์ (expiration_time)
+    - มีเธรดเบื้องหลัง (Reaper) คอยลบไฟล์ที่ไม่ได้ใช้งานนานหรือไฟล์ที่ประมวลผลล้มเหลว
+    - นับจำนวนคำขอที่กำลังใช้ไฟล์ (acquire +1 / release -1) ไฟล์ที่ยังถูกใช้อยู่จะไม่ถูกลบ แม้คำขอจะยาวเกิน idle_ttl
+    """
+
+    # Gemini เก็บไฟล์ไว้ประมาณ 48 ชั่วโมง ใช้ค่านี้เมื่อเซิร์ฟเวอร์ไม่ได้ส่งเวลาหมดอายุมา
+    DEFAULT_SERVER_TTL = 47 * 3600
+
+    def __init__(self, clients, idle_ttl_seconds=1800, expiry_margin_seconds=600, reap_interval_seconds=60, processing_timeout=30):
+        self.clients = clients
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.expiry_margin_seconds = expiry_margin_seconds
+        self.reap_interval_seconds = reap_interval_seconds
+        self.processing_timeout = processing_timeout
+
+        # _entries, _orphans และ _refs ถูกอ่าน/เขียนภายใต้ self._lock เท่านั้น (เธรดคำขอและ Reaper ใช้ร่วมกัน)
+        self._entries = {}      # (api_key, audio_hash) -> {'file', 'expires_at', 'last_used'}
+        self._entry_locks = {}  # ล็อกแยกตามคีย์ เพื่อไม่ให้สองเธรดอัปโหลดไฟล์เดียวกันพร้อมกัน
+        self._orphans = []      # [(api_key, file_name)] รอการลบโดย Reaper
+        self._refs = {}         # file_name -> จำนวนคำขอที่กำลังใช้ไฟล์นี้
+        self._lock = threading.Lock()
+        self._reaper = None
+        self._stop_event = threading.Event()
+        atexit.register(self.shutdown)
+
+    # --- การเรียกใช้ Gemini File API ผ่าน Client ของแต่ละคีย์ ---
+    def _upload(self, api_key, audio_path, mime_type):
+        return self.clients.upload_file(api_key, audio_path, mime_type)
+
+    def _get(self, api_key, file_name):
+        return self.clients.get_file(api_key, file_name)
+
+    def _delete(self, api_key, file_name):
+        self.clients.delete_file(api_key, file_name)
+
+    def _entry_lock(self, key):
+        with self._lock:
+            lock = self._entry_locks.get(key)
+            if lock is None:
+                lock = threading.Lock()
+                self._entry_locks[key] = lock
+            return lock
+
+    def _expires_at(self, audio_file):
+        """แปลงเวลาหมดอายุของไฟล์ฝั่งเซิร์ฟเวอร์เป็น Unix timestamp"""
+        expiration = getattr(audio_file, 'expiration_time', None)
+        try:
+            if expiration is not None and hasattr(expiration, 'timestamp'):
+                return expiration.timestamp()
+        except Exception:
+            pass
+        return time.time() + self.DEFAULT_SERVER_TTL
+
+    def _fresh_entry(self, key):
+        """
+        คืนค่าไฟล์ที่จำไว้หากยังไม่ใกล้หมดอายุ พร้อมนับการใช้งาน (+1) ภายใต้ล็อกเดียวกัน
+        Reaper จึงไม่ลบไฟล์ระหว่างที่คำขอเพิ่งได้ไฟล์ไปแต่ยังไม่ได้นับการใช้งาน
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry['expires_at'] - self.expiry_margin_seconds > now:
+                entry['last_used'] = now
+                return self._retain_locked(entry['file'])
+            if entry:
+                # ไฟล์เดิมใกล้หมดอายุ ส่งให้ Reaper ลบแล้วอัปโหลดใหม่
+                self._discard_locked(key)
+        return None
+
+    def _retain_locked(self, audio_file):
+        """นับว่ามีคำขอใช้ไฟล์นี้เพิ่มหนึ่งรายการ (ต้องถือ self._lock อยู่ ผู้เรียก acquire ต้องเรียก release เมื่อคำขอจบ)"""
+        self._refs[audio_file.name] = self._refs.get(audio_file.name, 0) + 1
+        return audio_file
+
+    def release(self, audio_file):
+        """คืนไฟล์หลังคำขอจบ (สำเร็จหรือล้มเหลว) เวลาไม่ได้ใช้งานเริ่มนับจากตอนนี้"""
+        if audio_file is None:
+            return
+        now = time.time()
+        with self._lock:
+            count = self._refs.get(audio_file.name, 0) - 1
+            if count > 0:
+                self._refs[audio_file.name] = count
+            else:
+                self._refs.pop(audio_file.name, None)
+            for entry in self._entries.values():
+                if entry['file'].name == audio_file.name:
+                    entry['last_used'] = now
+
+    def _register(self, key, audio_file, file_status):
+        """บันทึกไฟล์ที่อัปโหลดเสร็จแล้วและนับการใช้งาน (ไฟล์ที่ FAILED จะถูกส่งให้ Reaper ลบและคืนค่า None)"""
+        with self._lock:
+            if file_status.state.name == "FAILED":
+                # ไม่ปล่อยไฟล์ค้างบนเซิร์ฟเวอร์ ส่งให้ Reaper ลบทิ้ง
+                self._orphans.append((key[0], audio_file.name))
+                audio_file = None
+            else:
+                self._discard_locked(key)
+                self._entries[key] = {
+                    'file': audio_file,
+                    'expires_at': self._expires_at(file_status),
+                    'last_used': time.time()
+                }
+                self._retain_locked(audio_file)
+        self._ensure_reaper()
+        return audio_file
+
+    def acquire(self, api_key, audio_path, audio_hash, mime_type):
+        """
+        คืนค่าไฟล์ที่อัปโหลดแล้วสำหรับคีย์นี้ (อัปโหลดใหม่เฉพาะเมื่อยังไม่มีหรือใกล้หมดอายุ)
+        คืนค่า None หากเซิร์ฟเวอร์ประมวลผลไฟล์ล้มเหลว (FAILED)
+        """
+        key = (api_key, audio_hash)
+        with self._entry_lock(key):
+            audio_file = self._fresh_entry(key)
+            if audio_file is not None:
+                return audio_file
+
+            audio_file = self._upload(api_key, audio_path, mime_type)
+
+            # รอการประมวลผลไฟล์ (ใช้เวลารอช่วงสั้นๆ 1 วินาที เพื่อความเร็ว)
+            file_status = self._get(api_key, audio_file.name)
+            waited = 0
+            while file_status.state.name == "PROCESSING" and waited < self.processing_timeout:
+                time.sleep(1); waited += 1
+                file_status = self._get(api_key, audio_file.name)
+
+            return self._register(key, audio_file, file_status)
+
+    def invalidate(self, api_key, audio_hash):
+        """ยกเลิกไฟล์ที่จำไว้ (เช่น เมื่อเซิร์ฟเวอร์แจ้งว่าไม่พบไฟล์แล้ว)"""
+        key = (api_key, audio_hash)
+        with self._entry_lock(key):
+            self._discard(key)
+
+    def _discard(self, key):
+        with self._lock:
+            self._discard_locked(key)
+
+    def _discard_locked(self, key):
+        """เลิกจำไฟล์ของคีย์นี้และส่งให้ Reaper ลบ (ต้องถือ self._lock อยู่)"""
+        entry = self._entries.pop(key, None)
+        if entry and entry['expires_at'] > time.time():
+            self._orphans.append((key[0], entry['file'].name))
+
+    def _ensure_reaper(self):
+        with self._lock:
+            if self._reaper and self._reaper.is_alive():
+                return
+            self._reaper = threading.Thread(target=self._reap_loop, name="gemini-upload-reaper", daemon=True)
+            self._reaper.start()
+
+    def _reap_loop(self):
+        while not self._stop_event.wait(self.reap_interval_seconds):
+            self.reap()
+
+    def reap(self, force=False):
+        """
+        ลบไฟล์ที่ไม่ได้ใช้งานเกิน idle_ttl, ไฟล์หมดอายุ และไฟล์ที่ค้างอยู่ (force=True จะลบทั้งหมด)
+        ไฟล์ที่ยังมีคำขอใช้อยู่ (ยังไม่ release) จะถูกเก็บไว้ก่อน ยกเว้นเมื่อ force=True
+        """
+        now = time.time()
+        with self._lock:
+            keys = list(self._entries.keys())
+        for key in keys:
+            lock = self._entry_lock(key)
+            # หากมีเธรดอื่นกำลังอัปโหลดคีย์นี้อยู่ ให้ข้ามไปก่อนแล้วค่อยลบรอบหน้า
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                with self._lock:
+                    # ตรวจและลบภายใต้ล็อกเดียวกับ acquire/release จึงไม่ลบไฟล์ที่เพิ่งถูกนำไปใช้
+                    entry = self._entries.get(key)
+                    if not entry:
+                        continue
+                    if not force and self._refs.get(entry['file'].name, 0) > 0:
+                        continue
+                    if force or entry['expires_at'] <= now or now - entry['last_used'] > self.idle_ttl_seconds:
+                        self._discard_locked(key)
+            finally:
+                lock.release()
+
+        with self._lock:
+            # ไฟล์ที่ถูกแทนที่แล้วแต่ยังมีคำขอใช้อยู่ ให้รอลบรอบหน้า
+            orphans = [o for o in self._orphans if force or self._refs.get(o[1], 0) <= 0]
+            self._orphans = [o for o in self._orphans if o not in orphans]
+        for api_key, file_name in orphans:
+            try:
+                self._delete(api_key, file_name)
+            except Exception as e:
+                if "404" not in str(e) and "not found" not in str(e).lower():
+                    print(f"   ⚠️ ลบไฟล์ที่อัปโหลดไว้ไม่สำเร็จ ({file_name}): {e}")
+
+    def shutdown(self):
+        """หยุด Reaper และลบไฟล์ทั้งหมดที่อัปโหลดไว้ (เรียกอัตโนมัติเมื่อปิดโปรแกรม)"""
+        self._stop_event.set()
+        with self._lock:
+            if not self._entries and not self._orphans:
+                return
+        try:
+            self.reap(force=True)
+        except Exception:
+            pass
+
+
+class GeminiText(str):
+    """
+    ข้อความผลลัพธ์ของ Gemini ที่พกเหตุผลการจบ (finish_reason) ไปด้วย
+    ใช้งานได้เหมือน str ทุกประการ (เช่น isinstance(result, str) ยังเป็น True)
+    sections: ส่วนต่างๆ ที่แยกไว้แล้ว (จากโหมด JSON) เพื่อไม่ต้องแยกข้อความซ้ำ
+    """
+
+    def __new__(cls, text, finish_reason=None, sections=None):
+        obj = super().__new__(cls, text)
+        obj.finish_reason = finish_reason
+        obj.sections = sections
+        return obj
+
+    @property
+    def is_truncated(self):
+        """โมเดลหยุดเพราะใช้ Token ครบ max_output_tokens"""
+        return self.finish_reason == "MAX_TOKENS"
+
+
+def response_finish_reason(response):
+    """ดึงชื่อเหตุผลการจบ (เช่น STOP, MAX_TOKENS) จาก Response หรือ Chunk คืนค่า None หากไม่มี"""
+    try:
+        candidates = response.candidates
+        if not candidates:
+            return None
+        reason = candidates[0].finish_reason
+    except Exception:
+        return None
+    if not reason:
+        return None
+    return getattr(reason, "name", str(reason))
+
+
+def parse_retry_after(error_text):
+    """
+    ดึงระยะเวลาที่เซิร์ฟเวอร์แนะนำให้รอ (Retry-After) จากข้อความ Error ของ Gemini
+    รองรับรูปแบบ 'Please retry in 27.5s', 'retry_delay { seconds: 27 }' และ 'Retry-After: 30'
+    คืนค่าเป็นวินาที หรือ None หากไม่พบ
+    """
+    if not error_text:
+        return None
+    patterns = [
+        r'retry in\s*([\d\.]+)\s*s',
+        r'retry_delay\s*\{\s*seconds:\s*(\d+)',
+        r'Retry-After:?\s*([\d\.]+)',
+    ]
+    for pattern in patterns:
+        match = re.search(pattern, error_text, re.IGNORECASE)
+        if match:
+            try:
+                return float(match.group(1))
+            except ValueError:
+                continue
+    return None
+
+
+def is_rate_limit_error(error):
+    """ตรวจว่า Error เกิดจากการเรียกเกินโควตา/อัตราที่กำหนด (429 / Resource Exhausted)"""
+    text = str(error)
+    return "429" in text or "resource exhausted" in text.lower() or "quota" in text.lower()
+
+
+def estimate_text_tokens(text):
+    """ประมาณจำนวน Token ของข้อความแบบคร่าวๆ (ภาษาไทยใช้ Token ต่อตัวอักษรมากกว่าภาษาอังกฤษ)"""
+    if not text:
+        return 0
+    return len(text) // 3 + 1
+
+
+_audio_seconds_memo = {}
+
+def probe_audio_seconds(audio_path):
+    """
+    อ่านความยาวไฟล์เสียง (วินาที): WAV อ่านจาก Header ไฟล์บีบอัด (Opus/AAC/MP3) ใช้ ffprobe
+    ผลลัพธ์ถูกจำไว้ตามขนาดและเวลาแก้ไขไฟล์ คืนค่า None หากอ่านไม่ได้
+    """
+    try:
+        stat = os.stat(audio_path)
+    except OSError:
+        return None
+    memo_key = (os.path.abspath(audio_path), stat.st_size, stat.st_mtime_ns)
+    if memo_key in _audio_seconds_memo:
+        return _audio_seconds_memo[memo_key]
+
+    seconds = None
+    try:
+        import wave
+        with wave.open(audio_path, 'rb') as wav:
+            seconds = wav.getnframes() / float(wav.getframerate())
+    except Exception:
+        try:
+            import subprocess
+            output = subprocess.run(
+                ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', audio_path],
+                capture_output=True, text=True, timeout=15
+            ).stdout.strip()
+            seconds = float(output) if output else None
+        except Exception:
+            seconds = None
+    _audio_seconds_memo[memo_key] = seconds
+    return seconds
+
+def estimate_audio_tokens(audio_path):
+    """ประมาณจำนวน Token ของไฟล์เสียง (Gemini คิดประมาณ 32 Token ต่อวินาที ไม่ขึ้นกับบิตเรตของไฟล์)"""
+    if not audio_path:
+        return 0
+    seconds = probe_audio_seconds(audio_path)
+    if seconds is None:
+        # อ่านความยาวไม่ได้: ประมาณจากขนาดไฟล์ที่บิตเรตราว 24 kbps (โปรไฟล์ opus) ซึ่งประเมินสูงไว้ก่อน
+        try:
+            seconds = os.path.getsize(audio_path) / 3000
+        except OSError:
+            return 0
+    return int(seconds * 32)
+
+
+# ขีดจำกัด Token (ขาเข้า, ขาออก) ของแต่ละโมเดลตามเอกสารของ Gemini โมเดลที่ไม่รู้จักใช้ DEFAULT_MODEL_TOKEN_LIMITS
+MODEL_TOKEN_LIMITS = {
+    'gemini-1.5-pro-latest': (2097152, 8192),
+    'gemini-2.0-flash': (1048576, 8192),
+    'gemini-2.0-flash-exp': (1048576, 8192),
+    'gemini-flash-latest': (1048576, 65536),
+    'gemini-1.5-flash-8b-latest': (1048576, 8192),
+}
+DEFAULT_MODEL_TOKEN_LIMITS = (1048576, 8192)
+
+
+class TokenBudgetPlanner:
+    """
+    วางแผนขนาดคำขอก่อนส่ง แทนการใช้ max_output_tokens คงที่แล้วค่อยแก้เมื่อผลลัพธ์ถูกตัด
+    - ประมาณ Token ขาออกของบทบรรยายจากความยาวเสียง x อัตราการพูด (Token ต่อนาที)
+    - เลือกเฉพาะโมเดลที่รับ Token ขาเข้าและขาออกของคำขอนี้ได้ และตั้ง max_output_tokens ให้พอดีกับงาน
+    - หากไม่มีโมเดลใดรับได้ในคำขอเดียว จะวางแผนแบ่งเป็นช่วง (chunk_seconds) ที่ผลลัพธ์แต่ละช่วงพอดีกับโมเดล
+    """
+
+    def __init__(self, limits=None, transcript_tokens_per_minute=450, safety_margin=1.3,
+                 min_output_tokens=8192, min_chunk_seconds=120):
+        self.limits = dict(MODEL_TOKEN_LIMITS if limits is None else limits)
+        self.transcript_tokens_per_minute = transcript_tokens_per_minute
+        self.safety_margin = safety_margin
+        self.min_output_tokens = min_output_tokens
+        self.min_chunk_seconds = min_chunk_seconds
+
+    def input_limit(self, model_name):
+        return self.limits.get(model_name, DEFAULT_MODEL_TOKEN_LIMITS)[0]
+
+    def output_limit(self, model_name):
+        return self.limits.get(model_name, DEFAULT_MODEL_TOKEN_LIMITS)[1]
+
+    def expected_transcript_tokens(self, duration_seconds):
+        """Token ขาออกโดยประมาณของบทบรรยาย (รวม Timestamp และชื่อผู้พูด) สำหรับเสียงยาว duration_seconds"""
+        return int((duration_seconds or 0) / 60.0 * self.transcript_tokens_per_minute)
+
+    def plan(self, models, input_tokens, expected_output_tokens, duration_seconds=0, max_chunk_seconds=None):
+        """
+        คืนค่า dict แผนการเรียก:
+        - strategy: 'single' (คำขอเดียว) หรือ 'chunked' (แบ่งเสียง/ข้อความเป็นช่วงละ chunk_seconds)
+        - models: โมเดลที่รับงานนี้ได้ (เรียงตามลำดับเดิม), max_output_tokens: เพดานที่ควรขอ
+        """
+        needed = max(self.min_output_tokens, int(expected_output_tokens * self.safety_margin))
+        fitting = [m for m in models if self.input_limit(m) >= input_tokens and self.output_limit(m) >= needed]
+        plan = {'input_tokens': input_tokens, 'expected_output_tokens': expected_output_tokens, 'chunk_seconds': None}
+        if fitting or not duration_seconds:
+            # ข้อความที่ไม่มีความยาวเสียงแบ่งตามเวลาไม่ได้ ใช้โมเดลที่รับ Output ได้มากที่สุดแทน
+            fitting = fitting or sorted(models, key=self.output_limit, reverse=True)
+            plan.update(strategy='single', models=fitting, max_output_tokens=min(needed, max(self.output_limit(m) for m in fitting)))
+            return plan
+
+        # ไม่มีโมเดลใดรับผลลัพธ์ทั้งหมดได้ในคำขอเดียว: แบ่งให้ผลลัพธ์แต่ละช่วงไม่เกิน 80% ของโมเดลที่รับได้มากที่สุด
+        best_output = max(self.output_limit(m) for m in models)
+        tokens_per_second = needed / float(duration_seconds)
+        chunk_seconds = max(self.min_chunk_seconds, best_output * 0.8 / tokens_per_second)
+        if max_chunk_seconds:
+            chunk_seconds = min(chunk_seconds, max_chunk_seconds)
+        plan.update(strategy='chunked', chunk_seconds=chunk_seconds, max_output_tokens=best_output,
+                    models=sorted(models, key=self.output_limit, reverse=True))
+        return plan
+
+
+class KeyPool:
+    """
+    ตัวจัดสรร API Key ที่ใช้ร่วมกันทุกเธรด (แทนการสุ่มลำดับคีย์ในแต่ละการเรียก)
+    - ติดตามจำนวนครั้งที่โดน 429 ติดต่อกัน และพักคีย์ (Cooldown) ตาม Retry-After หรือแบบทวีคูณ
+    - นับจำนวนคำขอที่กำลังทำงาน (In-flight) ของแต่ละคีย์
+    - จำกัดอัตราด้วย Token Bucket ทั้งจำนวนคำขอต่อนาที (RPM) และจำนวน Token ต่อนาที (TPM)
+    - แจกคีย์ที่สุขภาพดีและมีงานค้างน้อยที่สุดเสมอ
+    """
+
+    def __init__(self, keys, rpm_limit=10, tpm_limit=250000, base_cooldown=5, max_cooldown=300):
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self._cond = threading.Condition()
+
+        now = time.time()
+        self._keys = list(dict.fromkeys(keys))  # ตัดคีย์ซ้ำโดยรักษาลำดับเดิม
+        self._state = {}
+        for key in self._keys:
+            self._state[key] = {
+                'in_flight': 0,
+                'consecutive_429': 0,
+                'cooldowns': {},  # scope (เช่น ชื่อโมเดล) -> เวลาที่พ้นช่วงพัก
+                'rpm_tokens': float(rpm_limit),
+                'tpm_tokens': float(tpm_limit),
+                'refilled_at': now,
+                'total_requests': 0
+            }
+
+    @property
+    def keys(self):
+        """รายชื่อคีย์ทั้งหมดตามลำดับเดิม"""
+        return list(self._keys)
+
+    def _refill(self, state, now):
+        elapsed = now - state['refilled_at']
+        if elapsed > 0:
+            state['rpm_tokens'] = min(self.rpm_limit, state['rpm_tokens'] + elapsed * self.rpm_limit / 60.0)
+            state['tpm_tokens'] = min(self.tpm_limit, state['tpm_tokens'] + elapsed * self.tpm_limit / 60.0)
+            state['refilled_at'] = now
+
+    def _wait_time(self, state, tokens, now, scope=None):
+        """คำนวณเวลาที่ต้องรอก่อนคีย์นี้จะพร้อมใช้งาน (0 = พร้อมทันที)"""
+        self._refill(state, now)
+        wait = max(0.0, state['cooldowns'].get(None, 0.0) - now)
+        if scope is not None:
+            wait = max(wait, state['cooldowns'].get(scope, 0.0) - now)
+        if state['rpm_tokens'] < 1:
+            wait = max(wait, (1 - state['rpm_tokens']) * 60.0 / self.rpm_limit)
+        if state['tpm_tokens'] < tokens:
+            wait = max(wait, (tokens - state['tpm_tokens']) * 60.0 / self.tpm_limit)
+        return wait
+
+    def _try_acquire(self, tokens, exclude, scope):
+        """พยายามจองคีย์ทันที คืนค่า (คีย์, None) หรือ (None, เวลาที่ควรรอ) — ต้องถือ self._cond อยู่"""
+        now = time.time()
+        candidates = [k for k in self._keys if k not in exclude]
+        if not candidates:
+            return None, None
+
+        waits = {k: self._wait_time(self._state[k], tokens, now, scope) for k in candidates}
+        ready = [k for k in candidates if waits[k] == 0]
+        if not ready:
+            return None, min(waits.values())
+
+        key = min(ready, key=lambda k: (
+            self._state[k]['in_flight'],
+            self._state[k]['consecutive_429'],
+            -self._state[k]['rpm_tokens']
+        ))
+        state = self._state[key]
+        state['rpm_tokens'] -= 1
+        state['tpm_tokens'] -= tokens
+        state['in_flight'] += 1
+        state['total_requests'] += 1
+        return key, None
+
+    def acquire(self, estimated_tokens=0, exclude=(), max_wait=30, scope=None):
+        """
+        ขอคีย์ที่สุขภาพดีและมีงานค้างน้อยที่สุด (ไม่รวมคีย์ใน exclude)
+        scope: ขอบเขตของช่วงพัก (เช่น ชื่อโมเดล เพราะโควตาของ Gemini แยกตามโมเดล)
+        หากทุกคีย์กำลังพักอยู่ จะรอได้ไม่เกิน max_wait วินาที แล้วคืนค่า None
+        """
+        tokens = min(estimated_tokens, self.tpm_limit)
+        deadline = time.time() + max_wait
+        with self._cond:
+            while True:
+                key, wait = self._try_acquire(tokens, exclude, scope)
+                if key is not None or wait is None:
+                    return key
+                if time.time() + wait > deadline:
+                    return None
+                self._cond.wait(timeout=wait)
+
+    def release(self, key, error=None, scope=None):
+        """คืนคีย์หลังใช้งาน และอัปเดตสถานะสุขภาพตามผลลัพธ์ (error=None คือสำเร็จ)"""
+        with self._cond:
+            state = self._state.get(key)
+            if state is None:
+                return
+            state['in_flight'] = max(0, state['in_flight'] - 1)
+
+            if error is not None and is_rate_limit_error(error):
+                state['consecutive_429'] += 1
+                retry_after = parse_retry_after(str(error))
+                if retry_after is None:
+                    retry_after = min(self.max_cooldown, self.base_cooldown * (2 ** (state['consecutive_429'] - 1)))
+                state['cooldowns'][scope] = max(state['cooldowns'].get(scope, 0.0), time.time() + retry_after)
+                print(f"   🧊 พักคีย์ ...{str(key)[-4:]} เป็นเวลา {retry_after:.0f} วินาที (429 ติดต่อกัน {state['consecutive_429']} ครั้ง)")
+            elif error is None:
+                state['consecutive_429'] = 0
+
+            self._cond.notify_all()
+
+    def snapshot(self):
+        """คืนค่าสถานะของทุกคีย์ (สำหรับหน้าตรวจสอบระบบ)"""
+        with self._cond:
+            now = time.time()
+            return [{
+                'key': f"...{str(k)[-4:]}",
+                'in_flight': s['in_flight'],
+                'consecutive_429': s['consecutive_429'],
+                'cooldown_remaining': max([0.0] + [until - now for until in s['cooldowns'].values()]),
+                'total_requests': s['total_requests']
+            } for k, s in self._state.items()]
+
+
+class LatencyHistogram:
+    """
+    ฮิสโทแกรมเวลาตอบสนองแบบช่องเวลาขยายตัว (0.25 วินาที ถึงประมาณ 30 นาที)
+    เมื่อจำนวนตัวอย่างถึง max_samples จะลดน้ำหนักลงครึ่งหนึ่ง เพื่อให้สะท้อนพฤติกรรมล่าสุดมากกว่าอดีต
+    """
+
+    BOUNDS = [0.25 * (1.5 ** i) for i in range(23)]  # ขอบบนของแต่ละช่อง (วินาที)
+
+    def __init__(self, max_samples=200):
+        self.max_samples = max_samples
+        self.counts = [0.0] * (len(self.BOUNDS) + 1)
+        self.total = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.total += 1
+        if self.total >= self.max_samples:
+            self.counts = [c / 2 for c in self.counts]
+            self.total /= 2
+
+    def percentile(self, p):
+        """คืนค่าขอบบนของช่องที่ครอบคลุม p เปอร์เซ็นต์ของตัวอย่าง (None หากยังไม่มีข้อมูล)"""
+        if not self.total:
+            return None
+        target = self.total * p / 100.0
+        cumulative = 0.0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return self.BOUNDS[min(i, len(self.BOUNDS) - 1)]
+        return self.BOUNDS[-1]
+
+
+class LatencyTracker:
+    """
+    เก็บสถิติเวลาตอบสนองของ Gemini แยกตามคีย์และประเภทคำขอ (scope เช่น โมเดล/มีเสียงหรือไม่/Streaming)
+    ใช้กำหนดเกณฑ์ของการส่งคำขอสำรอง (Hedged Request) ตามเปอร์เซ็นไทล์ของคีย์นั้นๆ
+    หากคีย์ยังมีตัวอย่างไม่พอ จะใช้สถิติรวมของทุกคีย์ใน scope เดียวกันแทน
+    """
+
+    def __init__(self, min_samples=20):
+        self.min_samples = min_samples
+        self._histograms = {}  # (api_key หรือ None สำหรับสถิติรวม, scope) -> LatencyHistogram
+        self._lock = threading.Lock()
+
+    def record(self, api_key, scope, seconds):
+        with self._lock:
+            for hist_key in ((api_key, scope), (None, scope)):
+                histogram = self._histograms.get(hist_key)
+                if histogram is None:
+                    histogram = self._histograms[hist_key] = LatencyHistogram()
+                histogram.add(seconds)
+
+    def threshold(self, api_key, scope, percentile=95):
+        """เวลาที่เกินแล้วควรส่งคำขอสำรอง คืนค่า None หากยังมีข้อมูลไม่พอ"""
+        with self._lock:
+            for hist_key in ((api_key, scope), (None, scope)):
+                histogram = self._histograms.get(hist_key)
+                if histogram is not None and histogram.total >= self.min_samples:
+                    return histogram.percentile(percentile)
+        return None
+
+    def snapshot(self, percentile=95):
+        """คืนค่าเปอร์เซ็นไทล์ของทุกคีย์ (สำหรับหน้าตรวจสอบระบบ)"""
+        with self._lock:
+            return [{
+                'key': f"...{str(k)[-4:]}" if k else "ทุกคีย์",
+                'scope': scope,
+                'samples': round(h.total),
+                f'p{percentile}': h.percentile(percentile)
+            } for (k, scope), h in self._histograms.items()]
+
+
+def classify_model_error(error):
+    """
+    จำแนก Error ของโมเดลสำหรับ Circuit Breaker
+    คืนค่า 'dead' (โมเดลถูกปลด/ไม่มีอยู่), 'overloaded' (เซิร์ฟเวอร์ไม่พร้อม) หรือ None (ไม่เกี่ยวกับโมเดล เช่น 429 ของคีย์)
+    """
+    text = str(error).lower()
+    if is_rate_limit_error(error) or "file" in text:
+        return None
+    if "404" in text or "not found" in text or "is not supported" in text:
+        return 'dead'
+    if any(marker in text for marker in ("500", "503", "504", "overloaded", "unavailable", "deadline", "internal error")):
+        return 'overloaded'
+    return None
+
+
+class ModelRegistry:
+    """
+    รายชื่อโมเดลที่ใช้งานได้จริง พร้อม Circuit Breaker ต่อโมเดลที่ใช้ร่วมกันทุกเธรด
+    - ตรวจสอบรายชื่อโมเดลที่เปิดให้บริการ (Model Probe) ครั้งเดียว แล้วเก็บผลในแคชตาม probe_ttl_seconds
+    - โมเดลที่ตอบ 404 ถูกปิดยาว (dead_seconds) ส่วนโมเดลที่ล้มเหลวติดกัน (5xx/Overloaded) ถูกปิดชั่วคราวแบบทวีคูณ
+    - เมื่อพ้นช่วงปิด จะปล่อยให้ลองใหม่ (Half-open) หากสำเร็จจะกลับมาใช้งานตามปกติ
+    """
+
+    PROBE_CACHE_KEY = "model_probe:v1"
+
+    def __init__(self, clients, models, cache=None, probe_ttl_seconds=6 * 3600, failure_threshold=3,
+                 base_open_seconds=30, max_open_seconds=600, dead_seconds=6 * 3600):
+        self.clients = clients
+        self.models = list(models)
+        self.cache = cache
+        self.probe_ttl_seconds = probe_ttl_seconds
+        self.failure_threshold = failure_threshold
+        self.base_open_seconds = base_open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.dead_seconds = dead_seconds
+        self._available = None  # ชื่อโมเดลจาก Probe (None = ยังไม่ได้ตรวจ หรือตรวจไม่สำเร็จ)
+        self._probe_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._state = {m: {'failures': 0, 'trips': 0, 'open_until': 0.0, 'reason': None} for m in self.models}
+
+    def _cache_key(self):
+        return self.cache.make_key(self.PROBE_CACHE_KEY, model_name=",".join(self.models))
+
+    def probe(self, api_key, force=False):
+        """ตรวจสอบรายชื่อโมเดลที่ใช้งานได้ (ใช้ผลจากแคชหากยังไม่หมดอายุ) คืนค่า set หรือ None หากตรวจไม่ได้"""
+        with self._probe_lock:
+            if self._available is not None and not force:
+                return self._available
+
+            if self.cache is not None and not force:
+                cached = self.cache.get(self._cache_key())
+                if cached:
+                    data = json.loads(cached)
+                    if time.time() - data['checked_at'] < self.probe_ttl_seconds:
+                        self._available = set(data['models'])
+                        return self._available
+
+            if not api_key:
+                return None
+            try:
+                listed = self.clients.list_models(api_key)
+            except Exception as e:
+                print(f"   ⚠️ ตรวจสอบรายชื่อโมเดลไม่สำเร็จ จะลองทุกโมเดลตามลำดับ: {e}")
+                return None
+
+            self._available = {m for m in self.models if m in listed}
+            skipped = [m for m in self.models if m not in self._available]
+            if skipped:
+                print(f"   🚫 ข้ามโมเดลที่ไม่เปิดให้บริการแล้ว: {', '.join(skipped)}")
+            if self.cache is not None:
+                self.cache.set(self._cache_key(), json.dumps({'checked_at': time.time(), 'models': sorted(self._available)}))
+            return self._available
+
+    def is_available(self, model_name):
+        """โมเดลนี้ควรถูกเรียกหรือไม่ (Circuit ปิดอยู่ หรือพ้นช่วงปิดแล้วจึงลองใหม่ได้)"""
+        with self._lock:
+            state = self._state.get(model_name)
+            return state is None or state['open_until'] <= time.time()
+
+    def models_to_try(self, api_key=None):
+        """ลำดับโมเดลที่ควรลอง โดยตัดโมเดลที่ไม่มีอยู่จริงและโมเดลที่ Circuit เปิดอยู่ออก"""
+        available = self.probe(api_key)
+        candidates = [m for m in self.models if available is None or m in available]
+        if not candidates:
+            # Probe ไม่พบโมเดลใดเลย (เช่น ชื่อโมเดลเปลี่ยน) ให้ลองตามรายชื่อเดิมดีกว่าไม่เรียกเลย
+            candidates = list(self.models)
+        healthy = [m for m in candidates if self.is_available(m)]
+        return healthy or candidates
+
+    def record_success(self, model_name):
+        with self._lock:
+            state = self._state.get(model_name)
+            if state is not None:
+                state.update(failures=0, trips=0, open_until=0.0, reason=None)
+
+    def record_failure(self, model_name, error):
+        """บันทึกความล้มเหลวของโมเดล และเปิด Circuit หากถึงเกณฑ์"""
+        kind = classify_model_error(error)
+        if kind is None:
+            return
+        with self._lock:
+            state = self._state.get(model_name)
+            if state is None:
+                return
+            if kind == 'dead':
+                state.update(open_until=time.time() + self.dead_seconds, reason='dead')
+                if self._available is not None:
+                    self._available.discard(model_name)
+                print(f"   🚫 ปิดการใช้งานโมเดล {model_name} (ไม่พบโมเดล/ถูกปลดแล้ว)")
+                return
+
+            state['failures'] += 1
+            if state['failures'] >= self.failure_threshold:
+                open_seconds = min(self.max_open_seconds, self.base_open_seconds * (2 ** state['trips']))
+                state['trips'] += 1
+                state['failures'] = 0
+                state.update(open_until=time.time() + open_seconds, reason='overloaded')
+                print(f"   ⛔ พักโมเดล {model_name} เป็นเวลา {open_seconds:.0f} วินาที (ล้มเหลวติดต่อกัน)")
+
+    def snapshot(self):
+        """คืนค่าสถานะของทุกโมเดล (สำหรับหน้าตรวจสอบระบบ)"""
+        with self._lock:
+            now = time.time()
+            return [{
+                'model': m,
+                'listed': self._available is None or m in self._available,
+                'open_remaining': max(0.0, s['open_until'] - now),
+                'reason': s['reason']
+            } for m, s in self._state.items()]
+
+
+# หัวข้อส่วนต่างๆ ในผลลัพธ์ของ Gemini (รองรับ [TAG], TAG:, **TAG**)
+_SECTION_HEADER = re.compile(r'^(?:[-*>\s]*)(?:\*\*)?\[?\s*(SUMMARY|TOPICS|TRANSCRIPT)\s*(?:\]|:|\*\*)', re.IGNORECASE)
+
+# หัวข้อสำหรับตัวแยกส่วน (รวมชื่อภาษาไทยที่โมเดลมักใช้แทนแท็ก) ต้องอยู่ต้นบรรทัดเท่านั้น
+_SECTION_LINE = re.compile(
+    r'^[-*>#\s]*(?:\*\*)?\[?\s*(SUMMARY|TOPICS|TRANSCRIPT|สรุป|หัวข้อ|เนื้อหา|บทบรรยาย)\s*(?:\]\s*(?:\*\*)?\s*:?|\*\*\s*:?|:)(?:\*\*)?',
+    re.IGNORECASE)
+_SECTION_NAMES = {
+    'SUMMARY': 'summary', 'สรุป': 'summary',
+    'TOPICS': 'topics', 'หัวข้อ': 'topics',
+    'TRANSCRIPT': 'transcript', 'เนื้อหา': 'transcript', 'บทบรรยาย': 'transcript',
+}
+
+
+def split_tagged_sections(text):
+    """
+    แยกผลลัพธ์รูปแบบแท็ก ([SUMMARY], TOPICS:, **TRANSCRIPT**) เป็นส่วนๆ โดยอ่านทีละบรรทัดเพียงรอบเดียว (Linear time)
+    คืนค่า dict ชื่อส่วน ('summary', 'topics', 'transcript') -> ข้อความ เฉพาะส่วนที่พบ
+    - ข้อความหลังหัวข้อในบรรทัดเดียวกันนับเป็นเนื้อหาของส่วนนั้น (ยกเว้นวงเล็บบอกความยาววิดีโอ)
+    - หัวข้อเดิมที่ปรากฏซ้ำจะต่อเนื้อหาเข้ากับส่วนเดิม
+    """
+    sections = {}
+    current = None
+    for line in text.split('\n'):
+        header = _SECTION_LINE.match(line)
+        if header:
+            tag = header.group(1)
+            current = _SECTION_NAMES.get(tag.upper(), _SECTION_NAMES.get(tag))
+            lines = sections.setdefault(current, [])
+            rest = line[header.end():].strip()
+            if rest and not (rest.startswith('(') and rest.endswith(')')):
+                lines.append(rest)
+        elif current is not None:
+            sections[current].append(line)
+    return {name: '\n'.join(lines).strip() for name, lines in sections.items()}
+
+
+class TranscriptLineStream:
+    """
+    แปลงข้อความที่ Gemini ทยอยส่งมา (Streaming Chunks) เป็นบรรทัดบทบรรยายที่สมบูรณ์
+    - ส่งต่อเฉพาะบรรทัดที่อยู่ในส่วน [TRANSCRIPT] ให้ on_line ทีละบรรทัด
+    - feed(None) หมายถึงคำขอถูกเริ่มใหม่ (เช่น สลับคีย์) จะข้ามบรรทัดที่เคยส่งไปแล้วเพื่อไม่ให้ผู้ใช้เห็นซ้ำ
+    """
+
+    def __init__(self, on_line):
+        self.on_line = on_line
+        self.emitted = 0  # จำนวนบรรทัดที่ส่งให้ผู้ใช้แล้ว
+        self._restart_state = (False, 0)  # สถานะเริ่มต้นเมื่อ Stream ถูกเริ่มใหม่ (อยู่ใน TRANSCRIPT หรือไม่, จำนวนบรรทัดที่นับแล้ว)
+        self._reset()
+
+    def _reset(self):
+        self._buffer = ""
+        self._in_transcript, self._seen = self._restart_state  # _seen: จำนวนบรรทัดบทบรรยายที่พบใน Stream รอบปัจจุบัน
+
+    def continue_transcript(self):
+        """
+        เริ่มรับข้อความจากคำขอต่อเนื่อง (Continuation) ที่ตอบเฉพาะบทบรรยาย
+        ถือว่าอยู่ในส่วน [TRANSCRIPT] ตั้งแต่ต้น และไม่ข้ามบรรทัดที่เคยส่งไปแล้ว
+        """
+        self._restart_state = (True, self.emitted)
+        self._reset()
+
+    def feed(self, text):
+        """รับข้อความชิ้นถัดไป คืนค่า True เสมอ (ใช้เป็น on_chunk ของ call_gemini_with_retry ได้โดยตรง)"""
+        if text is None:
+            self._reset()
+            return True
+        self._buffer += text
+        while "\n" in self._buffer:
+            line, self._buffer = self._buffer.split("\n", 1)
+            self._handle(line)
+        return True
+
+    def close(self):
+        """ส่งบรรทัดสุดท้ายที่ค้างอยู่ใน Buffer (เรียกเมื่อ Stream จบ)"""
+        if self._buffer:
+            self._handle(self._buffer)
+        self._buffer = ""
+
+    def _handle(self, line):
+        stripped = line.strip()
+        header = _SECTION_HEADER.match(stripped)
+        if header:
+            self._in_transcript = header.group(1).upper() == "TRANSCRIPT"
+            return
+        if not self._in_transcript or not stripped:
+            return
+        self._seen += 1
+        if self._seen <= self.emitted:
+            return  # บรรทัดนี้ถูกส่งไปแล้วก่อนคำขอจะถูกเริ่มใหม่
+        self.emitted += 1
+        try:
+            self.on_line(stripped)
+        except Exception as e:
+            print(f"   ⚠️ on_line error: {e}")
+
+
+class RepetitionDetector:
+    """
+    ตรวจจับอาการ "วนซ้ำ" (Hallucination Loop) ของโมเดลระหว่าง Streaming แบบเชิงเส้น (Linear-time)
+    - ใช้ Rolling Hash ของหน้าต่างตัวอักษรขนาด window (Rabin-Karp) และจำตำแหน่งล่าสุดของแต่ละ Hash
+    - หากหน้าต่างติดกันจำนวนมากซ้ำกับข้อความก่อนหน้าด้วยระยะห่าง (Period) เท่าเดิม ถือว่ากำลังวนซ้ำ
+    - ตัวเลขถูกแทนด้วย 0 ก่อนคำนวณ เพื่อให้จับบรรทัดซ้ำที่ต่างกันแค่ Timestamp ได้
+    """
+
+    _MOD = (1 << 61) - 1
+    _BASE = 1_000_003
+
+    def __init__(self, window=32, min_repeats=4, min_chars=300, max_period=2000):
+        self.window = window
+        self.min_repeats = min_repeats
+        self.min_chars = min_chars
+        self.max_period = max_period
+        self._base_pow = pow(self._BASE, window - 1, self._MOD)
+        self.reset()
+
+    def reset(self):
+        """เริ่มตรวจใหม่ (เรียกเมื่อ Stream ถูกเริ่มใหม่)"""
+        self.text = []  # ข้อความดิบทั้งหมดที่ได้รับ
+        self._codes = []  # รหัสตัวอักษรหลังทำ Normalization
+        self._hash = 0
+        self._last_seen = {}  # hash -> ตำแหน่งล่าสุดที่พบ
+        self._period = None
+        self._run = 0
+        self.loop_start = None  # ตำแหน่งที่การวนซ้ำเริ่มต้น (หลังสำเนาแรก) เมื่อตรวจพบแล้ว
+
+    @property
+    def triggered(self):
+        return self.loop_start is not None
+
+    def feed(self, chunk):
+        """รับข้อความชิ้นถัดไป คืนค่า False เมื่อตรวจพบการวนซ้ำ (ใช้ยกเลิก Stream ได้ทันที)"""
+        if self.triggered:
+            return False
+        for ch in chunk:
+            if self._push(ch):
+                return False
+        return True
+
+    def _push(self, ch):
+        i = len(self._codes)
+        self.text.append(ch)
+        code = 48 if ch.isdigit() else ord(ch)
+        self._codes.append(code)
+
+        if i >= self.window:
+            self._hash = (self._hash - self._codes[i - self.window] * self._base_pow) % self._MOD
+        self._hash = (self._hash * self._BASE + code) % self._MOD
+        if i < self.window - 1:
+            return False
+
+        prev = self._last_seen.get(self._hash)
+        self._last_seen[self._hash] = i
+        if prev is None or i - prev > self.max_period:
+            self._period, self._run = None, 0
+            return False
+
+        period = i - prev
+        if period == self._period:
+            self._run += 1
+        else:
+            self._period, self._run = period, 1
+
+        # ช่วงที่ซ้ำกับข้อความก่อนหน้า (ไม่นับสำเนาแรก) และจำนวนรอบที่ซ้ำ
+        repeated_chars = self._run + self.window - 1
+        copies = repeated_chars / period + 1
+        if repeated_chars >= self.min_chars and copies >= self.min_repeats:
+            self.loop_start = i - repeated_chars + 1
+            return True
+        return False
+
+    def good_text(self):
+        """ข้อความก่อนเริ่มวนซ้ำ ตัดให้จบที่บรรทัดสมบูรณ์บรรทัดสุดท้าย"""
+        text = "".join(self.text[:self.loop_start] if self.triggered else self.text)
+        if self.triggered and "\n" in text:
+            text = text[:text.rfind("\n") + 1]
+        return text
@@ -38,6 +38,17 @@ class HistoryManager:
                 except sqlite3.OperationalError:
                      # คอลัมน์น่าจะมีอยู่แล้ว
                      pass
+
+                # การปรับเปลี่ยนฐานข้อมูล: เพิ่ม video_id (ID วิดีโอแบบมาตรฐาน) และ results_json (ผลลัพธ์ทั้งหมด)
+                # เพื่อให้เปิดวิดีโอที่เคยประมวลผลแล้วได้ทันที (รายการเก่าไม่มีค่าเหล่านี้ จึงไม่ถูกใช้ซ้ำ)
+                for column in ("video_id TEXT", "results_json TEXT"):
+                    try:
+                        cursor.execute(f"ALTER TABLE history ADD COLUMN {column}")
+                        conn.commit()
+                    except sqlite3.OperationalError:
+                        pass
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_history_video_id ON history (video_id)")
+                conn.commit()
         except Exception as e:
             print(f"Database initialization error: {e}")
 
@@ -85,6 +96,7 @@ class HistoryManager:
         """
         บันทึกข้อมูลใหม่ลงในฐานข้อมูล SQLite
         ในออบเจกต์ entry ควรมีคีย์: title, url, result_text, recommendations
+        และอาจมี video_id (ID วิดีโอแบบมาตรฐาน) กับ results (Dictionary ผลลัพธ์ทั้งหมด) สำหรับ find_results
         """
         try:
             # Prepare data
@@ -93,6 +105,8 @@ class HistoryManager:
             result_text = entry.get('result_text', '')
             # แปลง list/dict เป็นสตริง JSON เพื่อจัดเก็บ (JSON string for storage)
             recommendations = json.dumps(entry.get('recommendations', []), ensure_ascii=False)
+            video_id = entry.get('video_id')
+            results_json = json.dumps(entry['results'], ensure_ascii=False, default=str) if entry.get('results') else None
             timestamp = datetime.now().isoformat()
             
             with sqlite3.connect(self.db_file) as conn:
@@ -105,15 +119,15 @@ class HistoryManager:
                     # Update existing entry
                     cursor.execute("""
                         UPDATE history 
-                        SET title=?, result_text=?, recommendations=?, timestamp=?
+                        SET title=?, result_text=?, recommendations=?, timestamp=?, video_id=?, results_json=?
                         WHERE url=?
-                    """, (title, result_text, recommendations, timestamp, url))
+                    """, (title, result_text, recommendations, timestamp, video_id, results_json, url))
                 else:
                     # Insert new entry
                     cursor.execute("""
-                        INSERT INTO history (title, url, result_text, recommendations, timestamp)
-                        VALUES (?, ?, ?, ?, ?)
-                    """, (title, url, result_text, recommendations, timestamp))
+                        INSERT INTO history (title, url, result_text, recommendations, timestamp, video_id, results_json)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """, (title, url, result_text, recommendations, timestamp, video_id, results_json))
                 
                 conn.commit()
             return True
@@ -122,6 +136,35 @@ class HistoryManager:
             print(f"Error saving history: {e}")
             return False
             
+    def find_results(self, video_id, max_age_seconds=None):
+        """
+        ค้นหาผลลัพธ์ล่าสุดของวิดีโอจาก ID แบบมาตรฐาน (ไม่ว่าจะบันทึกมาจาก URL รูปแบบใด)
+        max_age_seconds: ไม่ใช้รายการที่เก่ากว่านี้ (None = ไม่จำกัดอายุ)
+        คืนค่า Dictionary ผลลัพธ์ทั้งหมด หรือ None หากไม่พบ
+        """
+        if not video_id:
+            return None
+        try:
+            with sqlite3.connect(self.db_file) as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT results_json, timestamp FROM history
+                    WHERE video_id = ? AND results_json IS NOT NULL
+                    ORDER BY timestamp DESC LIMIT 1
+                """, (video_id,))
+                row = cursor.fetchone()
+            if not row:
+                return None
+            results_json, timestamp = row
+            if max_age_seconds is not None:
+                age = (datetime.now() - datetime.fromisoformat(timestamp)).total_seconds()
+                if age > max_age_seconds:
+                    return None
+            return json.loads(results_json)
+        except Exception as e:
+            print(f"Error reading history results: {e}")
+            return None
+
     def clear_history(self):
         """ลบข้อมูลประวัติทั้งหมด (Deletes all records)"""
         try:
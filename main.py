@@ -12,6 +12,7 @@ import re
 import tempfile
 import threading
 import random
+import queue
 from datetime import datetime
 from pathlib import Path
 
@@ -42,73 +43,361 @@ if GEMINI_API_KEYS and 'GEMINI_API_KEY' not in os.environ:
 
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from utils import extract_meaningful_search_query, search_videos
+from cache_manager import ResultCache, StageCache, file_sha256
+from concurrency_manager import AdaptiveLimiter, SingleFlight
+from gemini_manager import ClientPool, UploadRegistry, KeyPool, ModelRegistry, TranscriptLineStream, RepetitionDetector, GeminiText, LatencyTracker, response_finish_reason, estimate_text_tokens, estimate_audio_tokens, split_tagged_sections, TokenBudgetPlanner
+
+# --- แคชผลลัพธ์ของ Gemini (Persistent Result Cache) ---
+# ป้องกันการส่ง Prompt เดิมซ้ำเมื่อมีการประมวลผล URL เดิม (Rerun / Retry / Batch ซ้ำ)
+GEMINI_RESULT_CACHE = ResultCache(
+    db_file=os.getenv('GEMINI_CACHE_DB', str(Path(__file__).parent / 'gemini_cache.db')),
+    max_bytes=int(float(os.getenv('GEMINI_CACHE_MAX_MB', '200')) * 1024 * 1024),
+    ttl_seconds=int(float(os.getenv('GEMINI_CACHE_TTL_HOURS', '168')) * 3600)
+)
+
+# แคชรายขั้นตอนของ process_video (Metadata / คำบรรยาย / ผลถอดเสียง) รันซ้ำเฉพาะขั้นตอนที่ข้อมูลนำเข้าเปลี่ยน
+# เพิ่มเลขเวอร์ชันของขั้นตอนเมื่อแก้ Prompt หรือรูปแบบผลลัพธ์ของขั้นตอนนั้น
+STAGE_VERSIONS = {'metadata': 1, 'captions': 1, 'audio_analysis': 1}
+STAGE_CACHE = StageCache(
+    ResultCache(
+        db_file=os.getenv('STAGE_CACHE_DB', str(Path(__file__).parent / 'stage_cache.db')),
+        max_bytes=int(float(os.getenv('STAGE_CACHE_MAX_MB', '500')) * 1024 * 1024),
+        ttl_seconds=int(float(os.getenv('STAGE_CACHE_TTL_HOURS', '720')) * 3600)
+    ),
+    stage_versions=STAGE_VERSIONS,
+    # Metadata และคำบรรยายเปลี่ยนได้ (และลิงก์สตรีมหมดอายุ) จึงเก็บสั้นกว่าผลถอดเสียง
+    max_ages={'metadata': 6 * 3600, 'captions': 24 * 3600}
+)
+
+# --- Client แยกตาม API Key (Thread-safe) ---
+# ใช้แทน genai.configure แบบ Global ซึ่งทำให้เธรดที่ทำงานพร้อมกันส่งคำขอด้วยคีย์ของเธรดอื่น
+GEMINI_CLIENTS = ClientPool()
+
+# --- ทะเบียนไฟล์เสียงที่อัปโหลดแล้ว (Upload-once per API Key) ---
+# อัปโหลดไฟล์เดิมครั้งเดียวต่อคีย์ แล้วใช้ซ้ำข้ามโมเดลสำรองและการเรียกครั้งถัดไป
+GEMINI_UPLOADS = UploadRegistry(
+    GEMINI_CLIENTS,
+    idle_ttl_seconds=int(os.getenv('GEMINI_UPLOAD_IDLE_MINUTES', '30')) * 60
+)
+
+# --- ตัวจัดสรร API Key ร่วมกันทุกเธรด (Key Health Scheduler) ---
+# ติดตาม 429 / Retry-After / งานค้าง / RPM-TPM ของแต่ละคีย์ แทนการสุ่มลำดับคีย์
+GEMINI_KEY_POOL = KeyPool(
+    GEMINI_API_KEYS or [os.getenv('GEMINI_API_KEY')],
+    rpm_limit=int(os.getenv('GEMINI_KEY_RPM', '10')),
+    tpm_limit=int(os.getenv('GEMINI_KEY_TPM', '250000'))
+)
 
-from utils import extract_video_id, format_transcript, get_video_title, get_video_info, download_audio, extract_search_query_from_ai_result, extract_meaningful_search_query, format_time, parse_timestamp_to_seconds
+from utils import extract_meaningful_search_query, search_videos
 
-def call_gemini_with_retry(prompt, audio_path=None, max_output_tokens=2048):
+from utils import extract_video_id, format_transcript, get_video_title, get_video_info, download_audio, extract_search_query_from_ai_result, extract_meaningful_search_query, format_time, parse_timestamp_to_seconds, split_audio_at_silences, compress_caption_hint, choose_audio_profile, YTDLP_LIMITER, MEDIA_CACHE
+
+# จัดลำดับความสำคัญของโมเดลที่ทำงานเร็วเพื่อให้ประมวลผลได้ไว
+GEMINI_MODELS = [
+    'gemini-1.5-pro-latest',
+    'gemini-2.0-flash',
+    'gemini-2.0-flash-exp',
+    'gemini-flash-latest',
+    'gemini-1.5-flash-8b-latest'
+]
+
+# --- ตรวจสอบโมเดลที่ใช้งานได้ + Circuit Breaker ต่อโมเดล ---
+# ข้ามโมเดลที่ถูกปลดแล้ว (404) หรือกำลังล่ม (5xx) ทันที แทนการไล่ลองทุกคีย์ในทุกการเรียก
+GEMINI_MODEL_REGISTRY = ModelRegistry(
+    GEMINI_CLIENTS,
+    GEMINI_MODELS,
+    cache=GEMINI_RESULT_CACHE,
+    probe_ttl_seconds=int(float(os.getenv('GEMINI_MODEL_PROBE_TTL_HOURS', '6')) * 3600)
+)
+# ตรวจรายชื่อโมเดลเบื้องหลังตั้งแต่เริ่มโปรแกรม (การเรียกครั้งแรกจะรอผลนี้เองหากยังไม่เสร็จ)
+if GEMINI_KEY_POOL.keys and GEMINI_KEY_POOL.keys[0]:
+    threading.Thread(target=GEMINI_MODEL_REGISTRY.probe, args=(GEMINI_KEY_POOL.keys[0],), daemon=True).start()
+
+# --- วางแผน Token ก่อนส่งคำขอ (Token Budget Planner) ---
+# นับ Token ขาเข้า ประมาณ Token ขาออกจากความยาววิดีโอ แล้วเลือกโมเดล เพดาน Output และการแบ่งช่วงล่วงหน้า
+GEMINI_TOKEN_PLANNER = TokenBudgetPlanner(
+    transcript_tokens_per_minute=int(os.getenv('GEMINI_TRANSCRIPT_TOKENS_PER_MINUTE', '450'))
+)
+# Token ขาออกโดยประมาณของส่วน [SUMMARY] และ [TOPICS]
+GEMINI_HEADER_OUTPUT_TOKENS = 1024
+
+# MIME Type ที่ Gemini รับได้ตามนามสกุลไฟล์ (Opus จาก yt-dlp อยู่ใน Ogg container)
+AUDIO_MIME_TYPES = {
+    '.mp3': 'audio/mp3',
+    '.wav': 'audio/wav',
+    '.opus': 'audio/ogg',
+    '.ogg': 'audio/ogg',
+    '.m4a': 'audio/mp4',
+    '.mp4': 'audio/mp4',
+    '.aac': 'audio/aac',
+    '.flac': 'audio/flac',
+    '.webm': 'audio/webm',
+}
+
+def get_audio_mime_type(audio_path):
+    """เลือก MIME Type ของไฟล์เสียงตามนามสกุลไฟล์สำหรับอัปโหลดไปยัง Gemini"""
+    ext = os.path.splitext(audio_path)[1].lower()
+    return AUDIO_MIME_TYPES.get(ext, f'audio/{ext[1:]}' if ext else 'audio/mp4')
+
+def _lookup_cached_result(prompt, audio_hash, max_output_tokens, models_to_try):
+    """ค้นหาผลลัพธ์ในแคชตามลำดับโมเดล คืนค่า None หากไม่พบ"""
+    for model_name in models_to_try:
+        cached, meta = GEMINI_RESULT_CACHE.get(GEMINI_RESULT_CACHE.make_key(prompt, audio_hash, model_name, max_output_tokens), with_meta=True)
+        if cached is not None:
+            print(f"   ⚡ ใช้ผลลัพธ์จากแคช ({model_name})")
+            return GeminiText(cached, meta.get('finish_reason'))
+    return None
+
+def _store_cached_result(prompt, audio_hash, model_name, max_output_tokens, result_text):
+    """บันทึกผลลัพธ์ลงแคชพร้อม finish_reason (ใช้ตรวจว่าผลลัพธ์ถูกตัดหรือไม่เมื่อดึงกลับมาใช้)"""
+    if result_text:
+        GEMINI_RESULT_CACHE.set(GEMINI_RESULT_CACHE.make_key(prompt, audio_hash, model_name, max_output_tokens), result_text,
+                                meta={'finish_reason': getattr(result_text, 'finish_reason', None)})
+
+def _is_missing_file_error(e):
+    """ตรวจว่า Error เกิดจากไฟล์เสียงถูกลบหรือหมดอายุฝั่งเซิร์ฟเวอร์หรือไม่"""
+    text = str(e).lower()
+    return "file" in text and ("403" in text or "not exist" in text or "not found" in text)
+
+def _stream_response_text(response, on_chunk):
+    """
+    อ่านผลลัพธ์แบบ Stream ทีละ Chunk และส่งต่อให้ on_chunk
+    คืนค่า (ข้อความทั้งหมดที่ได้รับ, ถูกยกเลิกหรือไม่, finish_reason) โดย on_chunk คืนค่า False เพื่อยกเลิกคำขอ
+    """
+    parts = []
+    finish_reason = None
+    for chunk in response:
+        finish_reason = response_finish_reason(chunk) or finish_reason
+        try:
+            text = chunk.text
+        except ValueError:
+            continue  # Chunk ที่ไม่มีข้อความ (เช่น มีแค่ finish_reason)
+        if not text:
+            continue
+        parts.append(text)
+        if on_chunk(text) is False:
+            return "".join(parts), True, finish_reason
+    return "".join(parts), False, finish_reason
+
+# --- จำกัดจำนวนคำขอ Gemini พร้อมกันแบบปรับตัวเอง (AIMD) ---
+# เริ่มจากจำนวนคีย์ เพิ่มขึ้นเมื่อสำเร็จต่อเนื่อง และลดลงครึ่งหนึ่งเมื่อโดน 429/Timeout
+GEMINI_LIMITER = AdaptiveLimiter(
+    "gemini",
+    initial_limit=int(os.getenv('GEMINI_INITIAL_CONCURRENCY', str(max(2, len(GEMINI_KEY_POOL.keys))))),
+    max_limit=int(os.getenv('GEMINI_MAX_CONCURRENCY', str(max(4, len(GEMINI_KEY_POOL.keys) * 4))))
+)
+
+# --- HEDGED REQUESTS: ส่งคำขอสำรองเมื่อคำขอเดิมช้ากว่าปกติ (ตัดหางของเวลาตอบสนอง) ---
+# เกณฑ์มาจากเปอร์เซ็นไทล์ของเวลาตอบสนองของคีย์นั้น (เวลาจนได้ Chunk แรก)
+# ใช้เฉพาะคำขอแบบ Streaming ซึ่งยกเลิกคำขอที่แพ้ได้ทันที (คำขอแบบปกติยกเลิกกลางทางไม่ได้ จะเสียโควตาเป็นสองเท่า)
+GEMINI_HEDGE_ENABLED = os.getenv('GEMINI_HEDGE_ENABLED', '1') == '1'
+GEMINI_HEDGE_PERCENTILE = float(os.getenv('GEMINI_HEDGE_PERCENTILE', '95'))
+GEMINI_LATENCY = LatencyTracker(min_samples=int(os.getenv('GEMINI_HEDGE_MIN_SAMPLES', '20')))
+
+def _latency_scope(model_name, audio_path, max_output_tokens, streaming):
+    """ประเภทของคำขอสำหรับแยกสถิติเวลาตอบสนอง (คำขอต่างขนาดกันไม่ควรใช้เกณฑ์เดียวกัน)"""
+    return f"{model_name}|{'audio' if audio_path else 'text'}|{max_output_tokens}|{'stream' if streaming else 'full'}"
+
+def _run_attempt(api_key, model_name, prompt, audio_path, audio_hash, max_output_tokens, use_cache, response_schema=None, on_chunk=None, on_started=None):
+    """
+    ส่งคำขอหนึ่งครั้งด้วยคีย์และโมเดลที่กำหนด และคืนคีย์ให้ Key Pool เสมอ
+    คืนค่า (result_text, aborted, error) โดย result_text เป็น None เมื่ออัปโหลดไม่สำเร็จหรือเกิด Error
+    response_schema: หากกำหนด จะบังคับให้โมเดลตอบเป็น JSON ตาม Schema นี้
+    on_started: เรียกเมื่ออัปโหลดเสร็จและเริ่มส่งคำขอจริง (ใช้เริ่มจับเวลาของ Hedging)
+    """
+    attempt_error = None
+    audio_file = None
+    try:
+        # ใช้ Client ของคีย์นี้โดยเฉพาะ (ไม่แตะค่าตั้งค่า Global ที่เธรดอื่นใช้ร่วมกัน)
+        model = GEMINI_CLIENTS.model(api_key, model_name)
+
+        content_payload = [prompt]
+        if audio_path:
+            # อัปโหลดครั้งเดียวต่อคีย์ (ใช้ไฟล์เดิมซ้ำได้ข้ามโมเดล) ไฟล์ที่ไม่ใช้แล้วจะถูก Reaper ลบภายหลัง
+            audio_file = GEMINI_UPLOADS.acquire(api_key, audio_path, audio_hash, get_audio_mime_type(audio_path))
+            if audio_file is None: return None, False, None
+            content_payload.append(audio_file)
+
+        # ไม่ขอ Output เกินเพดานของโมเดล (โมเดลสำรองบางตัวรับได้น้อยกว่าที่วางแผนไว้ ส่วนที่ขาดจะถูกขอต่อภายหลัง)
+        generation_config = {"max_output_tokens": min(max_output_tokens, GEMINI_TOKEN_PLANNER.output_limit(model_name)), "temperature": 0.0}
+        if response_schema:
+            generation_config.update(response_mime_type="application/json", response_schema=response_schema)
+        latency_scope = _latency_scope(model_name, audio_path, max_output_tokens, on_chunk is not None)
+        # รอช่องว่างจากตัวจำกัดงานพร้อมกัน (429/Timeout จะทำให้ลดจำนวนงานพร้อมกันลงอัตโนมัติ)
+        with GEMINI_LIMITER.slot():
+            started_at = time.time()
+            if on_started: on_started(started_at)
+            if on_chunk:
+                first_chunk = [True]
+                def timed_chunk(text):
+                    if first_chunk[0]:
+                        first_chunk[0] = False
+                        GEMINI_LATENCY.record(api_key, latency_scope, time.time() - started_at)
+                    return on_chunk(text)
+
+                response = model.generate_content(content_payload, generation_config=generation_config, stream=True)
+                result_text, aborted, finish_reason = _stream_response_text(response, timed_chunk)
+                result_text = GeminiText(result_text.strip(), finish_reason)
+            else:
+                response = model.generate_content(content_payload, generation_config=generation_config)
+                GEMINI_LATENCY.record(api_key, latency_scope, time.time() - started_at)
+                result_text, aborted = GeminiText(response.text.strip(), response_finish_reason(response)), False
+
+        GEMINI_MODEL_REGISTRY.record_success(model_name)
+        # ผลลัพธ์ที่ถูกยกเลิกกลางทางเป็นข้อความบางส่วน จึงไม่บันทึกลงแคช
+        if use_cache and not aborted:
+            _store_cached_result(prompt, audio_hash, model_name, max_output_tokens, result_text)
+        return result_text, aborted, None
+    except Exception as e:
+        attempt_error = e
+        GEMINI_MODEL_REGISTRY.record_failure(model_name, e)
+        # ไฟล์ถูกลบหรือหมดอายุฝั่งเซิร์ฟเวอร์ ให้ลืมไฟล์นี้เพื่ออัปโหลดใหม่ในรอบถัดไป
+        if audio_path and _is_missing_file_error(e):
+            GEMINI_UPLOADS.invalidate(api_key, audio_hash)
+        return None, False, e
+    finally:
+        # คืนไฟล์เสียง (Reaper จะไม่ลบไฟล์ระหว่างที่คำขอยังใช้อยู่) และคืนคีย์ให้ Key Pool พร้อมผลลัพธ์ (429 จะทำให้คีย์ถูกพักตาม Retry-After)
+        GEMINI_UPLOADS.release(audio_file)
+        GEMINI_KEY_POOL.release(api_key, error=attempt_error, scope=model_name)
+
+def _run_hedged_attempt(api_key, model_name, threshold, tried_keys, estimated_tokens, attempt_args, on_chunk):
+    """
+    ส่งคำขอหลักแบบ Streaming และหากยังไม่ได้ Chunk แรกภายใน threshold วินาที (นับหลังอัปโหลดเสร็จ) ให้ส่งคำขอสำรองด้วยคีย์อื่น
+    คำขอที่ได้ Chunk แรกก่อนชนะ ส่วนคำขอที่แพ้จะถูกยกเลิกทันทีที่ได้รับ Chunk ของตัวเอง (จึงไม่ใช้โควตาจนจบ)
+    คืนค่ารูปแบบเดียวกับ _run_attempt
+    """
+    lock = threading.Lock()
+    completions = queue.Queue()
+    state = {'winner': None, 'started_at': None}
+
+    def launch(label, key):
+        def chunk_callback(text):
+            with lock:
+                if state['winner'] is None:
+                    state['winner'] = label
+                if state['winner'] != label:
+                    return False  # แพ้แล้ว: ยกเลิก Stream นี้
+            return on_chunk(text)
+
+        def on_started(started_at):
+            if label == 'primary':
+                state['started_at'] = started_at
+
+        def target():
+            outcome = _run_attempt(key, model_name, *attempt_args, on_chunk=chunk_callback, on_started=on_started)
+            completions.put((label, outcome))
+        threading.Thread(target=target, daemon=True).start()
+
+    launch('primary', api_key)
+    pending = {'primary'}
+    hedged = False
+    outcome = (None, False, None)
+    while pending:
+        timeout = None
+        if not hedged and state['winner'] is None:
+            if state['started_at'] is None:
+                timeout = 0.5  # ยังอัปโหลดอยู่ ตรวจสอบใหม่เป็นระยะ
+            else:
+                timeout = state['started_at'] + threshold - time.time()
+                if timeout <= 0:
+                    hedged = True
+                    hedge_key = GEMINI_KEY_POOL.acquire(estimated_tokens, exclude=tried_keys, max_wait=0, scope=model_name)
+                    if hedge_key is not None:
+                        tried_keys.add(hedge_key)
+                        print(f"   🏁 คำขอช้ากว่าปกติ (เกิน P{GEMINI_HEDGE_PERCENTILE:.0f} = {threshold:.1f} วินาที) ส่งคำขอสำรองด้วยคีย์ ...{str(hedge_key)[-4:]}")
+                        launch('hedge', hedge_key)
+                        pending.add('hedge')
+                    continue
+        try:
+            label, outcome = completions.get(timeout=timeout)
+        except queue.Empty:
+            continue
+        pending.discard(label)
+        with lock:
+            winner = state['winner']
+        if winner == label:
+            return outcome
+    # ทุกคำขอจบโดยไม่มีผู้ชนะ (ล้มเหลวทั้งหมด)
+    return outcome
+
+def _prefer_models(models, prefer_models=None):
+    """จัดลำดับโมเดลให้โมเดลที่ระบุใน prefer_models มาก่อน (โมเดลอื่นยังเป็นตัวสำรองตามลำดับเดิม)"""
+    if not prefer_models:
+        return list(models)
+    preferred = [m for m in prefer_models if m in models]
+    return preferred + [m for m in models if m not in preferred]
+
+def call_gemini_with_retry(prompt, audio_path=None, max_output_tokens=2048, use_cache=True, on_chunk=None, prefer_models=None, response_schema=None):
     """
     ฟังก์ชันหลักสำหรับเรียกใช้ Gemini AI แบบมีตัวสำรอง (Retry & Fallback)
     - รองรับการสลับ API Key อัตโนมัติเมื่อคีย์เต็ม (Quota Full)
     - รองรับการอัปโหลดไฟล์เสียงแยกตามแต่ละ API Key
+    - ตรวจสอบแคชผลลัพธ์ก่อนเรียก API (ปิดได้ด้วย use_cache=False)
+    - on_chunk: หากกำหนด จะเรียกแบบ Streaming และส่งข้อความทีละส่วนทันทีที่โมเดลสร้างเสร็จ
+      (ส่ง None เมื่อคำขอถูกเริ่มใหม่กับคีย์/โมเดลอื่น, คืนค่า False เพื่อยกเลิกและรับข้อความบางส่วนกลับไป)
+    - ข้ามโมเดลที่ไม่มีอยู่จริงหรือ Circuit Breaker เปิดอยู่ (GEMINI_MODEL_REGISTRY)
+    - ส่งคำขอสำรองด้วยคีย์อื่นเมื่อคำขอแบบ Streaming ช้ากว่าเปอร์เซ็นไทล์ของคีย์นั้น (GEMINI_HEDGE_ENABLED)
+    - prefer_models: ลองโมเดลเหล่านี้ก่อน (เช่น โมเดลที่เร็ว/ถูกกว่าสำหรับคำขอสั้น) แล้วจึงใช้ GEMINI_MODELS เป็นตัวสำรอง
+    - response_schema: บังคับให้ตอบเป็น JSON ตาม Schema (Prompt ควรต่างจากแบบแท็กเพื่อไม่ให้แคชปนกัน)
     """
-    import google.generativeai as genai
-    import time
-    import os
-
-    # จัดลำดับความสำคัญของโมเดลที่ทำงานเร็วเพื่อให้ประมวลผลได้ไว
-    models_to_try = [
-        'gemini-1.5-pro-latest',
-        'gemini-2.0-flash',
-        'gemini-2.0-flash-exp',
-        'gemini-flash-latest',
-        'gemini-1.5-flash-8b-latest'
-    ]
 
-    # เลือกใช้คีย์ทั้งหมดที่มีในระบบ
-    keys_to_try = GEMINI_API_KEYS.copy() if GEMINI_API_KEYS else [os.getenv('GEMINI_API_KEY')]
-    
-    # สลับลำดับคีย์แบบสุ่ม เพื่อกระจายการใช้งานไม่ให้คีย์ใดคีย์หนึ่งทำงานหนักเกินไป
-    import random
-    random.shuffle(keys_to_try)
+    # ตรวจสอบแคชก่อน: หากเคยวิเคราะห์ Prompt และไฟล์เสียงเดียวกันแล้ว ให้คืนค่าทันทีโดยไม่เปลืองโควตา
+    audio_hash = file_sha256(audio_path) if audio_path else None
+    if use_cache:
+        try:
+            cached = _lookup_cached_result(prompt, audio_hash, max_output_tokens, _prefer_models(GEMINI_MODELS, prefer_models))
+            if cached is not None:
+                if on_chunk:
+                    on_chunk(cached)
+                return cached
+        except Exception as e:
+            print(f"   ⚠️ ตรวจสอบแคชไม่สำเร็จ: {e}")
+            use_cache = False
+
+    # ตรวจรายชื่อโมเดลครั้งแรก (ใช้ผลจากแคช) แล้วตัดโมเดลที่ใช้งานไม่ได้ออก
+    models_to_try = _prefer_models(GEMINI_MODEL_REGISTRY.models_to_try(GEMINI_KEY_POOL.keys[0] if GEMINI_KEY_POOL.keys else None), prefer_models)
+
+    # ประมาณ Token ของคำขอเพื่อให้ตัวจัดสรรคีย์คุมโควตา TPM ได้
+    estimated_tokens = estimate_text_tokens(prompt) + estimate_audio_tokens(audio_path)
+    attempt_args = (prompt, audio_path, audio_hash, max_output_tokens, use_cache, response_schema)
+
+    # ติดตามว่ามีข้อความถูกส่งให้ผู้รับไปแล้วหรือยัง เพื่อแจ้งเริ่ม Stream ใหม่เมื่อต้องลองคีย์/โมเดลอื่น
+    stream_state = {'emitted': False}
+    def forward_chunk(text):
+        stream_state['emitted'] = True
+        return on_chunk(text)
     
     last_error = None
-    for model_name in models_to_try: # วนลูปตามรุ่นของโมเดล (เริ่มจาก Flash ที่เร็วที่สุด)
-        for api_key in keys_to_try: # วนลูปตาม API Key ที่มี
-            try:
-                genai.configure(api_key=api_key)
-                model = genai.GenerativeModel(model_name)
-                
-                content_payload = [prompt]
-                if audio_path:
-                    ext = os.path.splitext(audio_path)[1].lower()
-                    mime_type = 'audio/mp3' if ext == '.mp3' else f'audio/{ext[1:]}' if ext else 'audio/mp4'
-                    audio_file = genai.upload_file(audio_path, mime_type=mime_type)
-                    
-                    # รอการประมวลผลไฟล์ (ใช้เวลารอช่วงสั้นๆ 1 วินาที เพื่อความเร็ว)
-                    file_status = genai.get_file(audio_file.name)
-                    waited = 0
-                    while file_status.state.name == "PROCESSING" and waited < 30:
-                        time.sleep(1); waited += 1
-                        file_status = genai.get_file(audio_file.name)
-                    
-                    if file_status.state.name == "FAILED": continue
-                    content_payload.append(audio_file)
-                
-                response = model.generate_content(content_payload, 
-                                                 generation_config={"max_output_tokens": max_output_tokens, "temperature": 0.0})
-                
-                # ลบไฟล์ทิ้งหลังใช้งานเสร็จ (Cleanup)
-                if audio_path:
-                    try: genai.delete_file(audio_file.name)
-                    except: pass
-                
-                return response.text.strip()
-            except Exception as e:
-                last_error = e
-                if "429" in str(e): continue
-                if "404" in str(e).lower(): break # Try next model
-                continue
+    for model_index, model_name in enumerate(models_to_try): # วนลูปตามรุ่นของโมเดล (เริ่มจาก Flash ที่เร็วที่สุด)
+        # Circuit อาจถูกเปิดโดยเธรดอื่นระหว่างที่กำลังไล่โมเดลก่อนหน้า
+        if not GEMINI_MODEL_REGISTRY.is_available(model_name): continue
+        tried_keys = set()
+        # หากทุกคีย์ของโมเดลนี้กำลังพัก ให้ข้ามไปโมเดลถัดไปทันที (รอเฉพาะโมเดลสุดท้าย)
+        max_wait = 30 if model_index == len(models_to_try) - 1 else 0
+        while True: # ขอคีย์ที่สุขภาพดีที่สุดจาก Key Pool ทีละคีย์ จนกว่าจะลองครบทุกคีย์
+            api_key = GEMINI_KEY_POOL.acquire(estimated_tokens, exclude=tried_keys, max_wait=max_wait, scope=model_name)
+            if api_key is None: break
+            tried_keys.add(api_key)
+
+            if on_chunk and stream_state['emitted']:
+                # แจ้งผู้รับว่าเริ่ม Stream ใหม่ เพราะรอบก่อนหน้าส่งข้อความไปบางส่วนแล้วล้มเหลว
+                on_chunk(None)
+                stream_state['emitted'] = False
+
+            threshold = None
+            if GEMINI_HEDGE_ENABLED and on_chunk and len(GEMINI_KEY_POOL.keys) > 1:
+                threshold = GEMINI_LATENCY.threshold(api_key, _latency_scope(model_name, audio_path, max_output_tokens, True), GEMINI_HEDGE_PERCENTILE)
+            if threshold is None:
+                result_text, aborted, error = _run_attempt(api_key, model_name, *attempt_args, on_chunk=forward_chunk if on_chunk else None)
+            else:
+                result_text, aborted, error = _run_hedged_attempt(api_key, model_name, threshold, tried_keys, estimated_tokens, attempt_args, forward_chunk)
+
+            if result_text is not None:
+                return result_text
+            if error is None: continue # อัปโหลดไฟล์ไม่สำเร็จ ลองคีย์ถัดไป
+            last_error = error
+            if "429" in str(error): continue
+            if "404" in str(error).lower(): break # Try next model
     
     return {"error": f"API_QUOTA_EXCEEDED: {last_error}"}
 
@@ -392,15 +681,13 @@ def improve_readability_with_gemini(transcript, title="", duration=None):
     """
     ใช้ Google Gemini เพื่อจัดรูปแบบบทบรรยายให้อ่านง่ายขึ้น
     """
-    import google.generativeai as genai
     api_key = os.getenv('GEMINI_API_KEY')
     if not api_key: return transcript
     
     duration_str = f" [ความยาว: {duration}]" if duration else ""
     
     try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-flash-latest', generation_config={"temperature": 0.0})
+        model = GEMINI_CLIENTS.model(api_key, 'gemini-flash-latest', generation_config={"temperature": 0.0})
         prompt = f"""จากเนื้อหาคำบรรยายวิดีโอต่อไปนี้ ให้ช่วยจัดเรียงใหม่ให้อ่านง่ายที่สุด (Format for Readability)
   
   ชื่อวิดีโอ: {title}{duration_str}
@@ -426,14 +713,8 @@ def improve_readability_with_gemini(transcript, title="", duration=None):
 
 
 
-def process_audio_with_gemini(audio_path, transcript_hint="", title="", diarize=False, duration=None, duration_seconds=0):
-    """
-    อัปโหลดไฟล์เสียงไปยัง Gemini เพื่อสร้างบทบรรยายและบทสรุป
-    transcript_hint: ข้อความคู่มือจาก YouTube เพื่อช่วยเรื่องความถูกต้องของสะกดและเวลา
-    """
-    import google.generativeai as genai
-    
-    # ตรวจสอบขนาดไฟล์ก่อน (Gemini มีขีดจำกัด)
+def check_audio_file_size(audio_path):
+    """ตรวจสอบขนาดไฟล์ก่อนอัปโหลด (Gemini มีขีดจำกัด) หากใหญ่เกินจะโยน FILE_TOO_LARGE"""
     file_size_mb = os.path.getsize(audio_path) / (1024*1024)
     MAX_FILE_SIZE_MB = 2000  # ขีดจำกัดของ Gemini คือประมาณ 2GB
     
@@ -441,12 +722,12 @@ def process_audio_with_gemini(audio_path, transcript_hint="", title="", diarize=
         error_msg = f"ไฟล์ใหญ่เกินไป ({file_size_mb:.1f} MB) - ขีดจำกัดคือ {MAX_FILE_SIZE_MB} MB"
         print(f"❌ {error_msg}")
         raise Exception(f"FILE_TOO_LARGE: {error_msg}")
-    
-    # เตรียมไฟล์เสียงเพื่ออัปโหลด
-    ext = os.path.splitext(audio_path)[1].lower()
-    mime_type = 'audio/mp4' if not ext else f'audio/{ext[1:]}'
-    if ext == '.mp3': mime_type = 'audio/mp3'
-    
+
+def build_audio_analysis_prompt(transcript_hint="", title="", diarize=False, duration=None, duration_seconds=0, include_header=True):
+    """
+    สร้าง Prompt สำหรับวิเคราะห์ไฟล์เสียง ([SUMMARY], [TOPICS], [TRANSCRIPT])
+    include_header=False: ขอเฉพาะ [TRANSCRIPT] (ใช้คู่กับ build_summary_topics_prompt ในโหมดแยกคำขอ)
+    """
     # ปรับจูน Prompt ให้ทำงานได้รวดเร็วที่สุดโดยลดภาระการวิเคราะห์ของผู้พูด (Simplified for Speed)
     system_instruction = "คุณคือผู้เชี่ยวชาญด้านการวิเคราะห์เสียง (Audio Forensic) และการแยกผู้พูด (Diarization) ที่แม่นยำที่สุด"
     
@@ -460,10 +741,9 @@ def process_audio_with_gemini(audio_path, transcript_hint="", title="", diarize=
 4. **ระบุชื่อจริง**: หากในบทสนทนามีการเอ่ยชื่อกัน ให้ใช้ชื่อจริง (เช่น คุณโต้ง, อาจารย์เอก) แทนตัวเลข เพื่อความแม่นยำทางนิติวิทยาศาสตร์เสียง
 5. **Silence Detection**: เมื่อพบช่วงเงียบ (Silence/Pause) เกิน 2 วินาที ให้ปิดช่วงบทสนทนานั้น"""
 
-    prompt = f"""{system_instruction}
-จากไฟล์เสียงที่แนบมานี้ ให้สรุปและถอดความตามคำสั่งดังนี้:
-{diarize_instruction}
-
+    header_sections = ""
+    if include_header:
+        header_sections = """
 [SUMMARY]
 สรุปใจความสำคัญเป็นย่อเดียว 3-5 บรรทัด (ห้ามใส่ Timestamp)
 
@@ -473,7 +753,13 @@ def process_audio_with_gemini(audio_path, transcript_hint="", title="", diarize=
 1. คัดเฉพาะหัวข้อใหญ่จริงๆ ห้ามถี่เกินไป
 2. ชื่อหัวข้อต้อง "สั้น กระชับ" ห้ามใช้เลขข้อ
 3. รูปแบบ: [เวลาเริ่มต้น] ชื่อหัวข้อ
+"""
+    task_line = "ให้สรุปและถอดความตามคำสั่งดังนี้:" if include_header else "ให้ถอดความเฉพาะส่วน [TRANSCRIPT] ตามคำสั่งดังนี้ (ห้ามเขียนบทสรุปหรือหัวข้อ):"
 
+    prompt = f"""{system_instruction}
+จากไฟล์เสียงที่แนบมานี้ {task_line}
+{diarize_instruction}
+{header_sections}
 [TRANSCRIPT] (ความยาววิดีโอ: {duration if duration else "Unknown"})
 ถอดความระดับ """"""Frame-Perfect Structural Alignment & Segment Summarization""""""
 กฎสากล: คุณต้องแทรกบทสรุปย่อย `> [สรุปช่วงนี้: ...]` เป็นระยะๆ เท่านั้น (เช่น เมื่อจบประเด็นสำคัญจริงๆ หรือทุกๆ 1-2 นาที) 
@@ -502,17 +788,512 @@ def process_audio_with_gemini(audio_path, transcript_hint="", title="", diarize=
 คำใบ้บทบรรยายเดิม (Transcript Hint - จัดรูปแบบให้ตรงเทมเพลต):
 {transcript_hint}
 """
+    return prompt
 
-    # --- วิเคราะห์ด้วย GEMINI (พร้อมระบบลองใหม่และอัปโหลดภายใน) ---
-    print(f"   🤖 กำลังวิเคราะห์เนื้อหาเสียงด้วยระบบหลาย API Key...")
-    ai_analysis_result = call_gemini_with_retry(prompt, audio_path=audio_path, max_output_tokens=65536)
-    
+# รูปแบบ Timestamp ในบรรทัดบทบรรยาย: [เริ่ม] TO [จบ] หรือ [เริ่ม] อย่างเดียว
+_TRANSCRIPT_TS_PATTERN = re.compile(r'\[(\d{1,2}:\d{2}(?::\d{2})?(?:\.\d+)?)\](?:\s*[tT][oO]\s*\[(\d{1,2}:\d{2}(?::\d{2})?(?:\.\d+)?)\])?')
+
+def last_transcript_timestamp(text):
+    """หา Timestamp สุดท้ายในบทบรรยาย (ใช้เวลาสิ้นสุดหากมี) คืนค่า None หากไม่พบ"""
+    for line in reversed(text.strip().split('\n')):
+        match = _TRANSCRIPT_TS_PATTERN.search(line)
+        if match:
+            return match.group(2) or match.group(1)
+    return None
+
+def build_continuation_prompt(prompt, partial_text, resume_ts):
+    """สร้าง Prompt สำหรับขอบทบรรยายต่อจากเวลาที่กำหนด (ใช้เมื่อผลลัพธ์รอบก่อนถูกตัดหรือวนซ้ำ)"""
+    last_lines = '\n'.join([l for l in partial_text.strip().split('\n') if l.strip()][-3:])
+    return f"""{prompt}
+
+--- คำสั่งต่อเนื่อง (Continuation) ---
+ผลลัพธ์รอบก่อนหน้าถูกตัดไว้ที่เวลา [{resume_ts}] ให้ถอดความเฉพาะส่วน [TRANSCRIPT] ต่อจากเวลานี้จนจบไฟล์เสียง
+ห้ามเขียน [SUMMARY] หรือ [TOPICS] ซ้ำ และห้ามทวนบรรทัดที่ถอดไว้แล้ว บรรทัดสุดท้ายที่มีอยู่แล้วคือ:
+{last_lines}
+ให้เริ่มตอบด้วยบรรทัดถัดไปในรูปแบบเดียวกันทันที
+"""
+
+def merge_continuation(partial_text, continuation_text, resume_ts):
+    """ต่อบทบรรยายส่วนที่ขอเพิ่ม โดยตัดหัวข้อส่วนต่างๆ และบรรทัดที่เริ่มก่อนเวลา resume_ts ออก (ป้องกันบรรทัดซ้ำ)"""
+    resume_seconds = parse_timestamp_to_seconds(resume_ts) or 0
+    kept = []
+    for line in continuation_text.split('\n'):
+        stripped = line.strip()
+        if re.match(r'^(?:\*\*)?\[?\s*(?:SUMMARY|TOPICS|TRANSCRIPT)\s*(?:\]|:|\*\*)', stripped, re.IGNORECASE):
+            continue
+        match = _TRANSCRIPT_TS_PATTERN.search(stripped)
+        if match and not kept and (parse_timestamp_to_seconds(match.group(1)) or 0) < resume_seconds:
+            continue
+        if stripped or kept:
+            kept.append(line)
+    return partial_text.rstrip('\n') + '\n' + '\n'.join(kept).strip()
+
+# จำนวนครั้งสูงสุดที่จะขอบทบรรยายต่อ (หลังตรวจพบการวนซ้ำ / หลังผลลัพธ์ถูกตัดเพราะ Token หมด)
+MAX_LOOP_CONTINUATIONS = int(os.getenv('GEMINI_MAX_LOOP_CONTINUATIONS', '2'))
+MAX_TRUNCATION_CONTINUATIONS = int(os.getenv('GEMINI_MAX_TRUNCATION_CONTINUATIONS', '4'))
+# finish_reason ที่ระบบตั้งเองเมื่อได้บทบรรยายไม่ครบ (ขอต่อจนครบไม่ได้ ถูกตัดเพราะวนซ้ำ หรือบางช่วงถอดความไม่สำเร็จ)
+INCOMPLETE_FINISH_REASON = "INCOMPLETE"
+# ข้อความแทนช่วงที่ถอดความไม่สำเร็จในผลลัพธ์แบบแบ่งช่วง
+FAILED_CHUNK_MARKER = "ช่วงที่ถอดความไม่สำเร็จ"
+
+def is_transcript_truncated(result_text, duration_seconds=0):
+    """
+    ตรวจว่าบทบรรยายจบก่อนเวลาจริงหรือไม่
+    - โมเดลหยุดเพราะ Token หมด (finish_reason = MAX_TOKENS)
+    - หรือ Timestamp สุดท้ายยังห่างจากความยาววิดีโอเกินเกณฑ์ (อย่างน้อย 60 วินาที หรือ 10% ของความยาว)
+    """
+    if getattr(result_text, 'is_truncated', False):
+        return True
+    if not duration_seconds:
+        return False
+    last_ts = last_transcript_timestamp(result_text)
+    if not last_ts:
+        return False
+    last_seconds = parse_timestamp_to_seconds(last_ts) or 0
+    return duration_seconds - last_seconds > max(60, duration_seconds * 0.1)
+
+def generate_with_continuations(prompt, audio_path=None, max_output_tokens=65536, on_transcript_line=None, duration_seconds=0, prefer_models=None):
+    """
+    เรียก Gemini แบบ Streaming แล้วขอบทบรรยายต่อโดยอัตโนมัติ จนได้บทบรรยายครบทั้งคลิป
+    - ตรวจจับอาการวนซ้ำ (Hallucination Loop) และยกเลิกคำขอทันทีที่พบ แทนการรอให้โมเดลใช้ Token จนหมด
+    - ตรวจจับผลลัพธ์ที่ถูกตัด (MAX_TOKENS หรือ Timestamp สุดท้ายไม่ถึงความยาววิดีโอ)
+    ทั้งสองกรณีจะขอถอดความต่อจาก Timestamp สุดท้ายที่ยังถูกต้อง แล้วรวมผลลัพธ์เข้าด้วยกัน
+    """
+    line_stream = TranscriptLineStream(on_transcript_line) if on_transcript_line else None
+    detector = RepetitionDetector()
+
+    def on_chunk(text):
+        if text is None:
+            detector.reset()
+        if line_stream:
+            line_stream.feed(text)
+        return True if text is None else detector.feed(text)
+
+    raw_result = call_gemini_with_retry(prompt, audio_path=audio_path, max_output_tokens=max_output_tokens, on_chunk=on_chunk, prefer_models=prefer_models)
+
+    base_text, resume_ts = "", None
+    loop_count, truncation_count = 0, 0
+    while isinstance(raw_result, str):
+        looped = detector.triggered
+        # ส่วนที่ยังถูกต้องของคำขอล่าสุด (ก่อนเริ่มวนซ้ำ) รวมกับผลลัพธ์ของคำขอก่อนหน้า
+        good_text = detector.good_text() if looped else raw_result
+        if not looped and getattr(raw_result, 'is_truncated', False) and '\n' in good_text:
+            good_text = good_text[:good_text.rfind('\n') + 1]  # ตัดบรรทัดสุดท้ายที่ถูกตัดกลางประโยคออก
+        if resume_ts:
+            good_text = merge_continuation(base_text, good_text, resume_ts)
+
+        if looped:
+            loop_count += 1
+            exhausted = loop_count > MAX_LOOP_CONTINUATIONS
+            reason = "ตรวจพบการวนซ้ำของโมเดล ยกเลิกคำขอและ"
+        elif getattr(raw_result, 'is_truncated', False) or is_transcript_truncated(good_text, duration_seconds):
+            truncation_count += 1
+            exhausted = truncation_count > MAX_TRUNCATION_CONTINUATIONS
+            reason = "บทบรรยายถูกตัดก่อนจบคลิป "
+        else:
+            ai_analysis_result = good_text
+            break
+
+        next_ts = last_transcript_timestamp(good_text)
+        if exhausted or not next_ts or next_ts == resume_ts:
+            # ไม่สามารถขอต่อได้ (หรือไม่คืบหน้า) ใช้เฉพาะส่วนที่ได้มาแล้ว
+            print(f"   ⚠️ {reason}ไม่สามารถขอต่อได้ ใช้ผลลัพธ์ที่มี ({len(good_text)} ตัวอักษร)")
+            ai_analysis_result = GeminiText(good_text.strip(), INCOMPLETE_FINISH_REASON)
+            break
+
+        base_text, resume_ts = good_text, next_ts
+        print(f"   🔁 {reason}ถอดความต่อจาก [{resume_ts}] (ต่อรอบที่ {loop_count + truncation_count})")
+        detector.reset()
+        if line_stream:
+            line_stream.continue_transcript()
+        raw_result = call_gemini_with_retry(build_continuation_prompt(prompt, base_text, resume_ts), audio_path=audio_path, max_output_tokens=max_output_tokens, on_chunk=on_chunk, prefer_models=prefer_models)
+    else:
+        # คำขอล้มเหลว: หากมีผลลัพธ์จากรอบก่อนหน้าให้ใช้ส่วนนั้น
+        ai_analysis_result = GeminiText(base_text.strip(), INCOMPLETE_FINISH_REASON) if base_text else raw_result
+
+    if line_stream:
+        line_stream.close()
     return ai_analysis_result
 
+# --- STRUCTURED OUTPUT: ให้โมเดลตอบเป็น JSON ตาม Schema แล้วแยกเป็นส่วนๆ ได้ทันที (เปิดด้วย GEMINI_JSON_OUTPUT=1) ---
+# โหมดนี้ไม่ Stream บรรทัดบทบรรยายระหว่างสร้าง และหากผลลัพธ์ถูกตัดหรือแยก JSON ไม่ได้ จะกลับไปใช้รูปแบบแท็กเดิม
+GEMINI_JSON_OUTPUT = os.getenv('GEMINI_JSON_OUTPUT', '0') == '1'
+
+_TOPIC_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "start": {"type": "STRING", "description": "เวลาเริ่มต้นของหัวข้อ HH:MM:SS"},
+        "title": {"type": "STRING"},
+        "description": {"type": "STRING"}
+    },
+    "required": ["start", "title"]
+}
+_SEGMENT_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "kind": {"type": "STRING", "enum": ["speech", "summary", "silence"]},
+        "start": {"type": "STRING", "description": "HH:MM:SS.mmm"},
+        "end": {"type": "STRING", "description": "HH:MM:SS.mmm"},
+        "speaker": {"type": "STRING"},
+        "text": {"type": "STRING"}
+    },
+    "required": ["kind", "start", "end", "text"]
+}
+
+def build_response_schema(summary=True, topics=True, segments=True):
+    """สร้าง Response Schema เฉพาะส่วนที่ต้องการ (summary / topics / segments)"""
+    properties = {}
+    if summary:
+        properties["summary"] = {"type": "STRING"}
+    if topics:
+        properties["topics"] = {"type": "ARRAY", "items": _TOPIC_SCHEMA}
+    if segments:
+        properties["segments"] = {"type": "ARRAY", "items": _SEGMENT_SCHEMA}
+    return {"type": "OBJECT", "properties": properties, "required": list(properties)}
+
+def build_json_output_instruction(schema):
+    """คำสั่งต่อท้าย Prompt แบบแท็ก เพื่อให้ตอบเป็น JSON ตาม Schema โดยใช้กฎเนื้อหาเดิม"""
+    fields = {
+        "summary": "- summary: เนื้อหาของส่วน [SUMMARY]",
+        "topics": "- topics: รายการหัวข้อของส่วน [TOPICS] (start, title, description)",
+        "segments": "- segments: บรรทัดบทบรรยายของส่วน [TRANSCRIPT] ทีละบรรทัด (kind: speech = คำพูด, summary = สรุปช่วงนี้, silence = ช่วงเงียบ)",
+    }
+    lines = [fields[name] for name in schema["properties"]]
+    return "\n\nรูปแบบคำตอบ: ตอบเป็น JSON ตาม Schema ที่กำหนดแทนรูปแบบแท็ก โดยใช้กฎเนื้อหาทั้งหมดด้านบน\n" + "\n".join(lines) + "\n"
+
+def render_segment(segment):
+    """แปลง Segment จากโหมด JSON กลับเป็นบรรทัดบทบรรยายรูปแบบมาตรฐาน"""
+    kind = segment.get('kind') or 'speech'
+    text = str(segment.get('text') or '').strip()
+    if kind == 'summary':
+        return f"> [สรุปช่วงนี้: {text}]"
+    if kind == 'silence':
+        return f"> [ช่วงเงียบ: {text or (str(segment.get('start', '')) + ' TO ' + str(segment.get('end', '')))}]"
+    return f"- **[{segment.get('start', '')}] TO [{segment.get('end', '')}] {str(segment.get('speaker') or '').strip()}** : {text}"
+
+def parse_structured_response(result_text, duration=None):
+    """
+    แปลงผลลัพธ์ JSON เป็นข้อความรูปแบบแท็กมาตรฐาน (ใช้กับขั้นตอนเดิมได้ทันที)
+    พร้อมแนบส่วนที่แยกแล้ว (summary, topics, transcript, segments) ไว้ใน .sections คืนค่า None หากแยก JSON ไม่ได้
+    """
+    try:
+        data = json.loads(result_text)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(data, dict):
+        return None
+
+    sections = {'summary': None, 'topics': None, 'transcript': None, 'segments': None}
+    parts = []
+    if 'summary' in data:
+        sections['summary'] = str(data.get('summary') or '').strip()
+        parts.append(f"[SUMMARY]\n{sections['summary']}")
+    if 'topics' in data:
+        sections['topics'] = [
+            f"[{t.get('start', '')}] {str(t.get('title') or '').strip()}" + (f": {str(t['description']).strip()}" if t.get('description') else "")
+            for t in data.get('topics') or [] if isinstance(t, dict)]
+        parts.append("[TOPICS]\n" + '\n'.join(sections['topics']))
+    if 'segments' in data:
+        sections['segments'] = [seg for seg in data.get('segments') or [] if isinstance(seg, dict)]
+        sections['transcript'] = '\n'.join(render_segment(seg) for seg in sections['segments'])
+        parts.append(f"[TRANSCRIPT] (ความยาววิดีโอ: {duration if duration else 'Unknown'})\n{sections['transcript']}")
+    return GeminiText('\n\n'.join(parts), getattr(result_text, 'finish_reason', None), sections=sections)
+
+def call_gemini_structured(prompt, schema, audio_path=None, max_output_tokens=2048, prefer_models=None, duration=None):
+    """
+    เรียก Gemini ในโหมด JSON แล้วแปลงผลเป็นรูปแบบแท็ก (parse_structured_response)
+    คืนค่า None เมื่อคำขอล้มเหลว ผลลัพธ์ถูกตัด (JSON ไม่ครบ) หรือแยก JSON ไม่ได้ เพื่อให้ผู้เรียกใช้โหมดแท็กแทน
+    """
+    result = call_gemini_with_retry(prompt + build_json_output_instruction(schema), audio_path=audio_path,
+                                    max_output_tokens=max_output_tokens, prefer_models=prefer_models, response_schema=schema)
+    if not isinstance(result, str):
+        return None
+    if getattr(result, 'is_truncated', False):
+        print("   ⚠️ ผลลัพธ์ JSON ถูกตัด (MAX_TOKENS) จะใช้รูปแบบแท็กที่ขอต่อได้แทน")
+        return None
+    parsed = parse_structured_response(result, duration)
+    if parsed is None:
+        print("   ⚠️ แยกผลลัพธ์ JSON ไม่ได้ จะใช้รูปแบบแท็กแทน")
+    return parsed
+
+def request_summary_topics(prompt, audio_path=None, duration=None):
+    """ขอเฉพาะ [SUMMARY]/[TOPICS] ด้วยโมเดลที่เร็ว (โหมด JSON หากเปิดไว้) คืนค่าข้อความรูปแบบแท็ก หรือ dict error"""
+    if GEMINI_JSON_OUTPUT:
+        structured = call_gemini_structured(prompt, build_response_schema(segments=False), audio_path=audio_path,
+                                            max_output_tokens=4096, prefer_models=GEMINI_FAST_MODELS, duration=duration)
+        if structured is not None:
+            return structured
+    return call_gemini_with_retry(prompt, audio_path=audio_path, max_output_tokens=4096, prefer_models=GEMINI_FAST_MODELS)
+
+def generate_analysis(prompt, audio_path=None, max_output_tokens=65536, on_transcript_line=None, duration=None, duration_seconds=0, schema=None, prefer_models=None):
+    """
+    ขอผลการวิเคราะห์ที่มีบทบรรยาย: โหมด JSON (ตาม schema) หากเปิดไว้ มิฉะนั้น/หากล้มเหลวจะใช้ generate_with_continuations
+    โหมด JSON จะส่งบรรทัดบทบรรยายให้ on_transcript_line หลังจากได้ผลลัพธ์ครบแล้วเท่านั้น
+    """
+    if GEMINI_JSON_OUTPUT and schema:
+        structured = call_gemini_structured(prompt, schema, audio_path=audio_path, max_output_tokens=max_output_tokens, prefer_models=prefer_models, duration=duration)
+        if structured is not None:
+            if on_transcript_line:
+                for line in (structured.sections['transcript'] or '').split('\n'):
+                    if line.strip(): on_transcript_line(line.strip())
+            return structured
+    return generate_with_continuations(prompt, audio_path=audio_path, max_output_tokens=max_output_tokens, on_transcript_line=on_transcript_line, duration_seconds=duration_seconds, prefer_models=prefer_models)
+
+def plan_gemini_request(prompt, audio_path=None, duration_seconds=0, expected_output_tokens=None, max_chunk_seconds=None, verbose=True):
+    """
+    วางแผนคำขอก่อนส่งด้วย GEMINI_TOKEN_PLANNER (นับ Prompt ทั้งหมดรวม transcript_hint และเสียง)
+    expected_output_tokens: หากไม่กำหนด จะประมาณจากความยาวบทบรรยายของ duration_seconds
+    """
+    models = GEMINI_MODEL_REGISTRY.models_to_try(GEMINI_KEY_POOL.keys[0] if GEMINI_KEY_POOL.keys else None)
+    audio_tokens = 0
+    if audio_path:
+        audio_tokens = int(duration_seconds * 32) if duration_seconds else estimate_audio_tokens(audio_path)
+    input_tokens = estimate_text_tokens(prompt) + audio_tokens
+    if expected_output_tokens is None:
+        expected_output_tokens = GEMINI_TOKEN_PLANNER.expected_transcript_tokens(duration_seconds)
+    plan = GEMINI_TOKEN_PLANNER.plan(models, input_tokens, expected_output_tokens, duration_seconds, max_chunk_seconds=max_chunk_seconds)
+    if verbose:
+        detail = f"แบ่งช่วงละ {format_time(plan['chunk_seconds'])}" if plan['strategy'] == 'chunked' else f"{plan['models'][0]}, Output ≤ {plan['max_output_tokens']:,}"
+        print(f"   📐 แผน Token: ขาเข้า ~{input_tokens:,} | ขาออก ~{expected_output_tokens:,} -> {detail}")
+    return plan
+
+# --- SPLIT ANALYSIS: แยกคำขอบทบรรยาย กับคำขอบทสรุป/หัวข้อ แล้วส่งพร้อมกัน ---
+# บทสรุปและหัวข้อไม่ต้องรอ Token บทบรรยายนับหมื่น และใช้โมเดลที่เร็วกว่าได้ (เปิดได้ด้วย GEMINI_SPLIT_ANALYSIS=1)
+# ปิดไว้เป็นค่าเริ่มต้น เพราะในโหมดเสียงจะส่งไฟล์เสียงทั้งไฟล์สองครั้ง (ใช้ Token ขาเข้าและโควตาเป็นสองเท่า)
+GEMINI_SPLIT_ANALYSIS = os.getenv('GEMINI_SPLIT_ANALYSIS', '0') == '1'
+GEMINI_FAST_MODELS = [m.strip() for m in os.getenv('GEMINI_FAST_MODELS', 'gemini-2.0-flash,gemini-flash-latest,gemini-1.5-flash-8b-latest').split(',') if m.strip()]
+
+def run_split_analysis(transcript_prompt, header_prompt, audio_path=None, max_output_tokens=65536, on_transcript_line=None, duration=None, duration_seconds=0, prefer_models=None):
+    """
+    ส่งคำขอบทบรรยาย (ยาว) และคำขอ [SUMMARY]/[TOPICS] (สั้น, โมเดลเร็ว) พร้อมกัน
+    Key Pool จะกระจายสองคำขอไปยังคีย์ที่ว่างต่างกัน แล้วรวมผลเป็นรูปแบบแท็กเดียวกับคำขอรวม
+    """
+    parts = {}
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        future_to_part = {
+            executor.submit(request_summary_topics, header_prompt, audio_path=audio_path, duration=duration): 'header',
+            executor.submit(generate_analysis, transcript_prompt, audio_path=audio_path, max_output_tokens=max_output_tokens, on_transcript_line=on_transcript_line,
+                            duration=duration, duration_seconds=duration_seconds, schema=build_response_schema(summary=False, topics=False), prefer_models=prefer_models): 'transcript',
+        }
+        for future in as_completed(future_to_part):
+            part = future_to_part[future]
+            parts[part] = future.result()
+            if part == 'header' and 'transcript' not in parts and isinstance(parts['header'], str):
+                print("   ⚡ ได้บทสรุปและหัวข้อแล้ว (ระหว่างรอบทบรรยาย)")
+    transcript, header = parts['transcript'], parts['header']
+
+    if not isinstance(transcript, str):
+        return transcript
+    if not isinstance(header, str):
+        print(f"   ⚠️ ขอบทสรุป/หัวข้อไม่สำเร็จ: {header.get('error') if isinstance(header, dict) else header}")
+        header = ""
+    # ส่วนที่แยกไว้แล้วจากโหมด JSON (บทบรรยายเป็น Segment) ถูกรวมไปกับผลลัพธ์ด้วย
+    sections = None
+    if getattr(transcript, 'sections', None):
+        header_sections = parse_ai_sections(header) if header else {}
+        sections = {**transcript.sections, 'summary': header_sections.get('summary'), 'topics': header_sections.get('topics')}
+    if not re.search(r'\[TRANSCRIPT\]', transcript, re.IGNORECASE):
+        transcript = f"[TRANSCRIPT] (ความยาววิดีโอ: {duration if duration else 'Unknown'})\n{transcript}"
+    return GeminiText(f"{header.strip()}\n\n{transcript.strip()}".strip(), getattr(transcript, 'finish_reason', None), sections=sections)
+
+# --- LONG AUDIO: แบ่งไฟล์เสียงยาวเป็นช่วงแล้วถอดความพร้อมกันหลาย API Key ---
+# ไฟล์ที่ยาวกว่าเกณฑ์จะถูกตัดที่ช่วงเงียบเป็นช่วงละ GEMINI_CHUNK_MINUTES นาที (มีส่วนเหลื่อมกันเล็กน้อย)
+GEMINI_CHUNK_THRESHOLD_SECONDS = float(os.getenv('GEMINI_CHUNK_THRESHOLD_MINUTES', '30')) * 60
+GEMINI_CHUNK_SECONDS = float(os.getenv('GEMINI_CHUNK_MINUTES', '10')) * 60
+GEMINI_CHUNK_OVERLAP_SECONDS = float(os.getenv('GEMINI_CHUNK_OVERLAP_SECONDS', '5'))
+
+def build_chunk_transcript_prompt(title="", diarize=False, chunk=None, transcript_hint=""):
+    """สร้าง Prompt สำหรับถอดความไฟล์เสียงหนึ่งช่วง (ขอเฉพาะบทบรรยาย เวลาเริ่มนับจาก 00:00:00.000 ของช่วงนี้)"""
+    chunk_length = format_time(chunk['end'] - chunk['start']) if chunk else "Unknown"
+    diarize_instruction = ""
+    if diarize:
+        diarize_instruction = """
+- แยกผู้พูดจากโทนเสียงและจังหวะการพูด หากเสียงเปลี่ยนให้ขึ้นบรรทัดใหม่และระบุ '**ผู้พูดคนที่ X**' หรือชื่อจริงหากมีการเอ่ยชื่อ"""
 
-def process_text_with_gemini(transcript, title="", diarize=False, duration=None, duration_seconds=0):
+    return f"""คุณคือผู้เชี่ยวชาญด้านการถอดความจากไฟล์เสียง (Audio Transcription) ที่แม่นยำที่สุด
+ไฟล์เสียงที่แนบมาเป็นเพียง "ช่วงหนึ่ง" ของวิดีโอ "{title}" (ความยาวช่วงนี้: {chunk_length})
+ให้ถอดความเฉพาะบทบรรยาย ห้ามเขียนบทสรุปหรือหัวข้อ และห้ามใส่หัวข้อ [TRANSCRIPT]
+
+กฎเหล็ก:
+- เวลาทุกบรรทัดต้องนับจากจุดเริ่มต้นของไฟล์เสียงนี้ (00:00:00.000) ไม่ใช่เวลาของวิดีโอเต็ม
+- รูปแบบบังคับ: - **[HH:MM:SS.mmm] TO [HH:MM:SS.mmm] ชื่อผู้พูด** : ข้อความ
+- เวลาสิ้นสุดของบรรทัดก่อนหน้าต้องเท่ากับเวลาเริ่มต้นของบรรทัดถัดไป และห้ามเกินความยาวของไฟล์{diarize_instruction}
+- ถอดความตามเสียงจริงเท่านั้น ห้ามแต่งเติม ห้ามทวนข้อความซ้ำ
+
+คำใบ้บทบรรยายเดิมของช่วงนี้ (ถ้ามี):
+{transcript_hint}
+"""
+
+def shift_transcript_timestamps(text, offset_seconds, own_start=None, own_end=None):
     """
-    วิเคราะห์บทบรรยายจากข้อความโดยใช้ AI
+    เลื่อน Timestamp ทุกบรรทัดไปอีก offset_seconds (แปลงเวลาของช่วงเป็นเวลาของวิดีโอเต็ม)
+    และเก็บเฉพาะบรรทัดที่เริ่มในช่วง [own_start, own_end) เพื่อตัดข้อความซ้ำในส่วนเหลื่อม
+    บรรทัดที่ไม่มีเวลา (เช่น สรุปช่วงนี้) จะตามบรรทัดที่มีเวลาก่อนหน้า
+    """
+    kept = []
+    keep_current = own_start is None or own_start <= offset_seconds
+    for line in text.split('\n'):
+        stripped = line.strip()
+        if not stripped or re.match(r'^(?:\*\*)?\[?\s*(?:SUMMARY|TOPICS|TRANSCRIPT)\s*(?:\]|:|\*\*)', stripped, re.IGNORECASE):
+            continue
+        match = _TRANSCRIPT_TS_PATTERN.search(stripped)
+        if match:
+            start = (parse_timestamp_to_seconds(match.group(1)) or 0) + offset_seconds
+            keep_current = (own_start is None or start >= own_start) and (own_end is None or start < own_end)
+            # แทนที่เฉพาะ Timestamp ตัวแรก (เริ่ม TO จบ) ของบรรทัด
+            stripped = _TRANSCRIPT_TS_PATTERN.sub(
+                lambda m: f"[{format_time((parse_timestamp_to_seconds(m.group(1)) or 0) + offset_seconds)}]" + (
+                    f" TO [{format_time((parse_timestamp_to_seconds(m.group(2)) or 0) + offset_seconds)}]" if m.group(2) else ""),
+                stripped, count=1)
+        if keep_current:
+            kept.append(stripped)
+    return '\n'.join(kept)
+
+def slice_transcript_hint(transcript_hint, start, end):
+    """ดึงคำใบ้บทบรรยายเฉพาะช่วงเวลา [start, end) และเลื่อนเวลาให้เริ่มจาก 0 ตามไฟล์เสียงของช่วงนั้น"""
+    if not transcript_hint:
+        return ""
+    lines = []
+    for line in transcript_hint.split('\n'):
+        match = _TRANSCRIPT_TS_PATTERN.search(line)
+        if match and start <= (parse_timestamp_to_seconds(match.group(1)) or 0) < end:
+            lines.append(line)
+    return shift_transcript_timestamps('\n'.join(lines), -start)
+
+def build_summary_topics_prompt(transcript="", title="", duration=None):
+    """
+    สร้าง Prompt ขอเฉพาะ [SUMMARY] และ [TOPICS] จากบทบรรยายที่ถอดความเสร็จแล้ว
+    transcript ว่าง: ให้สรุปจากไฟล์เสียงที่แนบมาแทน (ใช้ในโหมดแยกคำขอที่ยังไม่มีบทบรรยาย)
+    """
+    source = "บทบรรยาย" if transcript else "ไฟล์เสียงที่แนบมา"
+    transcript_block = f"\nบทบรรยาย:\n{transcript}\n" if transcript else ""
+    return f"""จาก{source}ของวิดีโอ "{title}" (ความยาว: {duration if duration else "Unknown"}) ต่อไปนี้ ให้ตอบเฉพาะ 2 ส่วนตามรูปแบบแท็ก:
+
+[SUMMARY]
+สรุปใจความสำคัญเป็นย่อหน้าเดียว 3-5 บรรทัด (ห้ามใส่ Timestamp)
+
+[TOPICS]
+ดึงหัวข้อสำคัญ 5-8 หัวข้อ เรียงตามเวลา รูปแบบ: [HH:MM:SS] ชื่อหัวข้อสั้นๆ: คำอธิบาย 1 ประโยค
+
+ต้องตอบเป็นภาษาไทยเท่านั้น และห้ามเขียนบทบรรยายซ้ำ
+{transcript_block}"""
+
+def transcribe_audio_in_chunks(audio_path, transcript_hint="", title="", diarize=False, duration=None, duration_seconds=0, on_transcript_line=None, chunk_seconds=None):
+    """
+    ถอดความไฟล์เสียงยาวแบบขนาน: แบ่งที่ช่วงเงียบ -> ถอดความแต่ละช่วงพร้อมกันผ่าน Key Pool -> รวมผล
+    คืนค่าข้อความรูปแบบเดียวกับ process_audio_with_gemini ([SUMMARY], [TOPICS], [TRANSCRIPT])
+    คืนค่า None หากแบ่งไฟล์ไม่ได้หรือถอดความไม่สำเร็จทุกช่วง (ให้ผู้เรียกส่งไฟล์ทั้งไฟล์แทน)
+    """
+    import shutil
+    workspace = tempfile.mkdtemp(prefix="gemini_chunks_")
+    try:
+        try:
+            chunks = split_audio_at_silences(audio_path, workspace, target_seconds=chunk_seconds or GEMINI_CHUNK_SECONDS, overlap_seconds=GEMINI_CHUNK_OVERLAP_SECONDS,
+                                          profile=choose_audio_profile())
+        except Exception as e:
+            print(f"   ⚠️ แบ่งไฟล์เสียงไม่สำเร็จ จะส่งทั้งไฟล์แทน: {e}")
+            return None
+        if len(chunks) < 2:
+            return None
+
+        print(f"   ✂️ แบ่งไฟล์เสียงเป็น {len(chunks)} ช่วง และถอดความพร้อมกัน...")
+
+        def transcribe_chunk(chunk):
+            prompt = build_chunk_transcript_prompt(title, diarize, chunk, slice_transcript_hint(transcript_hint, chunk['start'], chunk['end']))
+            plan = plan_gemini_request(prompt, chunk['path'], chunk['end'] - chunk['start'], verbose=False)
+            result = generate_with_continuations(prompt, audio_path=chunk['path'], max_output_tokens=plan['max_output_tokens'],
+                                                 duration_seconds=chunk['end'] - chunk['start'], prefer_models=plan['models'])
+            if not isinstance(result, str):
+                return result
+            return GeminiText(shift_transcript_timestamps(result, chunk['start'], chunk['own_start'], chunk['own_end']), getattr(result, 'finish_reason', None))
+
+        transcripts = [None] * len(chunks)
+        next_to_emit = 0
+        # Key Pool เป็นผู้คุมอัตราการเรียกจริง จึงเปิดเธรดตามจำนวนคีย์ที่มี
+        with ThreadPoolExecutor(max_workers=max(1, min(len(chunks), len(GEMINI_KEY_POOL.keys)))) as executor:
+            future_to_index = {executor.submit(transcribe_chunk, chunk): i for i, chunk in enumerate(chunks)}
+            for future in as_completed(future_to_index):
+                i = future_to_index[future]
+                try:
+                    transcripts[i] = future.result()
+                except Exception as e:
+                    transcripts[i] = {"error": str(e)}
+                # ส่งบรรทัดให้ผู้ใช้ตามลำดับเวลา เมื่อช่วงก่อนหน้าทั้งหมดเสร็จแล้ว
+                while next_to_emit < len(chunks) and transcripts[next_to_emit] is not None:
+                    if on_transcript_line and isinstance(transcripts[next_to_emit], str):
+                        for line in transcripts[next_to_emit].split('\n'):
+                            if line.strip(): on_transcript_line(line.strip())
+                    next_to_emit += 1
+
+        failed = [i for i, t in enumerate(transcripts) if not isinstance(t, str)]
+        if len(failed) == len(chunks):
+            print(f"   ⚠️ ถอดความไม่สำเร็จทุกช่วง ({len(chunks)} ช่วง) จะส่งไฟล์ทั้งไฟล์แทน")
+            return None
+        parts = []
+        for chunk, transcript in zip(chunks, transcripts):
+            if isinstance(transcript, str):
+                parts.append(transcript)
+            else:
+                print(f"   ⚠️ ถอดความช่วง {format_time(chunk['own_start'])} ไม่สำเร็จ: {transcript.get('error')}")
+                parts.append(f"> [{FAILED_CHUNK_MARKER}: {format_time(chunk['own_start'])} TO {format_time(chunk['own_end'])}]")
+        stitched = '\n'.join(p for p in parts if p.strip())
+        incomplete = bool(failed) or any(getattr(t, 'finish_reason', None) == INCOMPLETE_FINISH_REASON for t in transcripts)
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    # ขอบทสรุปและหัวข้อจากบทบรรยายที่รวมแล้ว (คำขอข้อความขนาดเล็ก)
+    header = request_summary_topics(build_summary_topics_prompt(stitched, title, duration), duration=duration)
+    header = header if isinstance(header, str) else ""
+    return GeminiText(f"{header}\n\n[TRANSCRIPT] (ความยาววิดีโอ: {duration if duration else 'Unknown'})\n{stitched}".strip(),
+                      INCOMPLETE_FINISH_REASON if incomplete else None)
+
+def is_complete_analysis(result_text, transcript, duration_seconds=0):
+    """
+    ตรวจว่าผลถอดความครบถ้วนพอจะเก็บใน STAGE_CACHE หรือไม่
+    ไม่นับผลที่ถูกตัด (MAX_TOKENS / จบก่อนความยาวคลิป) ถูกตัดเพราะวนซ้ำ หรือมีช่วงที่ถอดความไม่สำเร็จ
+    """
+    if getattr(result_text, 'finish_reason', None) in ("MAX_TOKENS", INCOMPLETE_FINISH_REASON):
+        return False
+    if FAILED_CHUNK_MARKER in result_text:
+        return False
+    return not is_transcript_truncated(transcript, duration_seconds)
+
+def process_audio_with_gemini(audio_path, transcript_hint="", title="", diarize=False, duration=None, duration_seconds=0, on_transcript_line=None):
+    """
+    อัปโหลดไฟล์เสียงไปยัง Gemini เพื่อสร้างบทบรรยายและบทสรุป
+    transcript_hint: ข้อความคู่มือจาก YouTube เพื่อช่วยเรื่องความถูกต้องของสะกดและเวลา
+    on_transcript_line: หากกำหนด จะส่งบรรทัด [TRANSCRIPT] ทีละบรรทัดทันทีที่สร้างเสร็จ
+    ไฟล์ที่ยาวกว่า GEMINI_CHUNK_THRESHOLD_MINUTES จะถูกแบ่งเป็นช่วงและถอดความพร้อมกันหลายคีย์
+    """
+    check_audio_file_size(audio_path)
+
+    prompt = build_audio_analysis_prompt(transcript_hint, title, diarize=diarize, duration=duration, duration_seconds=duration_seconds, include_header=not GEMINI_SPLIT_ANALYSIS)
+    # วางแผนก่อนส่ง: หากไม่มีโมเดลใดรับบทบรรยายทั้งคลิปได้ในคำขอเดียว ให้แบ่งช่วงตั้งแต่แรกแทนการรอให้ถูกตัด
+    expected_tokens = GEMINI_TOKEN_PLANNER.expected_transcript_tokens(duration_seconds) + (0 if GEMINI_SPLIT_ANALYSIS else GEMINI_HEADER_OUTPUT_TOKENS)
+    plan = plan_gemini_request(prompt, audio_path, duration_seconds, expected_output_tokens=expected_tokens, max_chunk_seconds=GEMINI_CHUNK_SECONDS)
+
+    if plan['strategy'] == 'chunked' or (duration_seconds and duration_seconds > GEMINI_CHUNK_THRESHOLD_SECONDS):
+        chunked_result = transcribe_audio_in_chunks(audio_path, transcript_hint, title, diarize=diarize, duration=duration, duration_seconds=duration_seconds,
+                                                    on_transcript_line=on_transcript_line, chunk_seconds=plan['chunk_seconds'])
+        if chunked_result is not None:
+            return chunked_result
+
+    if GEMINI_SPLIT_ANALYSIS:
+        print("   🤖 กำลังถอดความและสรุปเนื้อหาเสียงพร้อมกัน (แยกคำขอ)...")
+        return run_split_analysis(
+            prompt, build_summary_topics_prompt("", title, duration),
+            audio_path=audio_path, max_output_tokens=plan['max_output_tokens'], on_transcript_line=on_transcript_line,
+            duration=duration, duration_seconds=duration_seconds, prefer_models=plan['models'])
+
+    # --- วิเคราะห์ด้วย GEMINI (พร้อมระบบลองใหม่และอัปโหลดภายใน) ---
+    print(f"   🤖 กำลังวิเคราะห์เนื้อหาเสียงด้วยระบบหลาย API Key...")
+    return generate_analysis(prompt, audio_path=audio_path, max_output_tokens=plan['max_output_tokens'], on_transcript_line=on_transcript_line,
+                             duration=duration, duration_seconds=duration_seconds, schema=build_response_schema(), prefer_models=plan['models'])
+
+def build_text_analysis_prompt(transcript, title="", diarize=False, duration=None, duration_seconds=0, include_header=True):
+    """
+    สร้าง Prompt สำหรับวิเคราะห์บทบรรยายจากข้อความ ([SUMMARY], [TOPICS], [TRANSCRIPT])
+    include_header=False: ขอเฉพาะ [TRANSCRIPT] (ใช้คู่กับ build_summary_topics_prompt ในโหมดแยกคำขอ)
     """
     diarize_instruction = ""
     if diarize:
@@ -523,8 +1304,9 @@ def process_text_with_gemini(transcript, title="", diarize=False, duration=None,
    - **ห้ามรวบเป็นคนเดียว**: หากสัมผัสได้ว่ามี 2 คน ต้องแยกชื่อ (เช่น **ผู้พูดคนที่ 1**, **ผู้พูดคนที่ 2**) ทันที
    - หากรู้ชื่อจริงจากบริบท ให้ใช้ชื่อจริงเสมอ (เช่น คุณเอ, อาจารย์บี)"""
 
-    prompt = f"""วิเคราะห์เนื้อหาจาก Transcript ต่อไปนี้ด้วยความละเอียดสูงสุด และตอบกลับในรูปแบบแท็กที่กำหนด:
-
+    header_sections = ""
+    if include_header:
+        header_sections = """
 [SUMMARY]
 เขียนสรุปเนื้อหาที่ครอบคลุมประเด็นสำคัญทั้งหมด 1 ย่อหน้า (ประมาณ 3-5 บรรทัด) เน้นสาระที่ผู้อ่านจะได้รับ
 **กฎสำคัญ**: ห้ามใส่ Timestamp หรือเวลาใดๆ ในส่วนสรุปนี้เด็ดขาด (No timestamps in summary)
@@ -537,7 +1319,11 @@ def process_text_with_gemini(transcript, title="", diarize=False, duration=None,
 3. ชื่อหัวข้อต้องสั้นและมองภาพออกทันที
 4. ห้ามใส่ลำดับข้อ
 ตัวอย่าง: [00:05:30] จิตวิทยาการลงทุน: เทคนิคการควบคุมอารมณ์
+"""
+    task_line = "และตอบกลับในรูปแบบแท็กที่กำหนด:" if include_header else "และตอบกลับเฉพาะส่วน [TRANSCRIPT] (ห้ามเขียนบทสรุปหรือหัวข้อ):"
 
+    prompt = f"""วิเคราะห์เนื้อหาจาก Transcript ต่อไปนี้ด้วยความละเอียดสูงสุด {task_line}
+{header_sections}
 [TRANSCRIPT] (ความยาววิดีโอ: {duration if duration else "Unknown"})
     **บทบรรยายระดับ "Atomic-Clock Precision Calibration"**
     กฎเหล็กความแม่นยำสูงสุด (Authoritative Alignment):
@@ -558,9 +1344,86 @@ Transcript ต้นฉบับ:
 3. **ห้ามแต่งเนื้อหาเพิ่ม**: ให้ยึดตามข้อเท็จจริงในวิดีโอเท่านั้น
 4. **ห้ามหลอน**: ห้ามรันคำซ้ำๆ หรือตอบเป็นภาษาที่อ่านไม่ออก
 """
-    analysis_text = call_gemini_with_retry(prompt, max_output_tokens=16384)
-    return analysis_text
+    return prompt
+
+def split_transcript_by_time(transcript, chunk_seconds):
+    """แบ่งบทบรรยายที่มี Timestamp เป็นช่วงละ chunk_seconds (บรรทัดที่ไม่มีเวลาอยู่ช่วงเดียวกับบรรทัดก่อนหน้า)"""
+    parts, current, window_end = [], [], chunk_seconds
+    for line in transcript.split('\n'):
+        match = _TRANSCRIPT_TS_PATTERN.search(line)
+        if match and current:
+            start = parse_timestamp_to_seconds(match.group(1)) or 0
+            if start >= window_end:
+                parts.append('\n'.join(current))
+                current = []
+                while start >= window_end:
+                    window_end += chunk_seconds
+        current.append(line)
+    if current:
+        parts.append('\n'.join(current))
+    return parts
+
+def analyze_text_in_chunks(transcript, title="", diarize=False, duration=None, duration_seconds=0, chunk_seconds=None):
+    """
+    เรียบเรียงบทบรรยายข้อความยาวแบบขนานตามช่วงเวลา (เมื่อผลลัพธ์ทั้งหมดเกินเพดาน Output ของทุกโมเดล)
+    คืนค่าข้อความรูปแบบเดียวกับ process_text_with_gemini หรือ None หากแบ่งไม่ได้ (ไม่มี Timestamp)
+    """
+    parts = split_transcript_by_time(transcript, chunk_seconds or GEMINI_CHUNK_SECONDS)
+    if len(parts) < 2:
+        return None
+    print(f"   ✂️ แบ่งบทบรรยายเป็น {len(parts)} ช่วงตามแผน Token และเรียบเรียงพร้อมกัน...")
+
+    def analyze_part(part):
+        prompt = build_text_analysis_prompt(part, title, diarize=diarize, duration=duration, duration_seconds=duration_seconds, include_header=False)
+        plan = plan_gemini_request(prompt, expected_output_tokens=int(estimate_text_tokens(part) * 1.2), verbose=False)
+        result = generate_analysis(prompt, max_output_tokens=plan['max_output_tokens'], schema=build_response_schema(summary=False, topics=False), prefer_models=plan['models'])
+        if not isinstance(result, str):
+            return result
+        section = parse_ai_sections(result)['transcript']
+        return section if section is not None else result
+
+    analyzed = [None] * len(parts)
+    with ThreadPoolExecutor(max_workers=max(1, min(len(parts), len(GEMINI_KEY_POOL.keys)))) as executor:
+        future_to_index = {executor.submit(analyze_part, part): i for i, part in enumerate(parts)}
+        for future in as_completed(future_to_index):
+            i = future_to_index[future]
+            try:
+                analyzed[i] = future.result()
+            except Exception as e:
+                analyzed[i] = {"error": str(e)}
+
+    if not any(isinstance(a, str) for a in analyzed):
+        return analyzed[0]
+    # ช่วงที่เรียบเรียงไม่สำเร็จใช้ข้อความต้นฉบับของช่วงนั้นแทน เพื่อไม่ให้เนื้อหาหายไป
+    stitched = '\n'.join((a if isinstance(a, str) else part).strip() for a, part in zip(analyzed, parts))
+    header = request_summary_topics(build_summary_topics_prompt(transcript, title, duration), duration=duration)
+    header = header if isinstance(header, str) else ""
+    return f"{header}\n\n[TRANSCRIPT] (ความยาววิดีโอ: {duration if duration else 'Unknown'})\n{stitched}".strip()
 
+def process_text_with_gemini(transcript, title="", diarize=False, duration=None, duration_seconds=0):
+    """
+    วิเคราะห์บทบรรยายจากข้อความโดยใช้ AI
+    โหมดแยกคำขอ (GEMINI_SPLIT_ANALYSIS): ขอบทสรุป/หัวข้อจากข้อความต้นฉบับพร้อมกับการเรียบเรียงบทบรรยาย
+    """
+    prompt = build_text_analysis_prompt(transcript, title, diarize=diarize, duration=duration, duration_seconds=duration_seconds, include_header=not GEMINI_SPLIT_ANALYSIS)
+    # บทบรรยายที่เรียบเรียงแล้วยาวใกล้เคียงต้นฉบับ (บวก Timestamp และชื่อผู้พูด) หรือตามความยาวคลิป แล้วแต่ค่าใดมากกว่า
+    expected_tokens = max(GEMINI_TOKEN_PLANNER.expected_transcript_tokens(duration_seconds), int(estimate_text_tokens(transcript) * 1.2))
+    expected_tokens += 0 if GEMINI_SPLIT_ANALYSIS else GEMINI_HEADER_OUTPUT_TOKENS
+    plan = plan_gemini_request(prompt, duration_seconds=duration_seconds, expected_output_tokens=expected_tokens, max_chunk_seconds=GEMINI_CHUNK_SECONDS)
+    if plan['strategy'] == 'chunked':
+        chunked_result = analyze_text_in_chunks(transcript, title, diarize=diarize, duration=duration, duration_seconds=duration_seconds, chunk_seconds=plan['chunk_seconds'])
+        if chunked_result is not None:
+            return chunked_result
+
+    if GEMINI_SPLIT_ANALYSIS:
+        return run_split_analysis(
+            prompt, build_summary_topics_prompt(transcript, title, duration),
+            max_output_tokens=plan['max_output_tokens'], duration=duration, duration_seconds=duration_seconds, prefer_models=plan['models'])
+
+    # ขอบทบรรยายต่ออัตโนมัติหากผลลัพธ์ถูกตัดก่อนจบคลิป
+    analysis_text = generate_analysis(prompt, max_output_tokens=plan['max_output_tokens'], duration=duration, duration_seconds=duration_seconds,
+                                      schema=build_response_schema(), prefer_models=plan['models'])
+    return analysis_text
 
 def generate_auto_summary(title, keywords, objective_sentences=None, transcript=""):
     """
@@ -802,6 +1665,7 @@ def get_keywords(text, language="english", count=10):
             print("คำเตือน: ไม่พบ PyThaiNLP จะใช้ระบบดึงข้อมูลแบบพื้นฐานแทน")
     
     # กรณีสำรอง / ประมวลผลภาษาอังกฤษ
+    from sumy.utils import get_stop_words
     words = re.findall(r'\w+', text.lower())
     stop_words = set(get_stop_words(language))
     # เพิ่มคำฟุ่มเฟือยภาษาอังกฤษทั่วไป
@@ -867,11 +1731,180 @@ def find_video_objective(text):
     return candidates[:2]
 
 
-def process_video(url, diarize_mode=True):
+def parse_ai_sections(ai_result):
+    """
+    แยกส่วน [SUMMARY], [TOPICS] และ [TRANSCRIPT] ออกจากผลลัพธ์ของ Gemini
+    คืนค่า dict {'summary', 'topics', 'transcript', 'segments'} (ส่วนที่ไม่พบจะเป็น None)
+    ผลลัพธ์จากโหมด JSON ใช้ส่วนที่แยกไว้แล้ว ส่วนรูปแบบแท็กใช้ตัวแยกส่วนแบบรอบเดียว (split_tagged_sections)
+    """
+    if getattr(ai_result, 'sections', None) is not None:
+        return ai_result.sections
+
+    parsed = split_tagged_sections(ai_result)
+    sections = {'summary': None, 'topics': None, 'transcript': parsed.get('transcript'), 'segments': None}
+    if 'summary' in parsed:
+        # Post-process: ลบ Timestamp ออกจากสรุปเพื่อความสะอาด
+        sections['summary'] = re.sub(r'\[\d{1,2}:\d{2}(?::\d{2})?\]', '', parsed['summary']).strip()
+    if 'topics' in parsed:
+        # แยกแต่ละบรรทัดและทำความสะอาด
+        sections['topics'] = [t.strip().lstrip('-*• ').strip() for t in parsed['topics'].split('\n') if t.strip()]
+    return sections
+
+def text_to_stage_value(text):
+    """แปลงผลลัพธ์ของ Gemini (GeminiText) เป็นค่าที่เก็บใน STAGE_CACHE ได้ โดยคง finish_reason และส่วนที่แยกไว้"""
+    return {'text': str(text), 'finish_reason': getattr(text, 'finish_reason', None), 'sections': getattr(text, 'sections', None)}
+
+def stage_value_to_text(value):
+    """แปลงค่าจาก STAGE_CACHE กลับเป็น GeminiText (คืนค่า None หากไม่มีค่า)"""
+    if not value:
+        return None
+    return GeminiText(value['text'], value.get('finish_reason'), value.get('sections'))
+
+def fetch_youtube_captions(video_id, languages=('th', 'en')):
+    """
+    ดึงคำบรรยาย YouTube ของวิดีโอ (ผ่าน STAGE_CACHE) ด้วยการเรียกรายการคำบรรยายเพียงครั้งเดียว
+    คืนค่า {'manual': track, 'generated': track, 'other': track} โดย track คือ
+    {'language', 'is_manual', 'items'} หรือ None หากไม่มี ('other' คือแทร็กแรกที่มี ใช้เมื่อไม่มีสองแบบแรก)
+    """
+    def fetch():
+        from youtube_transcript_api import YouTubeTranscriptApi
+        from utils import format_transcript_with_timestamps
+        transcript_list_obj = YouTubeTranscriptApi.list_transcripts(video_id)
+
+        def load(transcript):
+            return {
+                'language': transcript.language,
+                'is_manual': transcript.is_manually_created,
+                'items': format_transcript_with_timestamps(transcript.fetch())
+            }
+
+        tracks = {'manual': None, 'generated': None, 'other': None}
+        try:
+            tracks['manual'] = load(transcript_list_obj.find_manually_created_transcript(list(languages)))
+        except Exception:
+            pass
+        try:
+            tracks['generated'] = load(transcript_list_obj.find_generated_transcript(list(languages)))
+        except Exception:
+            pass
+        if not tracks['manual'] and not tracks['generated']:
+            for transcript in transcript_list_obj:
+                tracks['other'] = load(transcript)
+                break
+        return tracks
+
+    return STAGE_CACHE.cached('captions', fetch, video_id=video_id, languages=list(languages))
+
+def captions_to_text(transcript_data):
+    """แปลงข้อมูลคำบรรยายจาก YouTube เป็นข้อความรูปแบบ [HH:MM:SS.mmm] ข้อความ ทีละบรรทัด"""
+    from utils import format_transcript_with_timestamps
+    lines = [f"[{format_time(float(item['start']))}] {item['text']}" for item in format_transcript_with_timestamps(transcript_data)]
+    return '\n'.join(lines).strip()
+
+def build_speculative_results(caption_text, title="", duration=None):
+    """
+    สร้างผลลัพธ์ชั่วคราว (บทสรุป หัวข้อ และคำสำคัญ) จากคำบรรยายของ YouTube ด้วยคำขอข้อความสั้นบนโมเดลที่เร็ว
+    ใช้แสดงผลระหว่างรอการถอดเสียงแบบแยกผู้พูด คืนค่า None หากสร้างไม่สำเร็จ
+    """
+    header = request_summary_topics(build_summary_topics_prompt(caption_text, title, duration), duration=duration)
+    if not isinstance(header, str):
+        return None
+    sections = parse_ai_sections(header)
+    return {
+        'ai_summary': sections['summary'] or "",
+        'ai_topics': sections['topics'] or [],
+        'keywords': get_keywords(caption_text + " " + title),
+        'is_provisional': True,
+        'transcription_source': "YouTube Captions (Provisional)"
+    }
+
+# สร้างผลลัพธ์ชั่วคราวจากคำบรรยาย YouTube ระหว่างรอการถอดเสียงแบบแยกผู้พูด (ปิดได้ด้วย GEMINI_SPECULATIVE_RESULTS=0)
+GEMINI_SPECULATIVE_RESULTS = os.getenv('GEMINI_SPECULATIVE_RESULTS', '1') == '1'
+# ใช้คำบรรยายอัตโนมัติเป็นคำใบ้ (Transcript Hint) ตอนแยกผู้พูด (ถูกบีบอัดก่อนส่ง จึงใช้ Token ไม่มาก)
+GEMINI_AUTO_CAPTION_HINT = os.getenv('GEMINI_AUTO_CAPTION_HINT', '1') == '1'
+# ระยะห่างของ Timestamp ในคำใบ้ (วินาที) 0 = หนึ่ง Timestamp ต่อประโยค
+GEMINI_HINT_ANCHOR_SECONDS = float(os.getenv('GEMINI_HINT_ANCHOR_SECONDS', '0'))
+
+def build_transcript_hint(caption_items):
+    """บีบอัดคำบรรยาย YouTube เป็นคำใบ้สำหรับ Prompt เสียง พร้อมแสดงจำนวน Token ที่ลดลงเทียบกับรูปแบบ [start] TO [end] : text เดิม"""
+    if not caption_items:
+        return ""
+    hint = compress_caption_hint(caption_items, anchor_seconds=GEMINI_HINT_ANCHOR_SECONDS)
+    legacy_tokens = sum(estimate_text_tokens(f"[00:00:00.000] TO [00:00:00.000] : {item['text']}\n") for item in caption_items)
+    hint_tokens = estimate_text_tokens(hint)
+    saved = 100 * (1 - hint_tokens / legacy_tokens) if legacy_tokens else 0
+    print(f"🗜️ คำใบ้บทบรรยาย: {len(caption_items)} บรรทัด -> {hint.count(chr(10)) + 1 if hint else 0} ช่วง (~{legacy_tokens:,} -> ~{hint_tokens:,} Token, ลดลง {saved:.0f}%)")
+    return hint
+
+# งานประมวลผลวิดีโอเดียวกันที่ส่งเข้ามาพร้อมกัน (หลาย Session หรือหลายบรรทัดใน Batch) จะทำเพียงครั้งเดียว
+PROCESS_SINGLE_FLIGHT = SingleFlight("process_video")
+
+def canonical_source(url):
+    """
+    ระบุแหล่งวิดีโอแบบมาตรฐาน (youtu.be/X และ youtube.com/watch?v=X ได้ค่าเดียวกัน)
+    ไฟล์ในเครื่องใช้ SHA-256 ของเนื้อหาไฟล์ (ไฟล์อัปโหลดชื่อเดิมแต่เนื้อหาต่างกันจึงไม่ชนกัน)
+    ส่วน URL อื่นๆ ใช้ URL ที่ตัดช่องว่างแล้ว
+    """
+    url = (url or "").strip()
+    if os.path.isfile(url):
+        return f"file:{file_sha256(url)}"
+    video_id = extract_video_id(url)
+    return f"youtube:{video_id}" if video_id else url
+
+def canonical_job_key(url, diarize_mode=True):
+    """สร้างคีย์ของงานจากแหล่งวิดีโอแบบมาตรฐานและโหมดการถอดเสียง"""
+    return f"{canonical_source(url)}|{'diarize' if diarize_mode else 'quick'}"
+
+def process_video(url, diarize_mode=True, on_transcript_line=None, on_partial_results=None, history_mgr=None, force_refresh=False, max_age_seconds=None):
     """
     ตรรกะหลักสำหรับการประมวลผลวิดีโอ (ดึงข้อมูลมาจาก main() เพื่อให้นำมาใช้ใหม่ได้)
     คืนค่าเป็น Dictionary ที่ประกอบด้วยผลลัพธ์ทั้งหมด
+    on_transcript_line: Callback ที่รับบรรทัดบทบรรยายทีละบรรทัดระหว่างที่ Gemini กำลังถอดเสียง (Streaming)
+    on_partial_results: Callback ที่รับผลลัพธ์ชั่วคราว (is_provisional=True) จากคำบรรยาย YouTube
+                        ก่อนที่บทบรรยายแบบแยกผู้พูดจะเสร็จ ผลลัพธ์สุดท้ายที่คืนค่าจะใช้แทนผลลัพธ์ชั่วคราวนี้
+    หากวิดีโอเดียวกันกำลังประมวลผลอยู่แล้ว จะรอรับผลลัพธ์ของงานนั้นแทนการเริ่มใหม่
+    (ผู้รอจะไม่ได้รับ Callback ระหว่างทาง ได้เฉพาะผลลัพธ์สุดท้าย)
+    history_mgr: HistoryManager สำหรับเปิดผลลัพธ์ของวิดีโอที่เคยประมวลผลแล้วทันที (ไม่เรียกเครือข่ายหรือ Gemini)
+                 ผลลัพธ์ที่ได้จากประวัติจะมี from_history=True
+    force_refresh: ประมวลผลใหม่เสมอแม้จะมีในประวัติ
+    max_age_seconds: ใช้ผลลัพธ์จากประวัติเฉพาะที่ไม่เก่ากว่านี้ (None = ไม่จำกัดอายุ)
     """
+    import copy
+    import shutil
+
+    if history_mgr is not None and not force_refresh:
+        stored = history_mgr.find_results(canonical_source(url), max_age_seconds=max_age_seconds)
+        # ผลลัพธ์แบบไม่แยกผู้พูดใช้แทนคำขอแบบแยกผู้พูดไม่ได้ (กลับกันใช้ได้)
+        if stored and not stored.get('error') and (stored.get('diarize_mode', True) or not diarize_mode):
+            print(f"♻️ [History] ใช้ผลลัพธ์ที่เคยประมวลผลแล้ว: {stored.get('video_title', url)}")
+            stored['from_history'] = True
+            stored['is_provisional'] = False
+            return stored
+
+    def run_job():
+        # พื้นที่ทำงานเฉพาะของงานนี้ (mkdtemp สร้างโฟลเดอร์ใหม่แบบ Exclusive) ไฟล์เสียงของงานอื่นจึงไม่ถูกลบหรือเขียนทับ
+        workspace = tempfile.mkdtemp(prefix="job_")
+        # ผลลัพธ์ชั่วคราว (Speculative) อาจเสร็จหลังงานจบแล้ว: ปิดการส่งผลชั่วคราวก่อนคืนผลลัพธ์สุดท้าย
+        # (ภายใต้ล็อกเดียวกัน) เพื่อไม่ให้ผลชั่วคราวที่มาช้าไปทับผลลัพธ์สุดท้ายบน UI
+        partial_state = {'final': False}
+        partial_lock = threading.Lock()
+        def publish_partial(partial):
+            with partial_lock:
+                if not partial_state['final']:
+                    on_partial_results(partial)
+        try:
+            return _process_video_job(url, diarize_mode, on_transcript_line, publish_partial if on_partial_results else None, workspace)
+        finally:
+            with partial_lock:
+                partial_state['final'] = True
+            shutil.rmtree(workspace, ignore_errors=True)
+
+    results, shared = PROCESS_SINGLE_FLIGHT.do(canonical_job_key(url, diarize_mode), run_job)
+    # ผู้รอแต่ละรายได้สำเนาของตัวเอง เพื่อไม่ให้การแก้ไขผลลัพธ์ฝั่งหนึ่งกระทบอีกฝั่ง
+    return copy.deepcopy(results) if shared else results
+
+def _process_video_job(url, diarize_mode, on_transcript_line, on_partial_results, workspace):
+    """ประมวลผลวิดีโอหนึ่งงานจริง (เรียกผ่าน process_video) ไฟล์ชั่วคราวทั้งหมดเก็บใน workspace"""
     print(f"\n🔥 [DEBUG] ฟังก์ชัน process_video ถูกเรียกสำหรับ URL: {url}")
     results = {
         'video_info': {},
@@ -882,6 +1915,7 @@ def process_video(url, diarize_mode=True):
         'ai_topics': [],
         'ai_summary': "",
         'all_segments': [],
+        'transcript_segments': [],
         'output_filename': "",
         'is_audio_processed': False,
         'platform': "",
@@ -889,7 +1923,10 @@ def process_video(url, diarize_mode=True):
         'video_id': "",
         'speaker_count': 0,
         'error': None,
-        'transcription_source': "Unknown"
+        'transcription_source': "Unknown",
+        'is_provisional': False,
+        'diarize_mode': diarize_mode,
+        'from_history': False
     }
 
     # ตรวจสอบว่าอินพุตเป็นเส้นทางไฟล์ในเครื่อง (Local File) หรือไม่
@@ -926,7 +1963,7 @@ def process_video(url, diarize_mode=True):
         video_id = hashlib.md5(url.encode()).hexdigest()[:10]
         
         print(f"🎬 Starting process for URL: {url}")
-        video_info = get_video_info(url)
+        video_info = STAGE_CACHE.cached('metadata', lambda: get_video_info(url), source=canonical_source(url))
         if not video_info:
             print("⚠️ Metadata extraction failed/blocked, using fallback info.")
             # กรณีสำรองเมื่อดึงข้อมูล Metadata ไม่ได้ แต่การดาวน์โหลดอาจยังทำงานได้ปกติ
@@ -974,6 +2011,9 @@ def process_video(url, diarize_mode=True):
     is_audio_processed = False
     ai_analysis_result = ""
     use_audio_fallback = False
+    caption_text = ""
+    caption_items = []
+    speculative_future = None
     
     # --- STEP 1: Transcription (YouTube API or Audio Download) ---
     print(f"📡 [Step 1] Initializing Transcription for {platform}...")
@@ -981,43 +2021,35 @@ def process_video(url, diarize_mode=True):
     # Try YouTube API for transcripts (Manual or Auto-generated)
     if 'youtube' in platform.lower():
         try:
-            from youtube_transcript_api import YouTubeTranscriptApi
             print(f"🎬 Checking for YouTube transcripts (Manual or Auto-generated)...")
-            transcript_list_obj = YouTubeTranscriptApi.list_transcripts(video_id)
+            caption_tracks = fetch_youtube_captions(video_id)
             
             # 1. พยายามดึง Manual Transcript (คุณภาพสูงสุด)
             # 2. หากไม่มี และ diarize=True ให้ข้ามไปใช้ Audio Native ทันที (เพื่อความแม่นยำ)
-            target_transcript = None
-            try:
-                target_transcript = transcript_list_obj.find_manually_created_transcript(['th', 'en'])
+            target_track = caption_tracks['manual']
+            if target_track:
                 print(f"✅ Found manual transcript.")
-            except:
-                if not diarize:
-                    try:
-                        target_transcript = transcript_list_obj.find_generated_transcript(['th', 'en'])
-                        print(f"✅ Found auto-generated transcript.")
-                    except:
-                        # ลองดึงอันแรกที่มี
-                        for t in transcript_list_obj:
-                            target_transcript = t
-                            print(f"✅ Found transcript ({t.language}).")
-                            break
-                else:
-                    print(f"⚠️ Diarization enabled: Bypassing auto-generated transcript for higher precision.")
+            elif not diarize_mode:
+                # ใช้คำบรรยายอัตโนมัติ หรือแทร็กแรกที่มี
+                target_track = caption_tracks['generated'] or caption_tracks['other']
+                if target_track:
+                    print(f"✅ Found transcript ({target_track['language']}).")
+            else:
+                print(f"⚠️ Diarization enabled: Bypassing auto-generated transcript for higher precision.")
+                # คำบรรยายอัตโนมัติยังใช้เป็นคำใบ้และสร้างผลลัพธ์ชั่วคราวได้ (ไม่ใช้เป็นบทบรรยายสุดท้าย)
+                if caption_tracks['generated'] and (GEMINI_AUTO_CAPTION_HINT or (on_partial_results and GEMINI_SPECULATIVE_RESULTS)):
+                    caption_items = caption_tracks['generated']['items']
+                    caption_text = captions_to_text(caption_items)
             
-            if target_transcript:
-                transcript_data = target_transcript.fetch()
-                from utils import format_transcript_with_timestamps, format_time
-                timestamped_transcript = format_transcript_with_timestamps(transcript_data)
-                for item in timestamped_transcript:
-                    start_s = float(item['start'])
-                    start_time_str = format_time(start_s)
-                    full_text += f"[{start_time_str}] {item['text']}\n"
-                full_text = full_text.strip()
+            if target_track:
+                full_text = captions_to_text(target_track['items'])
+                caption_text = full_text
+                if diarize_mode:
+                    caption_items = target_track['items']
                 if len(full_text) > 50:
                     is_audio_processed = True
                     ai_analysis_result = full_text
-                    results['transcription_source'] = f"YouTube {target_transcript.language} ({'Manual' if target_transcript.is_manually_created else 'Auto'})"
+                    results['transcription_source'] = f"YouTube {target_track['language']} ({'Manual' if target_track['is_manual'] else 'Auto'})"
             else:
                 print(f"ℹ️ No transcripts found on YouTube. Proceeding with audio processing.")
         except Exception as e:
@@ -1026,76 +2058,108 @@ def process_video(url, diarize_mode=True):
     # If diarization is requested, we MUST run Gemini Audio even if we have YT transcript
     # (Because YT transcripts don't have speakers)
     should_run_audio = not is_audio_processed or diarize_mode
+
+    # --- SPECULATIVE STAGE: สรุปจากคำบรรยาย YouTube ทันที ระหว่างที่ดาวน์โหลดเสียงและถอดความแบบแยกผู้พูด ---
+    speculative_executor = None
+    if should_run_audio and on_partial_results and GEMINI_SPECULATIVE_RESULTS and len(caption_text) > 50:
+        print("⚡ [Speculative] สร้างบทสรุปชั่วคราวจากคำบรรยาย YouTube...")
+        speculative_executor = ThreadPoolExecutor(max_workers=1)
+        speculative_future = speculative_executor.submit(build_speculative_results, caption_text, video_title, duration_fmt)
+
+        def publish_partial(future):
+            try:
+                partial = future.result()
+            except Exception as e:
+                print(f"   ⚠️ สร้างผลลัพธ์ชั่วคราวไม่สำเร็จ: {e}")
+                return
+            if partial:
+                on_partial_results({**results, **partial})
+        speculative_future.add_done_callback(publish_partial)
+        speculative_executor.shutdown(wait=False)
     
     if should_run_audio:
-        # หากมี Transcript จาก YT ให้จัดรูปแบบเป็น TO เพื่อเป็นคำใบ้ที่แม่นยำให้ Gemini
-        transcript_hint = ""
-        if is_audio_processed and full_text:
-            hint_lines = []
-            raw_lines = full_text.split('\n')
-            for i in range(len(raw_lines)):
-                l = raw_lines[i].strip()
-                t_match = re.match(r'\[(\d{1,2}:\d{2}(?::\d{2})?(?:\.\d+)?)\]\s*(.*)', l)
-                if t_match:
-                    start_ts = t_match.group(1)
-                    content = t_match.group(2)
-                    # พยายามหาเวลาสิ้นสุดจากบรรทัดถัดไป
-                    end_ts = start_ts # Default
-                    if i + 1 < len(raw_lines):
-                        next_match = re.match(r'\[(\d{1,2}:\d{2}(?::\d{2})?(?:\.\d+)?)\]', raw_lines[i+1].strip())
-                        if next_match: end_ts = next_match.group(1)
-                    hint_lines.append(f"[{start_ts}] TO [{end_ts}] : {content}")
-            transcript_hint = '\n'.join(hint_lines)
+        # หากมี Transcript จาก YT ให้บีบอัดเป็นช่วงระดับประโยคเพื่อเป็นคำใบ้ที่แม่นยำ (และประหยัด Token) ให้ Gemini
+        transcript_hint = build_transcript_hint(caption_items if GEMINI_AUTO_CAPTION_HINT or is_audio_processed else [])
         
-        if platform == "Local File": audio_file = url
+        # ผลถอดเสียงขึ้นกับไฟล์เสียง โหมดแยกผู้พูด และคำใบ้ หากเคยถอดด้วยข้อมูลชุดเดียวกันแล้ว ไม่ต้องดาวน์โหลดและอัปโหลดเสียงซ้ำ
+        import hashlib
+        audio_stage_inputs = {
+            'source': canonical_source(url),
+            'diarize': diarize_mode,
+            'hint': hashlib.sha256(transcript_hint.encode("utf-8")).hexdigest(),
+            'duration': duration_seconds
+        }
+        native_ai_result = stage_value_to_text(STAGE_CACHE.get('audio_analysis', **audio_stage_inputs))
+        audio_file = None
+        audio_pinned = False
+        if native_ai_result is not None:
+            print("♻️ [Stage Cache] ใช้ผลถอดเสียงเดิม ข้ามการดาวน์โหลดและอัปโหลดเสียง")
+        elif platform == "Local File": audio_file = url
         else:
-            temp_audio_path = os.path.join(tempfile.gettempdir(), f"audio_{video_id}")
-            print(f"📥 Downloading audio from: {url[:80]}...")
-            print(f"   💾 Target path: {temp_audio_path}")
-            audio_file = download_audio(url, temp_audio_path)
+            # ไฟล์เสียงเก็บใน MEDIA_CACHE ตามแหล่งวิดีโอและรูปแบบการเข้ารหัส ดาวน์โหลดใหม่เฉพาะเมื่อไม่มีในแคช
+            audio_profile = choose_audio_profile(duration_seconds)
+            audio_cache_key = f"{canonical_source(url)}|{audio_profile}"
+            # pin=True: ไฟล์ถูก pin ภายใต้ล็อกเดียวกับการอ่านดัชนี จึงไม่ถูกลบ (LRU) ก่อนถึงบล็อก with ด้านล่าง
+            audio_file = MEDIA_CACHE.lookup('audio', audio_cache_key, pin=True)
+            audio_pinned = bool(audio_file)
+            if audio_file:
+                print(f"♻️ ใช้ไฟล์เสียงเดิมจากแคช: {audio_file}")
+            else:
+                # ดาวน์โหลดลง workspace ของงานก่อน แล้วจึงย้ายเข้าแคชเมื่อเสร็จสมบูรณ์
+                temp_audio_path = os.path.join(workspace, f"audio_{video_id}")
+                print(f"📥 Downloading audio from: {url[:80]}...")
+                print(f"   💾 Target path: {temp_audio_path}")
+                audio_file = download_audio(url, temp_audio_path, profile=audio_profile, duration_seconds=duration_seconds)
+                if audio_file:
+                    audio_file = MEDIA_CACHE.adopt('audio', audio_cache_key, audio_file, pin=True)
+                    audio_pinned = True
         
-        if audio_file:
-            print(f"✅ Audio source ready: {audio_file}")
-            try:
-                # --- CORE TRANSCRIPTION: Gemini-Native Audio (Ultra-Precision Diarization) ---
-                # ใช้ระบบ Pipeline อัตโนมัติ (Audio -> Gemini Analysis)
-                native_ai_result = process_audio_with_gemini(audio_file, transcript_hint, video_title, diarize=diarize_mode, duration=duration_fmt, duration_seconds=duration_seconds)
+        if audio_file or native_ai_result is not None:
+            if audio_file:
+                print(f"✅ Audio source ready: {audio_file}")
+            # ป้องกันไม่ให้ไฟล์เสียงถูกลบจากแคช (LRU) ระหว่างที่ยังอัปโหลด/แบ่งช่วงอยู่
+            with MEDIA_CACHE.pin(audio_file, already_pinned=audio_pinned):
+                try:
+                    # --- CORE TRANSCRIPTION: Gemini-Native Audio (Ultra-Precision Diarization) ---
+                    # ใช้ระบบ Pipeline อัตโนมัติ (Audio -> Gemini Analysis)
+                    if native_ai_result is None:
+                        native_ai_result = process_audio_with_gemini(audio_file, transcript_hint, video_title, diarize=diarize_mode, duration=duration_fmt, duration_seconds=duration_seconds, on_transcript_line=on_transcript_line)
                 
-                if isinstance(native_ai_result, str):
-                    # Find [TRANSCRIPT] case-insensitively
-                    import re
-                    parts = re.split(r'\[TRANSCRIPT\]|TRANSCRIPT:', native_ai_result, flags=re.IGNORECASE)
-                    if len(parts) > 1:
-                        print(f"✅ Gemini-Native Audio success! Extracted transcript length: {len(native_ai_result)}")
-                        ai_analysis_result = native_ai_result
-                        is_audio_processed = True
-                        results['transcription_source'] = "Gemini-Native Audio (High Precision)"
-                        
-                        transcript_part = parts[1]
-                        # Clean up the transcript part from other tags
-                        transcript_part = re.split(r'\[SUMMARY\]|SUMMARY:|\[TOPICS\]|TOPICS:', transcript_part, flags=re.IGNORECASE)[0]
-                        full_text = transcript_part.strip()
-                        print(f"✅ Cleaned transcript length: {len(full_text)}")
-                    else:
-                        # If tag is missing but we have content, try to use it anyway
-                        if len(native_ai_result.strip()) > 100:
-                            print(f"ℹ️ Gemini-Native Audio result found without [TRANSCRIPT] tag, using as-is.")
+                    if isinstance(native_ai_result, str):
+                        # แยกส่วน [TRANSCRIPT] ด้วยตัวแยกส่วนแบบรอบเดียว (หรือใช้ส่วนที่แยกไว้แล้วจากโหมด JSON)
+                        native_sections = parse_ai_sections(native_ai_result)
+                        if native_sections['transcript'] is not None:
+                            # เก็บเฉพาะผลที่ครบถ้วน ผลที่ไม่ครบจะถูกถอดความใหม่ในครั้งถัดไปแทนการใช้ซ้ำจนหมดอายุแคช
+                            if is_complete_analysis(native_ai_result, native_sections['transcript'], duration_seconds):
+                                STAGE_CACHE.set('audio_analysis', text_to_stage_value(native_ai_result), **audio_stage_inputs)
+                            else:
+                                print("   ⚠️ ผลถอดความไม่ครบถ้วน จะไม่เก็บลง Stage Cache")
+                            print(f"✅ Gemini-Native Audio success! Extracted transcript length: {len(native_ai_result)}")
                             ai_analysis_result = native_ai_result
-                            full_text = native_ai_result.strip()
                             is_audio_processed = True
-                            results['transcription_source'] = "Gemini-Native Audio (Raw)"
+                            results['transcription_source'] = "Gemini-Native Audio (High Precision)"
+                            full_text = native_sections['transcript']
+                            print(f"✅ Cleaned transcript length: {len(full_text)}")
                         else:
-                            print(f"⚠️ Gemini-Native Audio return invalid format or too short.")
-                else:
-                    print(f"⚠️ Gemini-Native Audio failed.")
-                    if isinstance(native_ai_result, dict) and 'error' in native_ai_result:
-                         results['error'] = f"Gemini Error: {native_ai_result['error']}"
-            except Exception as e:
-                print(f"⚠️ Audio process failed: {e}")
-                results['error'] = f"Audio processing error: {str(e)}"
+                            # If tag is missing but we have content, try to use it anyway
+                            if len(native_ai_result.strip()) > 100:
+                                print(f"ℹ️ Gemini-Native Audio result found without [TRANSCRIPT] tag, using as-is.")
+                                ai_analysis_result = native_ai_result
+                                full_text = native_ai_result.strip()
+                                is_audio_processed = True
+                                results['transcription_source'] = "Gemini-Native Audio (Raw)"
+                            else:
+                                print(f"⚠️ Gemini-Native Audio return invalid format or too short.")
+                    else:
+                        print(f"⚠️ Gemini-Native Audio failed.")
+                        if isinstance(native_ai_result, dict) and 'error' in native_ai_result:
+                             results['error'] = f"Gemini Error: {native_ai_result['error']}"
+                except Exception as e:
+                    print(f"⚠️ Audio process failed: {e}")
+                    results['error'] = f"Audio processing error: {str(e)}"
         elif platform != "Local File":
             # ตรวจสอบว่ามีไฟล์ .error หรือไม่ เพื่อดูสาเหตุการดาวน์โหลดล้มเหลว (เฉพาะกรณี Web)
-            temp_audio_path = os.path.join(tempfile.gettempdir(), f"audio_{video_id}")
+            temp_audio_path = os.path.join(workspace, f"audio_{video_id}")
             error_file = f"{temp_audio_path}.error"
             if os.path.exists(error_file):
                 with open(error_file, "r", encoding="utf-8") as f:
@@ -1179,33 +2243,16 @@ def process_video(url, diarize_mode=True):
         # Step 2.2: Parse results
         if ai_combined_result and isinstance(ai_combined_result, str):
             print(f"   📝 Parsing results ({len(ai_combined_result)} chars)...")
-            # ใช้ regex ที่ยืดหยุ่นขึ้น (รองรับทั้ง [TAG] และ TAG:)
-            # Regex ที่เจาะจงมากขึ้นเพื่อป้องกันการจับผิดไปโดนเนื้อหาใน Prompt
-            # บังคับว่าต้องมี TAG อย่างใดอย่างหนึ่งในรูปแบบ [TAG], TAG:, **TAG** หรือ **[TAG]**
-            # SUMMARY capture
-            sum_match = re.search(r'(?:\*\*|\[)?(?:SUMMARY|สรุป)(?:\]|\:|\*\*\]|\*\*\:)(.*?)(?=(?:\*\*|\[)?(?:TOPICS|TRANSCRIPT|หัวข้อ|เนื้อหา|บทบรรยาย)(?:\]|\:|\*\*\]|\*\*\:)|$)', ai_combined_result, re.DOTALL | re.IGNORECASE)
-            
-            # TOPICS capture
-            top_match = re.search(r'(?:\*\*|\[)?(?:TOPICS|หัวข้อ)(?:\]|\:|\*\*\]|\*\*\:)(.*?)(?=(?:\*\*|\[)?(?:SUMMARY|TRANSCRIPT|สรุป|เนื้อหา|บทบรรยาย)(?:\]|\:|\*\*\]|\*\*\:)|$)', ai_combined_result, re.DOTALL | re.IGNORECASE)
-            
-            # TRANSCRIPT capture
-            trans_match = re.search(r'(?:\*\*|\[)?(?:TRANSCRIPT|เนื้อหา|บทบรรยาย)(?:\]|\:|\*\*\]|\*\*\:)(.*?)(?=(?:\*\*|\[)?(?:SUMMARY|TOPICS|สรุป|หัวข้อ)(?:\]|\:|\*\*\]|\*\*\:)|$)', ai_combined_result, re.DOTALL | re.IGNORECASE)
-            
-            if sum_match: 
-                raw_summary = sum_match.group(1).strip()
-                # Post-process: ลบ Timestamp ออกจากสรุปเพื่อความสะอาด
-                clean_summary = re.sub(r'\[\d{1,2}:\d{2}(?::\d{2})?\]', '', raw_summary)
-                results['ai_summary'] = clean_summary.strip()
-            
-            if top_match:
-                raw_topics = top_match.group(1).strip()
-                # แยกแต่ละบรรทัดและทำความสะอาด
-                topic_list = [t.strip().lstrip('-*• ').strip() for t in raw_topics.split('\n') if t.strip()]
-                results['ai_topics'] = topic_list
-            
-            if trans_match:
-                results['full_text'] = trans_match.group(1).strip()
+            sections = parse_ai_sections(ai_combined_result)
+            if sections['summary'] is not None:
+                results['ai_summary'] = sections['summary']
+            if sections['topics'] is not None:
+                results['ai_topics'] = sections['topics']
+            if sections['transcript'] is not None:
+                results['full_text'] = sections['transcript']
                 results['speaker_count'] = count_unique_speakers(results['full_text'])
+                if sections.get('segments'):
+                    results['transcript_segments'] = sections['segments']
             else:
                 # Fallback for transcript if tag is missing: Preserve both timestamps and Summaries
                 transcript_lines = [l for l in ai_combined_result.split('\n') if re.search(r'\[\d{1,2}:\d{2}(?::\d{2})?(?:\.\d+)?\]', l)]
@@ -1213,6 +2260,14 @@ def process_video(url, diarize_mode=True):
                     results['full_text'] = '\n'.join(transcript_lines)
                     results['speaker_count'] = count_unique_speakers(results['full_text'])
 
+        # หากการวิเคราะห์หลักไม่ได้บทสรุป/หัวข้อ ให้ใช้ผลลัพธ์ชั่วคราวจากคำบรรยาย (ถ้าเสร็จแล้ว)
+        if speculative_future is not None and speculative_future.done() and not speculative_future.exception():
+            speculative = speculative_future.result() or {}
+            if not results.get('ai_summary'):
+                results['ai_summary'] = speculative.get('ai_summary', "")
+            if not results.get('ai_topics'):
+                results['ai_topics'] = speculative.get('ai_topics', [])
+
         # Backup summary if AI failed
         if not results.get('ai_summary'):
             results['ai_summary'] = generate_auto_summary(video_title, keywords=[], transcript=full_text)
@@ -1259,7 +2314,8 @@ def process_video(url, diarize_mode=True):
                 return topic_str, search_videos(search_query, max_results=3)
             return topic_str, []
 
-        with ThreadPoolExecutor(max_workers=5) as executor:
+        # จำนวนเธรดเป็นเพียงเพดาน งานค้นหาจริงถูกคุมด้วย YTDLP_LIMITER ที่ปรับตามความจุของปลายทาง
+        with ThreadPoolExecutor(max_workers=max(1, min(len(results['ai_topics']), YTDLP_LIMITER.max_limit))) as executor:
             future_to_topic = {executor.submit(search_for_topic, t): t for t in results['ai_topics']}
             for future in as_completed(future_to_topic):
                 t_str, vids = future.result()
@@ -1280,15 +2336,28 @@ def main():
         args.remove('--quick')
     if '--diarize' in args:
         args.remove('--diarize')
+    # แสดงบทบรรยายทีละบรรทัดระหว่างที่ Gemini กำลังถอดเสียง (ปิดได้ด้วย --no-stream)
+    stream_mode = True
+    if '--no-stream' in args:
+        stream_mode = False
+        args.remove('--no-stream')
     
     if not args:
-         print("Usage: python main.py <video_url> [--quick]")
+         print("Usage: python main.py <video_url> [--quick] [--no-stream]")
          sys.exit(1)
          
     url = args[0]
     print("\n=== Processing Video ===")
     
-    results = process_video(url, diarize_mode=diarize_mode)
+    def print_transcript_line(line):
+        print(f"   📝 {line}", flush=True)
+
+    def print_partial_results(partial):
+        print(f"\n⚡ สรุปชั่วคราว (จากคำบรรยาย YouTube):\n{partial.get('ai_summary', '')}\n", flush=True)
+
+    results = process_video(url, diarize_mode=diarize_mode,
+                            on_transcript_line=print_transcript_line if stream_mode else None,
+                            on_partial_results=print_partial_results if stream_mode else None)
     
     if not results or results.get('error'):
         error_msg = results.get('error', 'Could not process video.') if results else 'Could not process video.'
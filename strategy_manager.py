@@ -0,0 +1,127 @@
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+
+
+def strategy_domain(url):
+    """
+    คืนค่าโดเมนหลักของ URL สำหรับใช้เป็นกลุ่มของสถิติ (เช่น www.youtube.com, youtu.be -> youtube.com)
+    """
+    host = (urlparse(url).hostname or '').lower()
+    for prefix in ('www.', 'm.', 'vm.', 'vt.', 'mobile.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+            break
+    if host == 'youtu.be':
+        return 'youtube.com'
+    return host or 'local'
+
+
+class StrategyScoreboard:
+    """
+    สถิติความสำเร็จของกลยุทธ์ดาวน์โหลด (คุกกี้ / Impersonate) แยกตามโดเมน เก็บถาวรใน SQLite
+    - ทุกผลลัพธ์จะถูกลดน้ำหนักลงครึ่งหนึ่งทุก half_life_seconds (Time Decay) ผลลัพธ์ล่าสุดจึงมีผลมากที่สุด
+    - order() เรียงรายการกลยุทธ์ใหม่ตามโอกาสสำเร็จ กลยุทธ์ที่ไม่มีสถิติหรือคะแนนเท่ากันจะคงลำดับเดิม
+    """
+
+    def __init__(self, db_file="strategy_scores.db", half_life_seconds=24 * 3600):
+        self.db_file = db_file
+        self.half_life_seconds = half_life_seconds
+        self._lock = threading.Lock()
+        self.init_db()
+
+    def init_db(self):
+        """สร้างตารางสถิติหากยังไม่มีในระบบ"""
+        try:
+            with sqlite3.connect(self.db_file) as conn:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS strategy_scores (
+                        domain TEXT,
+                        strategy TEXT,
+                        successes REAL,
+                        failures REAL,
+                        updated_at REAL,
+                        PRIMARY KEY (domain, strategy)
+                    )
+                """)
+                conn.commit()
+        except Exception as e:
+            print(f"Strategy scoreboard initialization error: {e}")
+
+    def _decay(self, age_seconds):
+        if self.half_life_seconds <= 0:
+            return 1.0
+        return 0.5 ** (max(0.0, age_seconds) / self.half_life_seconds)
+
+    def record(self, domain, strategy, success):
+        """บันทึกผลลัพธ์ของกลยุทธ์หนึ่งครั้ง (ค่าเดิมจะถูกลดน้ำหนักตามเวลาที่ผ่านไปก่อนบวกเพิ่ม)"""
+        now = time.time()
+        try:
+            with self._lock, sqlite3.connect(self.db_file) as conn:
+                row = conn.execute(
+                    "SELECT successes, failures, updated_at FROM strategy_scores WHERE domain = ? AND strategy = ?",
+                    (domain, strategy)
+                ).fetchone()
+                successes, failures = 0.0, 0.0
+                if row:
+                    weight = self._decay(now - row[2])
+                    successes, failures = row[0] * weight, row[1] * weight
+                if success:
+                    successes += 1.0
+                else:
+                    failures += 1.0
+                conn.execute(
+                    "INSERT OR REPLACE INTO strategy_scores (domain, strategy, successes, failures, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    (domain, strategy, successes, failures, now)
+                )
+                conn.commit()
+        except Exception as e:
+            print(f"Strategy scoreboard write error: {e}")
+
+    def scores(self, domain):
+        """คืนค่า {strategy: โอกาสสำเร็จ} ของโดเมน (ค่าเฉลี่ยแบบ Laplace: กลยุทธ์ที่ไม่มีสถิติ = 0.5)"""
+        now = time.time()
+        try:
+            with sqlite3.connect(self.db_file) as conn:
+                rows = conn.execute(
+                    "SELECT strategy, successes, failures, updated_at FROM strategy_scores WHERE domain = ?",
+                    (domain,)
+                ).fetchall()
+        except Exception as e:
+            print(f"Strategy scoreboard read error: {e}")
+            return {}
+        result = {}
+        for strategy, successes, failures, updated_at in rows:
+            weight = self._decay(now - updated_at)
+            result[strategy] = (successes * weight + 1.0) / ((successes + failures) * weight + 2.0)
+        return result
+
+    def order(self, domain, sources, key):
+        """เรียง sources ใหม่ตามโอกาสสำเร็จบนโดเมนนี้ (key(source) คืนค่าชื่อกลยุทธ์) โดยคงลำดับเดิมเมื่อคะแนนเท่ากัน"""
+        scores = self.scores(domain)
+        if not scores:
+            return list(sources)
+        return sorted(sources, key=lambda source: -scores.get(key(source), 0.5))
+
+    def snapshot(self):
+        """คืนค่าสถิติทั้งหมดที่ลดน้ำหนักตามเวลาแล้ว (สำหรับหน้าตรวจสอบระบบ)"""
+        now = time.time()
+        try:
+            with sqlite3.connect(self.db_file) as conn:
+                rows = conn.execute(
+                    "SELECT domain, strategy, successes, failures, updated_at FROM strategy_scores ORDER BY domain, strategy"
+                ).fetchall()
+        except Exception as e:
+            print(f"Strategy scoreboard read error: {e}")
+            return []
+        snapshot = []
+        for domain, strategy, successes, failures, updated_at in rows:
+            weight = self._decay(now - updated_at)
+            snapshot.append({
+                'domain': domain,
+                'strategy': strategy,
+                'successes': round(successes * weight, 2),
+                'failures': round(failures * weight, 2),
+            })
+        return snapshot
@@ -0,0 +1,42 @@
+import os
+import sys
+
+# Add current directory to path
+sys.path.append(os.getcwd())
+
+from concurrency_manager import AdaptiveLimiter, is_overload_error
+
+print("--- Test 1: Successes at full capacity raise the limit ---")
+limiter = AdaptiveLimiter("test", initial_limit=2, max_limit=4)
+for _ in range(10):
+    limiter.acquire()
+    limiter.acquire()
+    limiter.release()
+    limiter.release()
+if limiter.limit > 2:
+    print(f"✅ Limit grew to {limiter.limit}")
+else:
+    print(f"❌ Limit did not grow ({limiter.limit})")
+    sys.exit(1)
+
+print("\n--- Test 2: Overload halves the limit ---")
+before = limiter.limit
+try:
+    with limiter.slot():
+        raise Exception("HTTP Error 429: Too Many Requests")
+except Exception:
+    pass
+if limiter.limit < before:
+    print(f"✅ Limit dropped {before} -> {limiter.limit}")
+else:
+    print(f"❌ Unexpected limit after overload ({before} -> {limiter.limit})")
+    sys.exit(1)
+
+print("\n--- Test 3: Acquire times out when all slots are busy ---")
+small = AdaptiveLimiter("tiny", initial_limit=1, max_limit=1)
+small.acquire()
+if not small.acquire(timeout=0.1) and not is_overload_error(Exception("Video unavailable")):
+    print("✅ Busy limiter refused a second slot")
+else:
+    print("❌ Limiter handed out more slots than allowed")
+    sys.exit(1)
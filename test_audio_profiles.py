@@ -0,0 +1,52 @@
+import os
+import sys
+import tempfile
+
+# Add current directory to path
+sys.path.append(os.getcwd())
+
+import utils
+from utils import AUDIO_PROFILES, choose_audio_profile, download_audio
+
+print("--- Test 1: Profile is chosen by duration ---")
+if choose_audio_profile(5 * 60) == 'passthrough' and choose_audio_profile(2 * 3600) == 'opus' and choose_audio_profile(0) == 'opus':
+    print("✅ Short -> passthrough, long/unknown -> opus")
+else:
+    print("❌ Unexpected profile choice")
+    sys.exit(1)
+
+print("\n--- Test 2: download_audio passes the profile's encoder settings to yt-dlp ---")
+captured = []
+
+class RecordingYoutubeDL:
+    """แทน yt_dlp.YoutubeDL เพื่อตรวจค่าที่ส่งเข้าไปโดยไม่ต้องใช้เครือข่าย"""
+    def __init__(self, opts):
+        self.opts = opts
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        return False
+    def download(self, urls):
+        captured.append(self.opts)
+        codec = self.opts['postprocessors'][0]['preferredcodec']
+        ext = codec if codec in ('opus', 'm4a', 'wav') else 'opus'
+        with open(f"{self.opts['outtmpl']}.{ext}", "wb") as f:
+            f.write(b"audio")
+
+utils.yt_dlp.YoutubeDL = RecordingYoutubeDL
+output = os.path.join(tempfile.mkdtemp(), "audio_test")
+path = download_audio("https://example.com/video", output, duration_seconds=3 * 3600)
+opts = captured[-1]
+if path.endswith(".opus") and opts['postprocessors'][0]['preferredcodec'] == 'opus' and opts['postprocessor_args'] == ['-ac', '1', '-ar', '16000']:
+    print(f"✅ 3h video downloaded as {os.path.basename(path)} (mono 16 kHz Opus)")
+else:
+    print(f"❌ Unexpected options: {opts.get('postprocessors')} -> {path}")
+    sys.exit(1)
+
+print("\n--- Test 3: Explicit profile overrides the automatic choice ---")
+path = download_audio("https://example.com/video", output, profile='wav', duration_seconds=3 * 3600)
+if path.endswith(".wav") and captured[-1]['postprocessors'] == AUDIO_PROFILES['wav']['postprocessors']:
+    print("✅ Legacy WAV profile still available")
+else:
+    print(f"❌ Unexpected result: {path}")
+    sys.exit(1)
@@ -0,0 +1,69 @@
+import os
+import sys
+import time
+
+# Add current directory to path
+sys.path.append(os.getcwd())
+
+from concurrency_manager import race_strategies
+
+def make_run(behaviour, log):
+    """behaviour: strategy -> ('fail', seconds) | ('ok', seconds) | ('stream_fail', seconds)"""
+    def run(index, strategy, cancel_event, mark_started):
+        log.append(strategy)
+        kind, seconds = behaviour[strategy]
+        deadline = time.time() + seconds
+        if kind in ('ok', 'stream_fail'):
+            mark_started()
+        while time.time() < deadline:
+            if cancel_event.is_set():
+                raise RuntimeError(f"{strategy} cancelled")
+            time.sleep(0.01)
+        if kind == 'ok':
+            return f"{strategy}.m4a"
+        raise RuntimeError(f"{strategy}: HTTP Error 403: Forbidden")
+    return run
+
+print("--- Test 1: Blocked strategies fail in about one timeout, not one per strategy ---")
+log = []
+behaviour = {name: ('fail', 0.4) for name in ['cookiefile', 'safari', 'firefox', 'impersonate']}
+started = time.time()
+result, errors = race_strategies(list(behaviour), make_run(behaviour, log), fanout=4, hedge_delay=0)
+elapsed = time.time() - started
+if result is None and sorted(i for i, _ in errors) == [0, 1, 2, 3] and elapsed < 0.9:
+    print(f"✅ 4 blocked strategies failed in {elapsed:.2f}s (sequential would take ~1.6s)")
+else:
+    print(f"❌ result={result}, errors={len(errors)}, elapsed={elapsed:.2f}s")
+    sys.exit(1)
+
+print("\n--- Test 2: First success wins and the slower strategies are cancelled ---")
+log = []
+behaviour = {'cookiefile': ('fail', 0.1), 'safari': ('fail', 5), 'impersonate': ('ok', 0.2)}
+started = time.time()
+result, errors = race_strategies(list(behaviour), make_run(behaviour, log), fanout=3, hedge_delay=0)
+elapsed = time.time() - started
+if result == "impersonate.m4a" and elapsed < 1:
+    print(f"✅ {result} won in {elapsed:.2f}s")
+else:
+    print(f"❌ result={result}, errors={errors}, elapsed={elapsed:.2f}s")
+    sys.exit(1)
+
+print("\n--- Test 3: Fan-out 1 keeps the original one-at-a-time order ---")
+log = []
+behaviour = {'a': ('fail', 0.05), 'b': ('ok', 0.05), 'c': ('ok', 0.05)}
+result, errors = race_strategies(list(behaviour), make_run(behaviour, log), fanout=1, hedge_delay=0)
+if result == "b.m4a" and log == ['a', 'b']:
+    print(f"✅ Tried {log} in order")
+else:
+    print(f"❌ result={result}, log={log}")
+    sys.exit(1)
+
+print("\n--- Test 4: Strategies cancelled for a leader that later fails are retried ---")
+log = []
+behaviour = {'a': ('fail', 0.3), 'b': ('stream_fail', 0.1), 'c': ('ok', 0.3)}
+result, errors = race_strategies(list(behaviour), make_run(behaviour, log), fanout=3, hedge_delay=0)
+if result == "c.m4a" and [i for i, _ in errors] == [1] and log.count('a') == 2:
+    print(f"✅ {result} after re-queueing cancelled strategies (attempts: {log})")
+else:
+    print(f"❌ result={result}, errors={errors}, log={log}")
+    sys.exit(1)
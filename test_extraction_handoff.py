@@ -0,0 +1,97 @@
+import os
+import sys
+import tempfile
+
+# Add current directory to path
+sys.path.append(os.getcwd())
+
+import utils
+from utils import get_video_info, download_audio, take_extraction
+
+calls = []
+opened = []
+
+class RecordingYoutubeDL:
+    """แทน yt_dlp.YoutubeDL เพื่อนับจำนวนการดึงหน้าเว็บโดยไม่ต้องใช้เครือข่าย"""
+    fail_process = False
+    def __init__(self, opts):
+        self.opts = opts
+        opened.append(opts)
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        return False
+    @staticmethod
+    def sanitize_info(info, remove_private_keys=False):
+        return {k: v for k, v in info.items() if not k.startswith('_')}
+    def extract_info(self, url, download=False):
+        calls.append('extract')
+        return {'id': 'abc', 'title': 'Lecture', 'duration': 60, 'extractor_key': 'Youtube',
+                'formats': [{'format_id': '251', 'url': 'https://example.com/251'}], '_private': 1}
+    def process_ie_result(self, info, download=True):
+        calls.append('process')
+        if RecordingYoutubeDL.fail_process:
+            raise Exception("HTTP Error 403: Forbidden")
+        self._write()
+    def download(self, urls):
+        calls.append('download')
+        self._write()
+    def _write(self):
+        with open(f"{self.opts['outtmpl']}.opus", "wb") as f:
+            f.write(b"audio")
+
+utils.yt_dlp.YoutubeDL = RecordingYoutubeDL
+url = "https://www.youtube.com/watch?v=abc"
+output = os.path.join(tempfile.mkdtemp(), "audio_test")
+
+print("--- Test 1: Download reuses the metadata extraction ---")
+get_video_info(url)
+path = download_audio(url, output, profile='opus')
+if path.endswith(".opus") and calls == ['extract', 'process']:
+    print(f"✅ One extraction for metadata + download: {calls}")
+else:
+    print(f"❌ Unexpected calls: {calls} -> {path}")
+    sys.exit(1)
+
+print("\n--- Test 2: The handoff is used only once ---")
+if take_extraction(url) is None:
+    print("✅ Handoff consumed")
+else:
+    print("❌ Handoff still stored after download")
+    sys.exit(1)
+
+print("\n--- Test 3: A failed handoff falls back to full extraction ---")
+calls.clear()
+RecordingYoutubeDL.fail_process = True
+get_video_info(url)
+path = download_audio(url, output, profile='opus')
+if path.endswith(".opus") and calls[:2] == ['extract', 'process'] and 'download' in calls:
+    print(f"✅ Fell back after handoff failure: {calls}")
+else:
+    print(f"❌ Unexpected calls: {calls} -> {path}")
+    sys.exit(1)
+
+print("\n--- Test 4: The handoff downloads with the same client as the extraction ---")
+calls.clear()
+opened.clear()
+RecordingYoutubeDL.fail_process = False
+get_video_info(url)
+download_audio(url, output, profile='opus')
+network_keys = ('cookiefile', 'cookiesfrombrowser', 'impersonate', 'http_headers', 'extractor_args')
+extract_opts, download_opts = ({k: o.get(k) for k in network_keys} for o in opened[:2])
+if calls == ['extract', 'process'] and extract_opts == download_opts:
+    print(f"✅ Same network options: {extract_opts}")
+else:
+    print(f"❌ extract={extract_opts}, download={download_opts}")
+    sys.exit(1)
+
+print("\n--- Test 5: Extractions that return nothing count as failures ---")
+RecordingYoutubeDL.extract_info = lambda self, url, download=False: None
+recorded = []
+utils.STRATEGY_SCOREBOARD.record = lambda domain, strategy, success: recorded.append(success)
+get_video_info(url)
+if recorded == [False]:
+    print("✅ Empty extraction recorded as a failure")
+else:
+    print(f"❌ Recorded: {recorded}")
+    sys.exit(1)
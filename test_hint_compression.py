@@ -0,0 +1,48 @@
+import os
+import sys
+import json
+
+# Add current directory to path
+sys.path.append(os.getcwd())
+
+from utils import compress_caption_hint, format_transcript_with_timestamps
+from gemini_manager import estimate_text_tokens
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "youtube_auto_captions_rolling.json")
+
+with open(FIXTURE, encoding="utf-8") as f:
+    captions = format_transcript_with_timestamps(json.load(f))
+
+# รูปแบบคำใบ้เดิม: ทุกบรรทัดเป็น [start] TO [end] : text
+legacy_hint = '\n'.join(f"[00:00:00.000] TO [00:00:00.000] : {item['text']}" for item in captions)
+hint = compress_caption_hint(captions)
+
+print("--- Test 1: Rolling captions compress to sentence-level spans ---")
+legacy_tokens = estimate_text_tokens(legacy_hint)
+hint_tokens = estimate_text_tokens(hint)
+reduction = 1 - hint_tokens / legacy_tokens
+print(f"   {len(captions)} lines / ~{legacy_tokens} tokens -> {len(hint.splitlines())} spans / ~{hint_tokens} tokens ({reduction:.0%} smaller)")
+if reduction >= 0.5:
+    print("✅ Hint is at least 50% smaller")
+else:
+    print(f"❌ Hint only {reduction:.0%} smaller")
+    sys.exit(1)
+
+print("\n--- Test 2: No words are lost or duplicated ---")
+expected = "so today we are going to talk about how neural networks actually learn."
+first_line = hint.splitlines()[0]
+body = ' '.join(line.split('] ', 1)[1] for line in hint.splitlines())
+if first_line == f"[00:00:01] {expected}" and body.count("loss function") == 1 and body.endswith("write the training loop ourselves in python."):
+    print(f"✅ {first_line}")
+else:
+    print(f"❌ Unexpected hint:\n{hint[:500]}")
+    sys.exit(1)
+
+print("\n--- Test 3: Anchors keep one timestamp per window ---")
+anchored = compress_caption_hint(captions, anchor_seconds=30)
+last_start = captions[-1]['start']
+if len(anchored.splitlines()) <= last_start // 30 + 2 and estimate_text_tokens(anchored) <= hint_tokens:
+    print(f"✅ {len(anchored.splitlines())} anchors for {last_start:.0f}s of captions")
+else:
+    print(f"❌ Too many anchors: {len(anchored.splitlines())}")
+    sys.exit(1)
@@ -0,0 +1,44 @@
+import os
+import sys
+import sqlite3
+import tempfile
+
+# Add current directory to path
+sys.path.append(os.getcwd())
+
+from history_manager import HistoryManager
+
+db_file = os.path.join(tempfile.mkdtemp(), "test_history.db")
+
+# ฐานข้อมูลรุ่นเก่าที่ยังไม่มีคอลัมน์ video_id / results_json
+with sqlite3.connect(db_file) as conn:
+    conn.execute("CREATE TABLE history (id INTEGER PRIMARY KEY AUTOINCREMENT, title TEXT, url TEXT, result_text TEXT, timestamp TEXT)")
+    conn.execute("INSERT INTO history (title, url, result_text, timestamp) VALUES ('Old', 'https://youtu.be/old', 'text', '2024-01-01T00:00:00')")
+
+history = HistoryManager(db_file)
+
+print("--- Test 1: Old databases are migrated and old rows are not served ---")
+if len(history.load_history()) == 1 and history.find_results("youtube:old") is None:
+    print("✅ Migration kept existing rows")
+else:
+    print("❌ Migration failed")
+    sys.exit(1)
+
+print("\n--- Test 2: Results are found by canonical video ID from any URL form ---")
+results = {'video_title': "Demo", 'ai_summary': "สรุป", 'ai_topics': ["[00:00:05] หัวข้อ"], 'is_audio_processed': True}
+history.save_to_history({'title': "Demo", 'url': "https://youtu.be/X", 'result_text': "analysis", 'video_id': "youtube:X", 'results': results})
+stored = history.find_results("youtube:X")
+if stored == results:
+    print("✅ Full results dict restored")
+else:
+    print(f"❌ Unexpected results: {stored}")
+    sys.exit(1)
+
+print("\n--- Test 3: Max age rejects stale entries ---")
+with sqlite3.connect(db_file) as conn:
+    conn.execute("UPDATE history SET timestamp = '2020-01-01T00:00:00' WHERE video_id = 'youtube:X'")
+if history.find_results("youtube:X", max_age_seconds=3600) is None and history.find_results("youtube:X") is not None:
+    print("✅ Stale entry skipped only when a max age is given")
+else:
+    print("❌ Max age not applied")
+    sys.exit(1)
@@ -0,0 +1,39 @@
+import os
+import sys
+
+# Add current directory to path
+sys.path.append(os.getcwd())
+
+from gemini_manager import KeyPool, parse_retry_after
+
+print("--- Test 1: Least-loaded key is handed out first ---")
+pool = KeyPool(["key_a", "key_b"], rpm_limit=60, tpm_limit=100000)
+first = pool.acquire()
+second = pool.acquire()
+if first != second:
+    print(f"✅ Concurrent callers got different keys ({first}, {second})")
+else:
+    print("❌ Same key handed out while another key was idle")
+    sys.exit(1)
+pool.release(first)
+pool.release(second)
+
+print("\n--- Test 2: A key that returned 429 cools down for its model ---")
+key = pool.acquire(scope="gemini-2.0-flash")
+pool.release(key, error=Exception("429 Resource exhausted. Please retry in 20s"), scope="gemini-2.0-flash")
+other = pool.acquire(scope="gemini-2.0-flash", max_wait=0)
+pool.release(other)
+blocked = pool.acquire(scope="gemini-2.0-flash", exclude={other}, max_wait=0)
+same_key_other_model = pool.acquire(scope="gemini-flash-latest", exclude={other}, max_wait=0)
+if other != key and blocked is None and same_key_other_model == key:
+    print("✅ Cooling key skipped for the same model only")
+else:
+    print("❌ Cooldown not applied correctly")
+    sys.exit(1)
+
+print("\n--- Test 3: Retry-After hints are parsed ---")
+if parse_retry_after("Please retry in 27.5s") == 27.5 and parse_retry_after("retry_delay { seconds: 31 }") == 31:
+    print("✅ Retry-After parsed")
+else:
+    print("❌ Retry-After parsing failed")
+    sys.exit(1)
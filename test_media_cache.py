@@ -0,0 +1,108 @@
+import os
+import sys
+import time
+import tempfile
+import hashlib
+
+# Add current directory to path
+sys.path.append(os.getcwd())
+
+from cache_manager import MediaCache
+
+root = tempfile.mkdtemp()
+cache = MediaCache(os.path.join(root, "media"), max_bytes=100)
+
+def make_file(name, size):
+    path = os.path.join(root, name)
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    return path
+
+print("--- Test 1: Finished downloads are adopted and reused ---")
+path = cache.adopt('audio', "youtube:A|opus", make_file("audio_A.opus", 40))
+if cache.lookup('audio', "youtube:A|opus") == path and os.path.basename(path) == "audio_A.opus" and cache.lookup('audio', "youtube:A|wav") is None:
+    print(f"✅ Reused {os.path.basename(path)} from the cache")
+else:
+    print("❌ Adopted file not found")
+    sys.exit(1)
+
+print("\n--- Test 2: LRU eviction keeps recently used and pinned files ---")
+time.sleep(0.01)
+b_path = cache.adopt('audio', "youtube:B|opus", make_file("audio_B.opus", 40))
+time.sleep(0.01)
+cache.lookup('audio', "youtube:A|opus")  # A ถูกใช้ล่าสุด B จึงเก่าที่สุด
+with cache.pin(b_path):
+    time.sleep(0.01)
+    cache.adopt('preview', "https://x", make_file("preview.mp4", 40))
+    pinned_kept = os.path.exists(b_path)
+time.sleep(0.01)
+cache.adopt('preview', "https://y", make_file("preview2.mp4", 40))
+snapshot = cache.snapshot()
+if pinned_kept and not os.path.exists(b_path) and snapshot['bytes'] <= 100 and cache.lookup('audio', "youtube:B|opus") is None:
+    print(f"✅ Pinned file survived, then evicted; {snapshot['files']} files / {snapshot['bytes']} bytes")
+else:
+    print(f"❌ Unexpected state: pinned_kept={pinned_kept}, {snapshot}")
+    sys.exit(1)
+
+print("\n--- Test 3: Uploads are keyed by content and missing files are dropped ---")
+first = cache.store_bytes('upload', b"same content", "lecture.mp4")
+second = cache.store_bytes('upload', b"same content", "lecture.mp4")
+os.remove(first)
+if first == second and os.path.basename(first) == "lecture.mp4" and cache.store_bytes('upload', b"same content", "lecture.mp4") and os.path.exists(first):
+    print("✅ Identical uploads share one file, deleted files are restored")
+else:
+    print("❌ Upload cache mismatch")
+    sys.exit(1)
+
+print("\n--- Test 4: Same content under another name keeps the caller's file name ---")
+renamed = cache.store_bytes('upload', b"same content", "lecture_copy.mp4")
+if os.path.basename(renamed) == "lecture_copy.mp4" and open(renamed, "rb").read() == b"same content" and os.path.basename(cache.store_bytes('upload', b"same content", "lecture.mp4")) == "lecture.mp4":
+    print("✅ Each upload keeps its own name over shared content")
+else:
+    print(f"❌ Returned {renamed}")
+    sys.exit(1)
+
+print("\n--- Test 5: Pinned lookups survive eviction until released ---")
+pinned_cache = MediaCache(os.path.join(tempfile.mkdtemp(), "media_cache"), max_bytes=100)
+held = pinned_cache.adopt('preview', "https://a", make_file("a.mp4", 80), pin=True)
+pinned_cache.adopt('preview', "https://b", make_file("b.mp4", 80))
+survived = os.path.exists(held)
+with pinned_cache.pin(held, already_pinned=True):
+    pass
+pinned_cache.adopt('preview', "https://c", make_file("c.mp4", 80))
+if survived and not os.path.exists(held) and pinned_cache.lookup('preview', "https://a", pin=True) is None:
+    print("✅ Pinned at lookup time, released by the with block")
+else:
+    print(f"❌ survived={survived}, still exists={os.path.exists(held)}")
+    sys.exit(1)
+
+print("\n--- Test 6: Replaced files still pinned are removed at the last unpin ---")
+replace_cache = MediaCache(os.path.join(tempfile.mkdtemp(), "media_cache"), max_bytes=1000)
+old_path = replace_cache.adopt('preview', "https://r", make_file("old.mp4", 10), pin=True)
+new_path = replace_cache.adopt('preview', "https://r", make_file("new.mp4", 10))
+kept_while_pinned = os.path.exists(old_path)
+replace_cache.unpin(old_path)
+if kept_while_pinned and not os.path.exists(old_path) and os.path.exists(new_path):
+    print("✅ Old file kept while pinned, then removed")
+else:
+    print(f"❌ kept_while_pinned={kept_while_pinned}, old exists={os.path.exists(old_path)}")
+    sys.exit(1)
+
+print("\n--- Test 7: Copied aliases count toward the quota and leave with their entry ---")
+alias_cache = MediaCache(os.path.join(tempfile.mkdtemp(), "media_cache"), max_bytes=1000)
+original_link = os.link
+def refuse_link(*args, **kwargs):
+    raise OSError("hard links not supported")
+os.link = refuse_link
+try:
+    alias_cache.store_bytes('upload', b"y" * 30, "first.mp4")
+    copy_path = alias_cache.store_bytes('upload', b"y" * 30, "second.mp4")
+finally:
+    os.link = original_link
+counted = alias_cache.snapshot()['bytes']
+entry_path = alias_cache.adopt('upload', hashlib.sha256(b"y" * 30).hexdigest(), make_file("first.mp4", 30))
+if counted == 60 and not os.path.exists(copy_path) and os.path.exists(entry_path) and alias_cache.snapshot()['bytes'] == 30:
+    print(f"✅ {counted} bytes counted with the copy, alias removed with the old content")
+else:
+    print(f"❌ counted={counted}, alias exists={os.path.exists(copy_path)}, {alias_cache.snapshot()}")
+    sys.exit(1)
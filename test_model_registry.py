@@ -0,0 +1,61 @@
+import os
+import sys
+import tempfile
+
+# Add current directory to path
+sys.path.append(os.getcwd())
+
+from cache_manager import ResultCache
+from gemini_manager import ModelRegistry
+
+
+class FakeClients:
+    """จำลอง ClientPool ที่คืนรายชื่อโมเดลโดยไม่ต้องเรียก API จริง"""
+    def __init__(self, listed):
+        self.listed = listed
+        self.calls = 0
+
+    def list_models(self, api_key):
+        self.calls += 1
+        return set(self.listed)
+
+
+models = ["gemini-1.5-pro-latest", "gemini-2.0-flash", "gemini-flash-latest"]
+cache = ResultCache(db_file=os.path.join(tempfile.mkdtemp(), "probe_cache.db"))
+
+print("--- Test 1: Retired models are skipped after the probe ---")
+clients = FakeClients(["gemini-2.0-flash", "gemini-flash-latest"])
+registry = ModelRegistry(clients, models, cache=cache)
+order = registry.models_to_try("key_a")
+if order == ["gemini-2.0-flash", "gemini-flash-latest"]:
+    print(f"✅ Probe filtered models: {order}")
+else:
+    print(f"❌ Unexpected model order: {order}")
+    sys.exit(1)
+
+print("\n--- Test 2: Probe result is reused from the cache ---")
+clients_2 = FakeClients(models)
+registry_2 = ModelRegistry(clients_2, models, cache=cache)
+registry_2.models_to_try("key_a")
+if clients_2.calls == 0 and registry_2.models_to_try("key_a") == order:
+    print("✅ Second registry used the cached probe")
+else:
+    print("❌ Probe was repeated instead of using the cache")
+    sys.exit(1)
+
+print("\n--- Test 3: Repeated 503s open the circuit for that model only ---")
+for _ in range(3):
+    registry.record_failure("gemini-2.0-flash", Exception("503 The model is overloaded."))
+registry.record_failure("gemini-flash-latest", Exception("429 Resource exhausted"))
+if registry.models_to_try("key_a") == ["gemini-flash-latest"] and not registry.is_available("gemini-2.0-flash"):
+    print("✅ Overloaded model skipped, 429 ignored")
+else:
+    print(f"❌ Circuit state wrong: {registry.snapshot()}")
+    sys.exit(1)
+
+registry.record_success("gemini-2.0-flash")
+if registry.is_available("gemini-2.0-flash"):
+    print("✅ Success closes the circuit again")
+else:
+    print("❌ Circuit did not close after success")
+    sys.exit(1)
@@ -0,0 +1,45 @@
+import os
+import sys
+import time
+import tempfile
+
+# Add current directory to path
+sys.path.append(os.getcwd())
+
+from cache_manager import ResultCache
+
+db_file = os.path.join(tempfile.mkdtemp(), "test_cache.db")
+cache = ResultCache(db_file=db_file, max_bytes=100, ttl_seconds=3600)
+
+print("--- Test 1: Cache hit for identical prompt/audio/model/tokens ---")
+key = cache.make_key("prompt", "audio_sha", "gemini-2.0-flash", 2048)
+cache.set(key, "result text")
+if cache.get(key) == "result text" and cache.get(cache.make_key("prompt", "audio_sha", "gemini-2.0-flash", 4096)) is None:
+    print("✅ Hit on same key, miss on different max_output_tokens")
+else:
+    print("❌ Cache key mismatch")
+    sys.exit(1)
+
+print("\n--- Test 2: LRU eviction when size quota is exceeded ---")
+cache.set("a", "x" * 40)
+time.sleep(0.01)
+cache.set("b", "y" * 40)
+time.sleep(0.01)
+cache.get("a")  # แตะ a เพื่อให้ b เป็นรายการที่เก่าที่สุด
+time.sleep(0.01)
+cache.set("c", "z" * 40)
+if cache.get("a") and cache.get("c") and cache.get("b") is None:
+    print("✅ Least recently used entry was evicted")
+else:
+    print("❌ LRU eviction failed")
+    sys.exit(1)
+
+print("\n--- Test 3: Expired entries are ignored ---")
+cache.ttl_seconds = 0.05
+cache.set("d", "old")
+time.sleep(0.1)
+if cache.get("d") is None:
+    print("✅ Expired entry treated as miss")
+else:
+    print("❌ TTL not enforced")
+    sys.exit(1)
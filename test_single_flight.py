@@ -0,0 +1,62 @@
+import os
+import sys
+import time
+import threading
+
+# Add current directory to path
+sys.path.append(os.getcwd())
+
+from concurrency_manager import SingleFlight
+
+flight = SingleFlight("test")
+calls = []
+
+def slow_job():
+    calls.append(1)
+    time.sleep(0.3)
+    return {"video_id": "X"}
+
+print("--- Test 1: Concurrent callers of one key share a single run ---")
+outcomes = []
+threads = [threading.Thread(target=lambda: outcomes.append(flight.do("youtube:X", slow_job))) for _ in range(4)]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+shared_count = sum(1 for _, shared in outcomes if shared)
+if len(calls) == 1 and shared_count == 3 and all(result == {"video_id": "X"} for result, _ in outcomes):
+    print("✅ 1 run, 3 callers received the shared result")
+else:
+    print(f"❌ {len(calls)} runs, {shared_count} shared")
+    sys.exit(1)
+
+print("\n--- Test 2: Waiting callers receive the leader's exception ---")
+def failing_job():
+    time.sleep(0.2)
+    raise RuntimeError("download failed")
+
+errors = []
+def call_failing():
+    try:
+        flight.do("youtube:Y", failing_job)
+    except RuntimeError as e:
+        errors.append(str(e))
+
+threads = [threading.Thread(target=call_failing) for _ in range(3)]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+if errors == ["download failed"] * 3:
+    print("✅ All 3 callers saw the same error")
+else:
+    print(f"❌ Unexpected errors: {errors}")
+    sys.exit(1)
+
+print("\n--- Test 3: A finished key runs again on the next call ---")
+result, shared = flight.do("youtube:X", slow_job)
+if len(calls) == 2 and not shared and not flight.in_flight():
+    print("✅ Completed jobs are not cached")
+else:
+    print(f"❌ {len(calls)} runs, shared={shared}, in flight={flight.in_flight()}")
+    sys.exit(1)
@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+import tempfile
+
+# Add current directory to path
+sys.path.append(os.getcwd())
+
+from cache_manager import ResultCache, StageCache
+
+db_file = os.path.join(tempfile.mkdtemp(), "test_stage_cache.db")
+store = ResultCache(db_file=db_file, max_bytes=0, ttl_seconds=3600)
+stages = StageCache(store, stage_versions={'audio_analysis': 1}, max_ages={'metadata': 0.2})
+
+print("--- Test 1: Only stages whose inputs changed are recomputed ---")
+runs = []
+def transcribe():
+    runs.append(1)
+    return {'text': "[TRANSCRIPT]\n[00:00:01] hello"}
+
+stages.cached('audio_analysis', transcribe, source="youtube:X", diarize=True)
+stages.cached('audio_analysis', transcribe, diarize=True, source="youtube:X")
+stages.cached('audio_analysis', transcribe, source="youtube:X", diarize=False)
+if len(runs) == 2:
+    print("✅ Same inputs reused (argument order ignored), changed diarize recomputed")
+else:
+    print(f"❌ Expected 2 runs, got {len(runs)}")
+    sys.exit(1)
+
+print("\n--- Test 2: Bumping a stage version invalidates old results ---")
+stages.stage_versions['audio_analysis'] = 2
+if stages.get('audio_analysis', source="youtube:X", diarize=True) is None:
+    print("✅ Old prompt version is not reused")
+else:
+    print("❌ Stale result returned after version bump")
+    sys.exit(1)
+
+print("\n--- Test 3: Per-stage max age and None results ---")
+stages.set('metadata', {'title': "T"}, source="youtube:X")
+fresh = stages.get('metadata', source="youtube:X")
+time.sleep(0.3)
+stale = stages.get('metadata', source="youtube:X")
+stages.cached('captions', lambda: None, video_id="X")
+if fresh == {'title': "T"} and stale is None and stages.get('captions', video_id="X") is None:
+    print("✅ Metadata expires after its max age; None is never stored")
+else:
+    print(f"❌ fresh={fresh}, stale={stale}")
+    sys.exit(1)
@@ -0,0 +1,55 @@
+import os
+import sys
+import time
+import tempfile
+
+# Add current directory to path
+sys.path.append(os.getcwd())
+
+from strategy_manager import StrategyScoreboard, strategy_domain
+
+db_file = os.path.join(tempfile.mkdtemp(), "strategy_scores.db")
+board = StrategyScoreboard(db_file, half_life_seconds=3600)
+sources = [{'name': 'cookiefile'}, {'name': 'safari'}, {'name': 'firefox'}, {'name': 'impersonate'}]
+label = lambda source: source['name']
+
+print("--- Test 1: URL variants share one domain ---")
+domains = {strategy_domain(u) for u in ["https://www.youtube.com/watch?v=x", "https://youtu.be/x", "https://m.youtube.com/watch?v=x"]}
+if domains == {"youtube.com"} and strategy_domain("https://vm.tiktok.com/abc") == "tiktok.com":
+    print("✅ youtube.com / tiktok.com")
+else:
+    print(f"❌ Domains: {domains}")
+    sys.exit(1)
+
+print("\n--- Test 2: No history keeps the original order ---")
+if board.order("youtube.com", sources, label) == sources:
+    print("✅ Original order")
+else:
+    print("❌ Order changed without history")
+    sys.exit(1)
+
+print("\n--- Test 3: The strategy that just worked is tried first ---")
+for name in ['cookiefile', 'safari', 'firefox']:
+    board.record("youtube.com", name, False)
+board.record("youtube.com", "impersonate", True)
+order = [label(s) for s in board.order("youtube.com", sources, label)]
+other = [label(s) for s in board.order("tiktok.com", sources, label)]
+if order[0] == "impersonate" and order[-3:] == ['cookiefile', 'safari', 'firefox'] and other[0] == "cookiefile":
+    print(f"✅ youtube.com: {order}, tiktok.com unchanged")
+else:
+    print(f"❌ youtube.com: {order}, tiktok.com: {other}")
+    sys.exit(1)
+
+print("\n--- Test 4: Scores persist and old results decay ---")
+reopened = StrategyScoreboard(db_file, half_life_seconds=3600)
+fresh = reopened.scores("youtube.com")["impersonate"]
+future = time.time() + 10 * 3600
+original_time = time.time
+time.time = lambda: future
+decayed = reopened.scores("youtube.com")["impersonate"]
+time.time = original_time
+if fresh > 0.6 and abs(decayed - 0.5) < 0.01:
+    print(f"✅ {fresh:.2f} now, {decayed:.2f} after 10 half-lives")
+else:
+    print(f"❌ fresh={fresh:.2f}, decayed={decayed:.2f}")
+    sys.exit(1)
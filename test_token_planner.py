@@ -0,0 +1,34 @@
+import os
+import sys
+
+# Add current directory to path
+sys.path.append(os.getcwd())
+
+from gemini_manager import TokenBudgetPlanner
+
+planner = TokenBudgetPlanner(limits={"small": (1000000, 8192), "large": (1000000, 65536)})
+
+print("--- Test 1: Short audio fits every model in one request ---")
+plan = planner.plan(["small", "large"], 20000, planner.expected_transcript_tokens(5 * 60), duration_seconds=5 * 60)
+if plan['strategy'] == 'single' and plan['models'] == ["small", "large"] and plan['max_output_tokens'] <= 8192:
+    print(f"✅ Single request on {plan['models']} with output limit {plan['max_output_tokens']}")
+else:
+    print(f"❌ Unexpected plan: {plan}")
+    sys.exit(1)
+
+print("\n--- Test 2: Medium audio keeps only models with a large enough output limit ---")
+plan = planner.plan(["small", "large"], 60000, planner.expected_transcript_tokens(40 * 60), duration_seconds=40 * 60)
+if plan['strategy'] == 'single' and plan['models'] == ["large"] and plan['max_output_tokens'] > 8192:
+    print(f"✅ Routed to {plan['models']} with output limit {plan['max_output_tokens']}")
+else:
+    print(f"❌ Unexpected plan: {plan}")
+    sys.exit(1)
+
+print("\n--- Test 3: Oversized audio is split before sending ---")
+plan = planner.plan(["small", "large"], 400000, planner.expected_transcript_tokens(4 * 3600), duration_seconds=4 * 3600, max_chunk_seconds=900)
+chunk_tokens = planner.expected_transcript_tokens(plan['chunk_seconds'] or 0) * planner.safety_margin
+if plan['strategy'] == 'chunked' and plan['chunk_seconds'] <= 900 and chunk_tokens <= 65536:
+    print(f"✅ Split into {plan['chunk_seconds']:.0f}s chunks (~{chunk_tokens:.0f} output tokens each)")
+else:
+    print(f"❌ Unexpected plan: {plan}")
+    sys.exit(1)
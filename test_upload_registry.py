@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+import types
+import threading
+
+# Add current directory to path
+sys.path.append(os.getcwd())
+
+from gemini_manager import UploadRegistry
+
+class FakeClients:
+    """แทน ClientPool: จำลองการอัปโหลด/ลบไฟล์โดยไม่ต้องใช้เครือข่าย"""
+    def __init__(self):
+        self.uploads = 0
+        self.deleted = []
+    def upload_file(self, api_key, path, mime_type):
+        self.uploads += 1
+        return types.SimpleNamespace(name=f"files/{self.uploads}")
+    def get_file(self, api_key, file_name):
+        return types.SimpleNamespace(name=file_name, state=types.SimpleNamespace(name="ACTIVE"), expiration_time=None)
+    def delete_file(self, api_key, file_name):
+        self.deleted.append(file_name)
+
+clients = FakeClients()
+registry = UploadRegistry(clients, idle_ttl_seconds=0.2, reap_interval_seconds=3600)
+
+print("--- Test 1: A file in use is kept past the idle TTL ---")
+audio_file = registry.acquire("KEY", "audio.opus", "hash", "audio/ogg")
+time.sleep(0.3)
+registry.reap()
+if clients.deleted == []:
+    print("✅ Long-running request keeps its upload")
+else:
+    print(f"❌ Deleted while in use: {clients.deleted}")
+    sys.exit(1)
+
+print("\n--- Test 2: Idle time counts from release, not acquire ---")
+registry.release(audio_file)
+registry.reap()
+kept = clients.deleted == []
+time.sleep(0.3)
+registry.reap()
+if kept and clients.deleted == [audio_file.name]:
+    print("✅ Deleted only after being idle for the TTL since release")
+else:
+    print(f"❌ kept={kept}, deleted={clients.deleted}")
+    sys.exit(1)
+
+print("\n--- Test 3: Shared uploads wait for every user to release ---")
+first = registry.acquire("KEY", "audio.opus", "hash2", "audio/ogg")
+second = registry.acquire("KEY", "audio.opus", "hash2", "audio/ogg")
+registry.release(first)
+time.sleep(0.3)
+registry.reap()
+in_use_kept = first.name not in clients.deleted
+registry.release(second)
+time.sleep(0.3)
+registry.reap()
+if first.name == second.name and clients.uploads == 2 and in_use_kept and first.name in clients.deleted:
+    print("✅ One upload, deleted after the last release")
+else:
+    print(f"❌ uploads={clients.uploads}, deleted={clients.deleted}")
+    sys.exit(1)
+
+print("\n--- Test 4: Concurrent acquire, release and reap do not race ---")
+errors = []
+def worker(n):
+    try:
+        for i in range(200):
+            audio_file = registry.acquire(f"KEY{n % 3}", "audio.opus", f"hash{i % 7}", "audio/ogg")
+            registry.release(audio_file)
+            if i % 10 == 0:
+                registry.invalidate(f"KEY{n % 3}", f"hash{i % 7}")
+    except Exception as e:
+        errors.append(e)
+def reaper():
+    try:
+        for _ in range(200):
+            registry.reap()
+    except Exception as e:
+        errors.append(e)
+threads = [threading.Thread(target=worker, args=(n,)) for n in range(6)] + [threading.Thread(target=reaper)]
+for t in threads: t.start()
+for t in threads: t.join()
+if not errors and not registry._refs:
+    print("✅ No errors and every reference was released")
+else:
+    print(f"❌ errors={errors[:3]}, refs={registry._refs}")
+    sys.exit(1)
+
+registry.shutdown()
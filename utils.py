@@ -3,15 +3,107 @@ import os
 import hashlib
 from urllib.parse import urlparse, parse_qs
 import time
+import copy
+import threading
+import shutil
+import tempfile
 import subprocess
 import platform
 import yt_dlp
 from yt_dlp.networking.impersonate import ImpersonateTarget
+from yt_dlp.utils import DownloadCancelled
+from concurrency_manager import AdaptiveLimiter, is_overload_error, race_strategies
+from cache_manager import MediaCache
+from strategy_manager import StrategyScoreboard, strategy_domain
 
 # บังคับเพิ่ม Path สำหรับ ffmpeg ในกรณีที่ระบบมองไม่เห็น
 os.environ["PATH"] += os.pathsep + "/opt/homebrew/bin"
 os.environ["PATH"] += os.pathsep + "/usr/local/bin"
 
+# --- จำกัดจำนวนงาน yt-dlp พร้อมกันแบบปรับตัวเอง (ใช้ร่วมกันทั้งดาวน์โหลด ค้นหา และดึง Metadata) ---
+# เพิ่มจำนวนงานเมื่อสำเร็จต่อเนื่อง และลดลงครึ่งหนึ่งเมื่อโดน 429/403/Timeout จากปลายทาง
+YTDLP_LIMITER = AdaptiveLimiter(
+    "yt-dlp",
+    initial_limit=int(os.getenv('YTDLP_INITIAL_CONCURRENCY', '5')),
+    max_limit=int(os.getenv('YTDLP_MAX_CONCURRENCY', '16'))
+)
+
+# --- แข่งกลยุทธ์ดาวน์โหลด (คุกกี้ / Impersonate) พร้อมกัน ---
+# จำนวนกลยุทธ์ที่รันพร้อมกันสูงสุด (1 = ลองทีละกลยุทธ์ตามลำดับแบบเดิม)
+YTDLP_DOWNLOAD_FANOUT = int(os.getenv('YTDLP_DOWNLOAD_FANOUT', '3'))
+# ระยะห่าง (วินาที) ระหว่างการเริ่มแต่ละกลยุทธ์ (0 = เริ่มพร้อมกันทันที) กลยุทธ์ถัดไปจะเริ่มเฉพาะเมื่อยังไม่มีกลยุทธ์ใดเริ่มรับข้อมูล
+YTDLP_HEDGE_DELAY = float(os.getenv('YTDLP_HEDGE_DELAY', '0'))
+
+# --- สถิติความสำเร็จของกลยุทธ์ (คุกกี้ / Impersonate) ต่อโดเมน ---
+# กลยุทธ์ที่เพิ่งสำเร็จบนแพลตฟอร์มเดียวกันจะถูกลองก่อน (สถิติลดน้ำหนักลงครึ่งหนึ่งทุก STRATEGY_HALF_LIFE_HOURS ชั่วโมง)
+STRATEGY_SCOREBOARD = StrategyScoreboard(
+    os.getenv('STRATEGY_SCOREBOARD_DB', 'strategy_scores.db'),
+    half_life_seconds=float(os.getenv('STRATEGY_HALF_LIFE_HOURS', '24')) * 3600
+)
+
+# --- ส่งต่อผลการดึงข้อมูลของ yt-dlp จากขั้น Metadata ไปยังขั้นดาวน์โหลด ---
+# get_video_info เก็บ info dict ไว้ แล้ว download_audio ใช้ต่อด้วย process_ie_result
+# ไม่ต้องโหลดหน้าเว็บ / Player / Signature ซ้ำอีกรอบ (URL ของสตรีมมีอายุจำกัด จึงเก็บไว้เพียง EXTRACTION_HANDOFF_TTL วินาที)
+# URL ของสตรีมผูกกับ Client / Fingerprint ที่ดึงข้อมูล ขั้นดาวน์โหลดจึงต้องใช้ตัวเลือกเครือข่ายชุดเดียวกัน (HANDOFF_NETWORK_KEYS)
+HANDOFF_NETWORK_KEYS = ('cookiefile', 'cookiesfrombrowser', 'impersonate', 'http_headers', 'extractor_args')
+EXTRACTION_HANDOFF_TTL = float(os.getenv('EXTRACTION_HANDOFF_TTL', '600'))
+EXTRACTION_HANDOFF_MAX_ENTRIES = 32
+_extraction_handoff = {}
+_extraction_handoff_lock = threading.Lock()
+
+def stash_extraction(url, info, source, ydl_opts):
+    """
+    เก็บผลการดึงข้อมูล (info dict ที่ล้างคีย์ภายในแล้ว) พร้อมกลยุทธ์และตัวเลือกเครือข่ายที่ใช้ดึง (จาก ydl_opts)
+    เพื่อให้ขั้นดาวน์โหลดใช้ต่อด้วย Client / Fingerprint เดียวกับที่ได้ URL ของสตรีมมา
+    """
+    network_opts = {key: copy.deepcopy(ydl_opts[key]) for key in HANDOFF_NETWORK_KEYS if key in ydl_opts}
+    now = time.time()
+    with _extraction_handoff_lock:
+        for key in [k for k, (stored_at, _, _, _) in _extraction_handoff.items() if now - stored_at > EXTRACTION_HANDOFF_TTL]:
+            del _extraction_handoff[key]
+        while len(_extraction_handoff) >= EXTRACTION_HANDOFF_MAX_ENTRIES:
+            oldest = min(_extraction_handoff, key=lambda k: _extraction_handoff[k][0])
+            del _extraction_handoff[oldest]
+        _extraction_handoff[url] = (now, info, dict(source), network_opts)
+
+def take_extraction(url):
+    """นำผลการดึงข้อมูลของ URL ออกมาใช้ (ใช้ได้ครั้งเดียว) คืนค่า (info, source, network_opts) หรือ None หากไม่มี/หมดอายุ"""
+    with _extraction_handoff_lock:
+        entry = _extraction_handoff.pop(url, None)
+    if not entry or time.time() - entry[0] > EXTRACTION_HANDOFF_TTL:
+        return None
+    return entry[1], entry[2], entry[3]
+
+def strategy_label(source):
+    """ชื่อของกลยุทธ์ (แหล่งคุกกี้ / Impersonate) ใช้ทั้งใน Log และเป็นคีย์ของ STRATEGY_SCOREBOARD"""
+    if source.get('cookiefile'):
+        return f"file:{os.path.basename(source.get('cookiefile'))}"
+    if source.get('rotation_target'):
+        return f"impersonate:{source['rotation_target']}"
+    if source.get('cookiesfrombrowser'):
+        return f"browser:{','.join(source['cookiesfrombrowser'])}"
+    return 'no-cookies'
+
+def record_strategy_result(url, source, error=None):
+    """
+    บันทึกผลของกลยุทธ์ลง STRATEGY_SCOREBOARD
+    ไม่นับการถูกยกเลิก (มีกลยุทธ์อื่นชนะแล้ว) และ Error ที่เกิดจากตัววิดีโอเอง (ถูกลบ / ส่วนตัว) ซึ่งทุกกลยุทธ์ได้ผลเหมือนกัน
+    """
+    if isinstance(error, DownloadCancelled):
+        return
+    if error is not None:
+        err_str = str(error) or repr(error)
+        if any(msg in err_str for msg in ["Video unavailable", "Private video", "has been removed", "Unsupported URL"]):
+            return
+    STRATEGY_SCOREBOARD.record(strategy_domain(url), strategy_label(source), error is None)
+
+# --- แคชไฟล์สื่อ (เสียงที่ดาวน์โหลด, วิดีโอตัวอย่าง, ไฟล์อัปโหลด) ที่จำกัดขนาดรวม ---
+# แทนการทิ้งไฟล์ไว้ใน Temp โดยไม่มีวันลบ และใช้ไฟล์เดิมซ้ำแทนการดาวน์โหลดใหม่
+MEDIA_CACHE = MediaCache(
+    os.getenv('MEDIA_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'media_cache')),
+    max_bytes=int(float(os.getenv('MEDIA_CACHE_MAX_MB', '2048')) * 1024 * 1024)
+)
+
 def format_time(s):
     # รูปแบบ HH:MM:SS.mmm
     h = int(s // 3600)
@@ -74,27 +166,100 @@ def format_transcript_with_timestamps(transcript_list):
 
     return formatted
 
+_SENTENCE_BREAK = re.compile(r'(?<=[.?!。？！])\s+')
+
+def _strip_caption_overlap(tail, text, min_overlap=4):
+    """
+    ตัดส่วนต้นของ text ที่ซ้ำกับท้ายข้อความก่อนหน้า (คำบรรยายแบบเลื่อนบรรทัดจะขึ้นต้นด้วยท้ายบรรทัดก่อน)
+    คืนค่าข้อความว่างหาก text ซ้ำกับข้อความก่อนหน้าทั้งบรรทัด ตัดเฉพาะที่ขอบคำเพื่อไม่ให้คำขาดครึ่ง
+    """
+    if not tail:
+        return text
+    if len(text) >= min_overlap and text in tail:
+        return ""
+    for k in range(min(len(tail), len(text)), min_overlap - 1, -1):
+        if tail.endswith(text[:k]) and (k == len(text) or text[k].isspace()) and (k == len(tail) or tail[-k - 1].isspace()):
+            return text[k:].strip()
+    return text
+
+def compress_caption_hint(captions, max_gap_seconds=1.5, max_span_seconds=20.0, anchor_seconds=0):
+    """
+    บีบอัดคำบรรยาย YouTube เป็นคำใบ้ (transcript_hint) สำหรับ Prompt ให้ใช้ Token น้อยลง
+    - ตัดข้อความที่ซ้ำจากคำบรรยายแบบเลื่อนบรรทัด (Rolling captions) และบรรทัดที่ซ้ำทั้งบรรทัด
+    - รวมบรรทัดที่ต่อเนื่องหรือเหลื่อมเวลากันเป็นช่วงระดับประโยค (ตัดช่วงเมื่อจบประโยค เว้นช่วงเกิน max_gap_seconds หรือยาวเกิน max_span_seconds)
+    - anchor_seconds > 0: ใส่ Timestamp เพียงทุกๆ anchor_seconds วินาที (ข้อความระหว่างนั้นรวมเป็นบรรทัดเดียว)
+    captions: รายการ {'start', 'duration' หรือ 'end', 'text'} (รูปแบบเดียวกับ format_transcript_with_timestamps)
+    คืนค่าข้อความรูปแบบ [HH:MM:SS] ข้อความ ทีละบรรทัด
+    """
+    span_limit = anchor_seconds or max_span_seconds
+    spans = []
+    current = None
+    tail = ""  # ท้ายข้อความที่ส่งออกไปแล้ว (ข้ามช่วงได้ เพราะการเลื่อนบรรทัดไม่สนใจขอบช่วง)
+    for item in captions:
+        text = ' '.join(str(item.get('text', '')).split())
+        if not text:
+            continue
+        start = float(item['start'])
+        end = float(item['end']) if 'end' in item else start + float(item.get('duration', 0))
+
+        text = _strip_caption_overlap(tail, text)
+        if not text:
+            if current is not None:
+                current['end'] = max(current['end'], end)
+            continue
+
+        tail = (tail + ' ' + text)[-300:]
+
+        if current is not None and (start - current['end'] > max_gap_seconds or start - current['start'] >= span_limit):
+            spans.append(current)
+            current = None
+        if current is not None and not anchor_seconds:
+            # คำบรรยายอัตโนมัติมักตัดกลางประโยค: ส่วนที่จบประโยคต่อท้ายช่วงเดิม แล้วเริ่มช่วงใหม่จากส่วนที่เหลือ
+            parts = _SENTENCE_BREAK.split(text)
+            if len(parts) > 1:
+                current['text'] += ' ' + ' '.join(parts[:-1])
+                current['end'] = max(current['end'], start)
+                spans.append(current)
+                current = None
+                text = parts[-1]
+        if current is None:
+            current = {'start': start, 'end': end, 'text': text}
+        else:
+            current['text'] += ' ' + text
+            current['end'] = max(current['end'], end)
+        if not anchor_seconds and text[-1] in '.?!。？！':
+            spans.append(current)
+            current = None
+    if current is not None:
+        spans.append(current)
+
+    lines = []
+    for span in spans:
+        seconds = int(span['start'])
+        lines.append(f"[{seconds // 3600:02d}:{(seconds % 3600) // 60:02d}:{seconds % 60:02d}] {span['text']}")
+    return '\n'.join(lines)
+
 def download_video_preview(url):
     """
     ดาวน์โหลดวิดีโอเพื่อใช้ในการแสดงตัวอย่าง (เช่น TikTok)
-    คืนค่าเป็นเส้นทางของไฟล์ที่ดาวน์โหลด
+    คืนค่าเป็นเส้นทางของไฟล์ที่ดาวน์โหลด ซึ่งถูก pin ใน MEDIA_CACHE แล้ว
+    ผู้เรียกต้องคืน pin หลังแสดงผลเสร็จ (with MEDIA_CACHE.pin(path, already_pinned=True))
     """
     import tempfile
     import os
     
-    # สร้างชื่อไฟล์ตาม Hash ของ URL เพื่อให้สามารถแคชหรือนำกลับมาใช้ใหม่ได้
+    # ใช้ไฟล์ตัวอย่างเดิมจาก MEDIA_CACHE ถ้ามี (คีย์คือ URL)
+    cached_path = MEDIA_CACHE.lookup('preview', url, pin=True)
+    if cached_path:
+        return cached_path
+
+    # สร้างชื่อไฟล์ตาม Hash ของ URL แล้วดาวน์โหลดลงโฟลเดอร์ชั่วคราวก่อนย้ายเข้าแคช (ไฟล์ที่ยังโหลดไม่ครบจะไม่อยู่ในแคช)
     import hashlib
     url_hash = hashlib.md5(url.encode()).hexdigest()
-    temp_dir = tempfile.gettempdir()
-    # รูปแบบไฟล์ผลลัพธ์: /tmp/preview_MD5.mp4
+    temp_dir = tempfile.mkdtemp(prefix="preview_")
+    # รูปแบบไฟล์ผลลัพธ์: preview_MD5.mp4
     output_template = os.path.join(temp_dir, f"preview_{url_hash}.%(ext)s")
-    
-    # ตรวจสอบว่ามีไฟล์อยู่แล้วหรือไม่ (ระบบแคชแบบง่าย)
-    # ตรวจสอบนามสกุลไฟล์หรือรูปแบบที่ตรงกัน
     base_path = os.path.join(temp_dir, f"preview_{url_hash}")
-    for ext in ['.mp4', '.mkv', '.webm']:
-        if os.path.exists(base_path + ext):
-            return base_path + ext
 
     # การตั้งค่าคุ้กกี้และความเสถียรสำหรับ TikTok
     base_ydl_opts = {
@@ -130,6 +295,8 @@ def download_video_preview(url):
         # Removed Chrome source to ensure system doesn't rely on it
         cookie_sources.append({}) # ลำดับสุดท้ายลองแบบไม่ใช้คุ้กกี้
 
+    cookie_sources = STRATEGY_SCOREBOARD.order(strategy_domain(url), cookie_sources, strategy_label)
+
     last_error = None
     for source in cookie_sources:
         ydl_opts = base_ydl_opts.copy()
@@ -152,8 +319,12 @@ def download_video_preview(url):
             # ตรวจสอบไฟล์ที่ดาวน์โหลด
             for ext in ['.mp4', '.mkv', '.webm']:
                 if os.path.exists(base_path + ext):
-                    return base_path + ext
+                    record_strategy_result(url, source)
+                    cached_path = MEDIA_CACHE.adopt('preview', url, base_path + ext, pin=True)
+                    shutil.rmtree(temp_dir, ignore_errors=True)
+                    return cached_path
         except Exception as e:
+            record_strategy_result(url, source, e)
             last_error = e
             continue
             
@@ -173,15 +344,14 @@ def download_video_preview(url):
                         print(f"✅ Found preview video via stealth: {video_url[:50]}...")
                         video_resp = requests.get(video_url, timeout=30)
                         if video_resp.status_code == 200:
-                            target_path = base_path + ".mp4"
-                            with open(target_path, "wb") as f:
-                                f.write(video_resp.content)
-                            return target_path
+                            shutil.rmtree(temp_dir, ignore_errors=True)
+                            return MEDIA_CACHE.store_bytes('preview', video_resp.content, f"preview_{url_hash}.mp4", key=url, pin=True)
         except Exception as te:
             print(f"❌ Stealth preview fallback error: {te}")
             
     if last_error:
         print(f"Error downloading video preview: {last_error}")
+    shutil.rmtree(temp_dir, ignore_errors=True)
     return None
 
 def get_video_info(url):
@@ -270,6 +440,8 @@ def get_video_info(url):
         # สำหรับ URL ที่ไม่ใช่ TikTok
         cookie_sources = [{}]
 
+    cookie_sources = STRATEGY_SCOREBOARD.order(strategy_domain(url), cookie_sources, strategy_label)
+
     last_error = None
     safari_permission_error = False
     
@@ -288,9 +460,12 @@ def get_video_info(url):
             }
             
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            with YTDLP_LIMITER.slot(), yt_dlp.YoutubeDL(ydl_opts) as ydl:
                 info = ydl.extract_info(url, download=False)
                 if info:
+                    record_strategy_result(url, source)
+                    if info.get('formats') and info.get('_type', 'video') == 'video':
+                        stash_extraction(url, ydl.sanitize_info(info, remove_private_keys=True), source, ydl_opts)
                     return {
                         'id': info.get('id'),
                         'title': info.get('title'),
@@ -301,7 +476,10 @@ def get_video_info(url):
                         'thumbnail': info.get('thumbnail'),
                         'url': info.get('url')
                     }
+                # ignoreerrors=True ทำให้การดึงข้อมูลที่ล้มเหลวคืนค่า None แทน Exception จึงต้องบันทึกเป็นความล้มเหลวเอง
+                record_strategy_result(url, source, RuntimeError("yt-dlp returned no info"))
         except Exception as e:
+            record_strategy_result(url, source, e)
             err_str = str(e)
             if 'Operation not permitted' in err_str and 'Safari' in err_str:
                 safari_permission_error = True
@@ -338,15 +516,73 @@ def get_video_title(url):
         print(f"Error fetching title: {e}")
         return None
 
-def download_audio(url, output_filename="temp_audio"):
+# รูปแบบการเข้ารหัสเสียงก่อนอัปโหลดไปยัง Gemini (ขนาดโดยประมาณต่อชั่วโมงเสียง)
+# - passthrough: ใช้สตรีมเสียงบิตเรตต่ำของต้นทางโดยไม่เข้ารหัสใหม่ (Opus/AAC ~50-70 kbps, ~25-30 MB)
+# - opus: Opus โมโน 16 kHz 24 kbps (~11 MB) เล็กที่สุด เหมาะกับไฟล์ยาว
+# - aac: AAC โมโน 16 kHz 32 kbps (~14 MB) สำหรับเครื่องที่ FFmpeg ไม่มี libopus
+# - wav: PCM 16 kHz โมโน (~115 MB) แบบเดิม
+# Gemini แปลงเสียงเป็น 16 kHz โมโนอยู่แล้ว การส่ง PCM เต็มจึงไม่ได้ความแม่นยำเพิ่ม
+AUDIO_PROFILES = {
+    'passthrough': {
+        'format': 'bestaudio[acodec=opus][abr<=80]/bestaudio[ext=m4a][abr<=80]/bestaudio/best',
+        'postprocessors': [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'best'}],
+        'postprocessor_args': [],
+        'export': {'format': 'ogg', 'codec': 'libopus', 'bitrate': '24k'},
+        'export_ext': 'ogg',
+    },
+    'opus': {
+        'format': 'bestaudio/best',
+        'postprocessors': [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'opus', 'preferredquality': '24'}],
+        'postprocessor_args': ['-ac', '1', '-ar', '16000'],
+        'export': {'format': 'ogg', 'codec': 'libopus', 'bitrate': '24k'},
+        'export_ext': 'ogg',
+    },
+    'aac': {
+        'format': 'bestaudio/best',
+        'postprocessors': [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'm4a', 'preferredquality': '32'}],
+        'postprocessor_args': ['-ac', '1', '-ar', '16000'],
+        'export': {'format': 'adts', 'codec': 'aac', 'bitrate': '32k'},
+        'export_ext': 'aac',
+    },
+    'wav': {
+        'format': 'bestaudio/best',
+        'postprocessors': [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'wav', 'preferredquality': '192'}],
+        'postprocessor_args': ['-ac', '1', '-ar', '16000'],
+        'export': {'format': 'wav'},
+        'export_ext': 'wav',
+    },
+}
+
+# กำหนดรูปแบบเสียงตายตัวได้ด้วย AUDIO_UPLOAD_PROFILE (ค่าเริ่มต้น auto = เลือกตามความยาววิดีโอ)
+AUDIO_UPLOAD_PROFILE = os.getenv('AUDIO_UPLOAD_PROFILE', 'auto')
+# วิดีโอที่สั้นกว่านี้ (วินาที) ใช้สตรีมต้นทางโดยไม่เข้ารหัสใหม่ (ไฟล์เล็กอยู่แล้ว ประหยัดเวลาเข้ารหัส)
+AUDIO_PASSTHROUGH_MAX_SECONDS = float(os.getenv('AUDIO_PASSTHROUGH_MAX_SECONDS', '1200'))
+
+def choose_audio_profile(duration_seconds=0):
+    """
+    เลือกรูปแบบการเข้ารหัสเสียงตามความยาว: วิดีโอสั้นใช้ passthrough วิดีโอยาวหรือไม่ทราบความยาวใช้ opus
+    (ไฟล์ยาวถูกอัปโหลดหลายครั้งเมื่อแบ่งช่วงหรือลองใหม่ จึงคุ้มที่จะเข้ารหัสให้เล็กที่สุด)
+    """
+    if AUDIO_UPLOAD_PROFILE in AUDIO_PROFILES:
+        return AUDIO_UPLOAD_PROFILE
+    if duration_seconds and duration_seconds <= AUDIO_PASSTHROUGH_MAX_SECONDS:
+        return 'passthrough'
+    return 'opus'
+
+def download_audio(url, output_filename="temp_audio", profile=None, duration_seconds=0):
     """
     Downloads audio from a video URL using yt-dlp.
     Attempts to use cookies from various sources if available.
+    profile: รูปแบบการเข้ารหัสใน AUDIO_PROFILES (None = เลือกอัตโนมัติจาก duration_seconds ด้วย choose_audio_profile)
     """
     import os
     
+    profile = profile if profile in AUDIO_PROFILES else choose_audio_profile(duration_seconds)
+    audio_profile = AUDIO_PROFILES[profile]
+    print(f"   🎚️ Audio profile: {profile}")
+
     # ล้างไฟล์เก่าทิ้งก่อน (Clean up previous files)
-    possible_extensions = ['m4a', 'mp3', 'webm', 'mp4', 'aac', 'wav']
+    possible_extensions = ['m4a', 'mp3', 'webm', 'mp4', 'aac', 'wav', 'opus', 'ogg']
     for ext in possible_extensions:
         path = f"{output_filename}.{ext}"
         if os.path.exists(path):
@@ -358,7 +594,7 @@ def download_audio(url, output_filename="temp_audio"):
         except: pass
         
     base_ydl_opts = {
-        'format': 'bestaudio/best', 
+        'format': audio_profile['format'], 
         'outtmpl': output_filename, 
         'quiet': False,
         'no_warnings': False,
@@ -373,15 +609,9 @@ def download_audio(url, output_filename="temp_audio"):
         },
         'socket_timeout': 60,
         'retries': 5,
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'wav',
-            'preferredquality': '192',
-        }],
-        'postprocessor_args': [
-            '-ac', '1',  # Mono
-            '-ar', '16000' # 16kHz (Gemini Native Resolution) for zero-latency sync
-        ],
+        'postprocessors': [dict(pp) for pp in audio_profile['postprocessors']],
+        # โมโน 16 kHz (ความละเอียดที่ Gemini ใช้จริง) ยกเว้น passthrough ที่ไม่เข้ารหัสใหม่
+        'postprocessor_args': list(audio_profile['postprocessor_args']),
     }
     
     cookie_sources = []
@@ -414,17 +644,12 @@ def download_audio(url, output_filename="temp_audio"):
     # 3. Simple Safari (Broadly supported)
     cookie_sources.append({'rotation_target': 'safari'})
 
-    last_error = None
-    safari_permission_error = False
-    
-    for source in cookie_sources:
+    def build_attempt_opts(source, attempt_output):
         ydl_opts = base_ydl_opts.copy()
         ydl_opts.update(source)
+        ydl_opts['outtmpl'] = attempt_output
+        ydl_opts['postprocessors'] = [dict(pp) for pp in base_ydl_opts['postprocessors']]
         
-        source_name = source.get('cookiesfrombrowser', 'no-cookies')
-        if source.get('cookiefile'):
-            source_name = f"file:{os.path.basename(source.get('cookiefile'))}"
-
         if "tiktok.com" in url or "youtube.com" in url or "youtu.be" in url:
             # Use robust settings as get_video_info
             
@@ -452,47 +677,128 @@ def download_audio(url, output_filename="temp_audio"):
                 'Accept-Language': 'en-US,en;q=0.9,th;q=0.8',
                 'Referer': 'https://www.google.com/',
             }
-            
+        ydl_opts.pop('rotation_target', None)
+        return ydl_opts
+
+    def remove_attempt_files(attempt_output):
+        # รวมไฟล์ค้าง .part / .ytdl ของ yt-dlp จากกลยุทธ์ที่ถูกยกเลิกกลางทาง
+        paths = [attempt_output] + [f"{attempt_output}.{ext}" for ext in possible_extensions]
+        for path in [p for base in paths for p in (base, f"{base}.part", f"{base}.ytdl")]:
+            if os.path.exists(path):
+                try: os.remove(path)
+                except: pass
+
+    # มีเพียงกลยุทธ์แรกที่ดาวน์โหลดเสร็จเท่านั้นที่ได้ย้ายไฟล์ไปยังชื่อจริง (กันกรณีเสร็จพร้อมกันแล้วเขียนทับกัน)
+    winner_lock = threading.Lock()
+    winner = []
+
+    def run_attempt(index, source, cancel_event, mark_started, info=None, network_opts=None):
+        # แต่ละกลยุทธ์ดาวน์โหลดลงไฟล์ของตัวเอง ผู้ชนะจึงถูกย้ายไปยังชื่อจริงโดยไม่ชนกับกลยุทธ์อื่น
+        # info: ผลการดึงข้อมูลจากขั้น Metadata (ถ้ามี) ใช้เลือกรูปแบบและดาวน์โหลดโดยไม่ดึงหน้าเว็บซ้ำ
+        # network_opts: ตัวเลือกเครือข่ายของขั้น Metadata ใช้แทนของ build_attempt_opts (ไม่เพิ่ม Impersonate / User-Agent อื่น)
+        attempt_output = f"{output_filename}.try{index}"
+        if network_opts is not None:
+            ydl_opts = base_ydl_opts.copy()
+            ydl_opts.update(copy.deepcopy(network_opts))
+            ydl_opts['outtmpl'] = attempt_output
+            ydl_opts['postprocessors'] = [dict(pp) for pp in base_ydl_opts['postprocessors']]
+        else:
+            ydl_opts = build_attempt_opts(source, attempt_output)
+
+        def progress_hook(d):
+            if cancel_event.is_set():
+                raise DownloadCancelled(f"cancelled: another strategy won ({strategy_label(source)})")
+            if d.get('status') == 'downloading' and d.get('downloaded_bytes'):
+                mark_started()
+
+        ydl_opts['progress_hooks'] = [progress_hook]
+        print(f"   🚀 Download attempt using: {strategy_label(source)}")
         try:
-            print(f"   🚀 Download attempt using: {source_name}")
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
-            
-            # ค้นหาไฟล์ที่ดาวน์โหลดสำเร็จ
-            for ext in possible_extensions:
-                path = f"{output_filename}.{ext}"
-                if os.path.exists(path):
-                    print(f"   ✅ Download successful: {path}")
-                    return path
-            if os.path.exists(output_filename):
-                print(f"   ✅ Download successful (no ext): {output_filename}")
-                return output_filename
+            # DownloadCancelled ไม่ใช่สัญญาณโอเวอร์โหลด จึงถูกนับเป็น neutral โดย YTDLP_LIMITER
+            with YTDLP_LIMITER.slot(), yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                if info is not None:
+                    ydl.process_ie_result(copy.deepcopy(info), download=True)
+                else:
+                    ydl.download([url])
+
+            # ค้นหาไฟล์ที่ดาวน์โหลดสำเร็จ แล้วย้ายไปยังชื่อจริง
+            with winner_lock:
+                if cancel_event.is_set() or winner:
+                    raise DownloadCancelled(f"cancelled: another strategy won ({strategy_label(source)})")
+                final_path = None
+                for ext in possible_extensions:
+                    path = f"{attempt_output}.{ext}"
+                    if os.path.exists(path):
+                        final_path = f"{output_filename}.{ext}"
+                        os.replace(path, final_path)
+                        break
+                if not final_path and os.path.exists(attempt_output):
+                    final_path = output_filename
+                    os.replace(attempt_output, final_path)
+                if not final_path:
+                    raise FileNotFoundError(f"yt-dlp finished without an output file ({strategy_label(source)})")
+                winner.append(index)
         except Exception as e:
-            # Clean ANSI colors and use repr(e) if empty
-            import re
-            raw_err = str(e) if str(e) else repr(e)
-            ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
-            err_str = ansi_escape.sub('', raw_err)
-            
-            print(f"   ⚠️  Download attempt failed ({source_name}): {err_str[:200]}...")
-            if 'Operation not permitted' in err_str and 'Safari' in err_str:
-                safari_permission_error = True
-            
-            # ลำดับความสำคัญของ Error:
-            # 1. Actionable (Sign in, Blocked, Unavailable)
-            # 2. Network/Timeout
-            # 3. Cookie not found (ความสำคัญต่ำสุด)
-            
-            is_serious_error = any(msg in err_str for msg in ["Sign in", "blocked", "Unavailable", "403", "Forbidden"])
-            is_cookie_not_found = "could not find" in err_str.lower() or "database" in err_str.lower()
-            
-            if not last_error:
-                last_error = e
-            elif is_serious_error and not any(msg in (str(last_error) if str(last_error) else repr(last_error)) for msg in ["Sign in", "blocked", "Unavailable"]):
-                last_error = e
-            elif not is_cookie_not_found and "could not find" in (str(last_error) if str(last_error) else repr(last_error)).lower():
-                 last_error = e
-            continue
+            record_strategy_result(url, source, e)
+            raise
+        finally:
+            remove_attempt_files(attempt_output)
+
+        record_strategy_result(url, source)
+        print(f"   ✅ Download successful ({strategy_label(source)}): {final_path}")
+        return final_path
+
+    # ใช้ผลการดึงข้อมูลจาก get_video_info ก่อน (ถ้ามี) ล้มเหลวเมื่อไรจึงค่อยแข่งกลยุทธ์ตามปกติ
+    handoff = take_extraction(url)
+    if handoff:
+        handoff_info, handoff_source, handoff_network_opts = handoff
+        print(f"   ♻️ ใช้ผลการดึงข้อมูลจากขั้น Metadata ({strategy_label(handoff_source)}) ข้ามการโหลดหน้าเว็บซ้ำ")
+        try:
+            return run_attempt('handoff', handoff_source, threading.Event(), lambda: None,
+                               info=handoff_info, network_opts=handoff_network_opts)
+        except Exception as e:
+            print(f"   ⚠️  Handoff download failed, falling back to full extraction: {str(e)[:200]}")
+
+    # เริ่มจากกลยุทธ์ที่เพิ่งสำเร็จบนโดเมนนี้ (ลำดับเดิมเมื่อยังไม่มีสถิติ)
+    cookie_sources = STRATEGY_SCOREBOARD.order(strategy_domain(url), cookie_sources, strategy_label)
+
+    # แข่งกลยุทธ์ (คุกกี้ / Impersonate) พร้อมกันตาม YTDLP_DOWNLOAD_FANOUT แทนการลองทีละกลยุทธ์
+    # วิดีโอที่ถูกบล็อกจึงรอประมาณหนึ่ง Timeout แทนการรอ Timeout ของทุกกลยุทธ์ต่อกัน
+    downloaded_path, attempt_errors = race_strategies(
+        cookie_sources, run_attempt,
+        fanout=YTDLP_DOWNLOAD_FANOUT, hedge_delay=YTDLP_HEDGE_DELAY,
+    )
+    if downloaded_path:
+        return downloaded_path
+
+    last_error = None
+    safari_permission_error = False
+    
+    for index, e in sorted(attempt_errors, key=lambda item: item[0]):
+        # Clean ANSI colors and use repr(e) if empty
+        import re
+        raw_err = str(e) if str(e) else repr(e)
+        ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
+        err_str = ansi_escape.sub('', raw_err)
+        
+        print(f"   ⚠️  Download attempt failed ({strategy_label(cookie_sources[index])}): {err_str[:200]}...")
+        if 'Operation not permitted' in err_str and 'Safari' in err_str:
+            safari_permission_error = True
+        
+        # ลำดับความสำคัญของ Error:
+        # 1. Actionable (Sign in, Blocked, Unavailable)
+        # 2. Network/Timeout
+        # 3. Cookie not found (ความสำคัญต่ำสุด)
+        
+        is_serious_error = any(msg in err_str for msg in ["Sign in", "blocked", "Unavailable", "403", "Forbidden"])
+        is_cookie_not_found = "could not find" in err_str.lower() or "database" in err_str.lower()
+        
+        if not last_error:
+            last_error = e
+        elif is_serious_error and not any(msg in (str(last_error) if str(last_error) else repr(last_error)) for msg in ["Sign in", "blocked", "Unavailable"]):
+            last_error = e
+        elif not is_cookie_not_found and "could not find" in (str(last_error) if str(last_error) else repr(last_error)).lower():
+             last_error = e
     
     if last_error:
         # เก็บข้อความ Error ล่าสุดที่คัดกรองเลาย (ANSI Stripped)
@@ -572,8 +878,12 @@ def search_videos(query, max_results=3, platforms=['youtube']):
                     "--skip-download"
                 ]
                 
-                # รันคำสั่ง (Run command)
-                result = subprocess.run(command, capture_output=True, text=True, timeout=30)
+                # รันคำสั่ง (Run command) ภายใต้ตัวจำกัดงานพร้อมกันของ yt-dlp
+                with YTDLP_LIMITER.slot() as permit:
+                    result = subprocess.run(command, capture_output=True, text=True, timeout=30)
+                    if result.returncode != 0:
+                        if is_overload_error(result.stderr or ""): permit.overloaded()
+                        else: permit.neutral()
                 
                 if result.returncode == 0:
                     # yt-dlp จะแสดงผลลัพธ์เป็นออบเจกต์ JSON หนึ่งรายการต่อหนึ่งบรรทัดสำหรับการค้นหา
@@ -720,6 +1030,57 @@ def parse_timestamp_to_seconds(timestamp_str):
         
     return total_seconds
 
+def split_audio_at_silences(audio_path, output_dir, target_seconds=600, overlap_seconds=5, search_seconds=30, min_silence_ms=700, silence_thresh_db=-40, profile='opus'):
+    """
+    แบ่งไฟล์เสียงยาวเป็นช่วงๆ (ประมาณ target_seconds ต่อช่วง) โดยตัดที่ช่วงเงียบที่ใกล้จุดตัดที่สุด
+    แต่ละช่วงมีส่วนเหลื่อม (Overlap) ด้านละ overlap_seconds เพื่อไม่ให้คำที่อยู่ตรงรอยต่อหายไป
+    แต่ละช่วงเข้ารหัสตาม profile ใน AUDIO_PROFILES (ค่าเริ่มต้น opus)
+    คืนค่ารายการ dict: path, start, end (ช่วงที่ส่งให้โมเดล) และ own_start, own_end (ช่วงที่ช่วงนี้เป็นเจ้าของ ใช้ตัดส่วนซ้ำ)
+    """
+    from pydub import AudioSegment
+    from pydub.silence import detect_silence
+
+    audio = AudioSegment.from_file(audio_path)
+    total_ms = len(audio)
+    target_ms = int(target_seconds * 1000)
+    if total_ms <= target_ms:
+        return [{'path': audio_path, 'start': 0.0, 'end': total_ms / 1000, 'own_start': 0.0, 'own_end': total_ms / 1000}]
+
+    # หาจุดตัด: ตรวจหาช่วงเงียบเฉพาะรอบๆ จุดตัดเป้าหมาย (ไม่ต้องสแกนทั้งไฟล์)
+    cuts = [0]
+    search_ms = int(search_seconds * 1000)
+    while total_ms - cuts[-1] > target_ms * 1.2:
+        target = cuts[-1] + target_ms
+        window_start = max(cuts[-1] + target_ms // 2, target - search_ms)
+        window_end = min(total_ms, target + search_ms)
+        silences = detect_silence(audio[window_start:window_end], min_silence_len=min_silence_ms, silence_thresh=silence_thresh_db, seek_step=10)
+        if silences:
+            # เลือกช่วงเงียบที่กึ่งกลางใกล้จุดตัดเป้าหมายที่สุด
+            mid_points = [window_start + (s + e) // 2 for s, e in silences]
+            cut = min(mid_points, key=lambda m: abs(m - target))
+        else:
+            cut = target
+        cuts.append(cut)
+    cuts.append(total_ms)
+
+    base_name = os.path.splitext(os.path.basename(audio_path))[0]
+    overlap_ms = int(overlap_seconds * 1000)
+    chunks = []
+    for i in range(len(cuts) - 1):
+        start_ms = max(0, cuts[i] - overlap_ms)
+        end_ms = min(total_ms, cuts[i + 1] + overlap_ms)
+        export = AUDIO_PROFILES.get(profile, AUDIO_PROFILES['opus'])
+        chunk_path = os.path.join(output_dir, f"{base_name}_part{i:03d}.{export['export_ext']}")
+        audio[start_ms:end_ms].set_frame_rate(16000).set_channels(1).export(chunk_path, **export['export'])
+        chunks.append({
+            'path': chunk_path,
+            'start': start_ms / 1000,
+            'end': end_ms / 1000,
+            'own_start': cuts[i] / 1000,
+            'own_end': cuts[i + 1] / 1000
+        })
+    return chunks
+
 def get_url_with_timestamp(url, seconds, autoplay=False):
     """
     เพิ่มพารามิเตอร์เวลา (Timestamp) ลงใน URL เพื่อให้สามารถเลื่อนเวลาได้อย่างแม่นยำ